@@ -0,0 +1,315 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import tzlocal
+import config
+
+DATA_DIR = "data"
+DB_PATH = os.path.join(DATA_DIR, "garmin_import.db")
+ACCOUNTS_DIR = os.path.join(DATA_DIR, "accounts")
+
+# Token stores of the original single-user setup. The "default" account (id None)
+# keeps using these so existing installs continue to work untouched.
+DEFAULT_TOKEN_FILE = os.path.join(DATA_DIR, "withings_tokens.pkl")
+DEFAULT_GARMIN_TOKEN_DIR = os.path.join(DATA_DIR, ".garminconnect")
+
+ACCOUNT_FIELDS = [
+    'name',
+    'withings_client_id',
+    'withings_client_secret',
+    'withings_redirect_uri',
+    'garmin_email',
+    'garmin_password',
+    'enabled',
+]
+
+SECRET_FIELDS = ['withings_client_secret', 'garmin_password']
+
+
+def init_accounts_db(db_path=DB_PATH):
+    """Creates the accounts and cursor tables if they don't exist yet."""
+    with sqlite3.connect(db_path) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS accounts
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      name TEXT NOT NULL,
+                      withings_client_id TEXT,
+                      withings_client_secret TEXT,
+                      withings_redirect_uri TEXT,
+                      garmin_email TEXT,
+                      garmin_password TEXT,
+                      enabled BOOLEAN DEFAULT 1,
+                      last_sync_at TEXT,
+                      last_status TEXT)''')
+        # Cursors are small named values per account (e.g. the newest synced measurement).
+        # account_id 0 is the default account.
+        c.execute('''CREATE TABLE IF NOT EXISTS sync_cursors
+                     (account_id INTEGER NOT NULL,
+                      name TEXT NOT NULL,
+                      value TEXT,
+                      updated_at TEXT,
+                      PRIMARY KEY (account_id, name))''')
+        # Next free Garmin call slot per account, shared by the web and sync worker processes
+        c.execute('''CREATE TABLE IF NOT EXISTS rate_limits
+                     (account_id INTEGER PRIMARY KEY,
+                      next_slot REAL NOT NULL)''')
+        conn.commit()
+
+
+_db_ready = False
+
+def _ensure_db():
+    """Makes sure the tables exist when used outside the web server (e.g. CLI syncs)."""
+    global _db_ready
+    if not _db_ready:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        init_accounts_db()
+        _db_ready = True
+
+
+def _account_key(account):
+    """Maps an account dict / id / None to the integer key used in cursor tables and registries."""
+    if account is None:
+        return 0
+    if isinstance(account, dict):
+        return account.get('id') or 0
+    return int(account)
+
+
+def list_accounts():
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM accounts ORDER BY id")
+        return [dict(row) for row in c.fetchall()]
+
+
+def get_account(account_id):
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM accounts WHERE id=?", (account_id,))
+        row = c.fetchone()
+        return dict(row) if row else None
+
+
+def add_account(data):
+    values = [data.get(f) for f in ACCOUNT_FIELDS]
+    values[ACCOUNT_FIELDS.index('enabled')] = 1 if data.get('enabled', True) else 0
+    with sqlite3.connect(DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute(f"INSERT INTO accounts ({', '.join(ACCOUNT_FIELDS)}) VALUES ({', '.join('?' * len(ACCOUNT_FIELDS))})",
+                  values)
+        conn.commit()
+        return c.lastrowid
+
+
+def update_account(account_id, data):
+    fields = [f for f in ACCOUNT_FIELDS if f in data]
+    if not fields:
+        return
+    with sqlite3.connect(DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute(f"UPDATE accounts SET {', '.join(f + '=?' for f in fields)} WHERE id=?",
+                  [data[f] for f in fields] + [account_id])
+        conn.commit()
+
+
+def delete_account(account_id):
+    with sqlite3.connect(DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM accounts WHERE id=?", (account_id,))
+        c.execute("DELETE FROM sync_cursors WHERE account_id=?", (account_id,))
+        conn.commit()
+
+
+def record_sync_result(account_id, status):
+    if not account_id:
+        return
+    timestamp = datetime.now(tzlocal.get_localzone()).strftime("%Y-%m-%d %H:%M:%S")
+    with sqlite3.connect(DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE accounts SET last_sync_at=?, last_status=? WHERE id=?", (timestamp, status, account_id))
+        conn.commit()
+
+
+def public_view(account):
+    """Account dict safe to return from the API (secrets masked)."""
+    view = dict(account)
+    for f in SECRET_FIELDS:
+        view[f] = bool(view.get(f))
+    return view
+
+
+def resolve(account=None):
+    """
+    Returns a fully populated settings dict for an account: credentials plus the paths
+    of its token stores. `account` may be an account dict, an account id, or None for
+    the default single-user setup (global config and the legacy token paths).
+    """
+    if isinstance(account, dict) and 'token_file' in account:
+        return account  # Already resolved
+
+    if account is None:
+        return {
+            'id': None,
+            'name': 'default',
+            'withings_client_id': config.WITHINGS_CLIENT_ID,
+            'withings_client_secret': config.WITHINGS_CLIENT_SECRET,
+            'withings_redirect_uri': config.WITHINGS_REDIRECT_URI,
+            'garmin_email': config.GARMIN_EMAIL,
+            'garmin_password': config.GARMIN_PASSWORD,
+            'token_file': DEFAULT_TOKEN_FILE,
+            'garmin_token_dir': DEFAULT_GARMIN_TOKEN_DIR,
+        }
+
+    if not isinstance(account, dict):
+        account_id = account
+        account = get_account(account_id)
+        if not account:
+            raise Exception(f"Account {account_id} not found.")
+
+    account_dir = os.path.join(ACCOUNTS_DIR, str(account['id']))
+    settings = dict(account)
+    settings['withings_redirect_uri'] = account.get('withings_redirect_uri') or config.WITHINGS_REDIRECT_URI
+    settings['token_file'] = os.path.join(account_dir, "withings_tokens.pkl")
+    settings['garmin_token_dir'] = os.path.join(account_dir, ".garminconnect")
+    return settings
+
+
+def get_cursor(account, name, default=None):
+    try:
+        _ensure_db()
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT value FROM sync_cursors WHERE account_id=? AND name=?", (_account_key(account), name))
+            row = c.fetchone()
+            return row[0] if row else default
+    except sqlite3.Error:
+        return default
+
+
+def set_cursor(account, name, value):
+    updated_at = datetime.now(tzlocal.get_localzone()).strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        _ensure_db()
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("INSERT OR REPLACE INTO sync_cursors (account_id, name, value, updated_at) VALUES (?, ?, ?, ?)",
+                      (_account_key(account), name, str(value), updated_at))
+            conn.commit()
+    except sqlite3.Error as e:
+        print(f"Warning: Could not save cursor '{name}'. Error type: {type(e).__name__}")
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that at most one happens every `min_interval` seconds.
+    Shared by every job of an account, so parallel jobs can't burst Garmin. The next free
+    slot lives in the database, so jobs in sync worker processes share it as well.
+    """
+
+    def __init__(self, account_key, min_interval):
+        self.account_key = account_key
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def _reserve(self, now):
+        """Claims the next slot across processes; returns its time."""
+        _ensure_db()
+        with sqlite3.connect(DB_PATH, timeout=30) as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT next_slot FROM rate_limits WHERE account_id=?", (self.account_key,))
+            row = c.fetchone()
+            slot = max(now, row[0] if row else 0.0)
+            c.execute("INSERT OR REPLACE INTO rate_limits (account_id, next_slot) VALUES (?, ?)",
+                      (self.account_key, slot + self.min_interval))
+            conn.commit()
+        return slot
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            try:
+                slot = self._reserve(now)
+            except sqlite3.Error as e:
+                # Database busy or unavailable: space out this process' calls at least
+                print(f"Warning: Could not reserve a Garmin call slot. Error type: {type(e).__name__}")
+                slot = max(now, self._next_slot)
+            self._next_slot = max(self._next_slot, slot + self.min_interval)
+            delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(account=None):
+    key = _account_key(account)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(key, config.GARMIN_MIN_INTERVAL)
+            _rate_limiters[key] = limiter
+        return limiter
+
+
+class AccountSyncPool:
+    """
+    Bounded worker pool running sync jobs for many accounts in parallel.
+    At most one job per account runs at a time; a job submitted for a busy account is rejected.
+    The exception are bulk jobs (submit_bulk): a regular job may run while the account's bulk
+    job is running, since bulk jobs give way to interactive work (see priority.PriorityGate).
+    Each lane has its own `max_workers` threads, so queued bulk jobs never keep an interactive
+    job from starting.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="account-sync")
+        self._bulk_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="account-bulk")
+        self._running = set()
+        self._bulk = set()
+        self._lock = threading.Lock()
+
+    def is_running(self, account_id):
+        key = _account_key(account_id)
+        with self._lock:
+            return key in self._running or key in self._bulk
+
+    def _submit(self, executor, key, lane, blocked_by, fn, args, kwargs):
+        with self._lock:
+            if any(key in jobs for jobs in blocked_by):
+                return None
+            lane.add(key)
+
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Account {key} job failed. Error type: {type(e).__name__}")
+            finally:
+                with self._lock:
+                    lane.discard(key)
+
+        return executor.submit(run)
+
+    def submit(self, account_id, fn, *args, **kwargs):
+        """Queues fn for the account. Returns a Future, or None if the account already has a (non-bulk) job."""
+        return self._submit(self._executor, _account_key(account_id), self._running, (self._running,), fn, args, kwargs)
+
+    def submit_bulk(self, account_id, fn, *args, **kwargs):
+        """Queues a bulk job (historical import, backfill, ...). Returns None if the account has any job."""
+        return self._submit(self._bulk_executor, _account_key(account_id), self._bulk, (self._running, self._bulk),
+                            fn, args, kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self._bulk_executor.shutdown(wait=False)
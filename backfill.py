@@ -0,0 +1,257 @@
+"""
+Drip backfills: large historical imports spread over days.
+
+A backfill plan covers a date range and has an hourly and a daily budget of Garmin
+upload calls plus an optional time-of-day window. Every BACKFILL_TICK_MINUTES the
+scheduler runs one step per active plan: a historical sync from the plan's cursor that
+stops before exceeding the share of the budget left for this tick. The cursor advances
+after every group, so plans survive restarts and simply continue on the next tick.
+"""
+import argparse
+import asyncio
+import math
+import sqlite3
+import time
+from datetime import datetime, timezone, timedelta
+
+import accounts
+import config
+import sync_engine
+
+STATUS_ACTIVE = 'active'
+STATUS_PAUSED = 'paused'
+STATUS_COMPLETED = 'completed'
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS backfill_plans
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      account_id INTEGER NOT NULL,
+                      start_ts INTEGER NOT NULL,
+                      end_ts INTEGER NOT NULL,
+                      cursor_ts INTEGER NOT NULL,
+                      hourly_budget INTEGER NOT NULL,
+                      daily_budget INTEGER NOT NULL,
+                      window_start TEXT,
+                      window_end TEXT,
+                      processed INTEGER NOT NULL DEFAULT 0,
+                      status TEXT NOT NULL,
+                      created_at INTEGER,
+                      updated_at INTEGER)''')
+        # Garmin upload calls made by each step, for the rolling hourly / daily budgets
+        c.execute('''CREATE TABLE IF NOT EXISTS backfill_usage
+                     (plan_id INTEGER NOT NULL,
+                      ts INTEGER NOT NULL,
+                      calls INTEGER NOT NULL)''')
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+def date_range(from_date=None, to_date=None, days=365):
+    """
+    (start_ts, end_ts) of whole days from_date..to_date (YYYY-MM-DD, UTC like sync_historical);
+    without from_date the last `days` days, without to_date up to now.
+    """
+    now = datetime.now(timezone.utc)
+    if from_date:
+        start = datetime.strptime(from_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    else:
+        start = now - timedelta(days=int(days))
+    end = (datetime.strptime(to_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1, seconds=-1)
+           if to_date else now)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def _parse_time(value):
+    """'HH:MM' -> minutes after midnight, None for an empty value."""
+    if not value:
+        return None
+    hour, minute = value.split(':')
+    hour, minute = int(hour), int(minute)
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        raise ValueError(f"Invalid time of day: {value}")
+    return hour * 60 + minute
+
+
+def in_window(plan, now=None):
+    """Whether the plan may upload at local time `now`. Windows may wrap midnight (22:00-06:00)."""
+    start, end = _parse_time(plan['window_start']), _parse_time(plan['window_end'])
+    if start is None or end is None:
+        return True
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def create(start_ts, end_ts, account=None, hourly_budget=None, daily_budget=None, window_start=None, window_end=None):
+    """Persists a new active plan and returns its id."""
+    _ensure_db()
+    _parse_time(window_start)
+    _parse_time(window_end)
+    now = int(time.time())
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO backfill_plans
+                     (account_id, start_ts, end_ts, cursor_ts, hourly_budget, daily_budget, window_start, window_end,
+                      processed, status, created_at, updated_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)''',
+                  (accounts._account_key(account), start_ts, end_ts, start_ts,
+                   hourly_budget or config.BACKFILL_HOURLY_BUDGET, daily_budget or config.BACKFILL_DAILY_BUDGET,
+                   window_start or None, window_end or None, STATUS_ACTIVE, now, now))
+        conn.commit()
+        return c.lastrowid
+
+
+def get(plan_id):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM backfill_plans WHERE id=?", (plan_id,))
+        row = c.fetchone()
+        return dict(row) if row else None
+
+
+def list_plans(status=None):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        if status:
+            c.execute("SELECT * FROM backfill_plans WHERE status=? ORDER BY id", (status,))
+        else:
+            c.execute("SELECT * FROM backfill_plans ORDER BY id")
+        return [dict(row) for row in c.fetchall()]
+
+
+def set_status(plan_id, status):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE backfill_plans SET status=?, updated_at=? WHERE id=?", (status, int(time.time()), plan_id))
+        conn.commit()
+        return c.rowcount > 0
+
+
+def delete(plan_id):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM backfill_usage WHERE plan_id=?", (plan_id,))
+        c.execute("DELETE FROM backfill_plans WHERE id=?", (plan_id,))
+        conn.commit()
+        return c.rowcount > 0
+
+
+def _used(c, plan_id, since):
+    c.execute("SELECT COALESCE(SUM(calls), 0) FROM backfill_usage WHERE plan_id=? AND ts>?", (plan_id, since))
+    return c.fetchone()[0]
+
+
+def allowance(plan, now=None):
+    """Garmin upload calls the plan may make in this tick."""
+    now = now or int(time.time())
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        left = min(plan['hourly_budget'] - _used(c, plan['id'], now - 3600),
+                   plan['daily_budget'] - _used(c, plan['id'], now - 86400))
+    # Spread the hourly budget evenly over the ticks of an hour
+    per_tick = math.ceil(plan['hourly_budget'] * max(1, config.BACKFILL_TICK_MINUTES) / 60)
+    return max(0, min(left, per_tick))
+
+
+def _record_usage(plan_id, calls):
+    now = int(time.time())
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        if calls:
+            c.execute("INSERT INTO backfill_usage (plan_id, ts, calls) VALUES (?, ?, ?)", (plan_id, now, calls))
+        c.execute("DELETE FROM backfill_usage WHERE ts<?", (now - 86400,))
+        conn.commit()
+
+
+class PlanCursor:
+    """Checkpoint-compatible progress of a plan (see checkpoints.Checkpoint)."""
+
+    def __init__(self, plan):
+        self.plan_id = plan['id']
+        self.finished = False
+
+    def advance(self, date, grpid=None):
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE backfill_plans SET cursor_ts=?, processed=processed+1, updated_at=? WHERE id=?",
+                      (date + 1, int(time.time()), self.plan_id))
+            conn.commit()
+
+    def finish(self, completed):
+        self.finished = True
+        if completed:
+            set_status(self.plan_id, STATUS_COMPLETED)
+
+
+def run_step(plan_id):
+    """
+    Runs one budgeted step of a plan. Returns the number of Garmin upload calls made,
+    or None if the plan had nothing to do this tick.
+    """
+    plan = get(plan_id)
+    if not plan or plan['status'] != STATUS_ACTIVE:
+        return None
+    if not in_window(plan):
+        return None
+    budget = allowance(plan)
+    if not budget:
+        return None
+
+    print(f"Backfill #{plan_id}: syncing from {datetime.fromtimestamp(plan['cursor_ts']).strftime('%Y-%m-%d %H:%M')} "
+          f"to {datetime.fromtimestamp(plan['end_ts']).strftime('%Y-%m-%d')}, up to {budget} upload(s).")
+    sync_pipeline = asyncio.run(sync_engine.run_range_sync(
+        start_date=plan['cursor_ts'], end_date=plan['end_ts'], account=plan['account_id'] or None,
+        checkpoint=PlanCursor(plan), max_uploads=budget, bulk=True,
+    ))
+    calls = sync_pipeline.upload_calls if sync_pipeline else 0
+    _record_usage(plan_id, calls)
+
+    plan = get(plan_id)
+    if plan['status'] == STATUS_COMPLETED:
+        print(f"Backfill #{plan_id} completed: {plan['processed']} measurement group(s) imported.")
+    return calls
+
+
+def due_plans():
+    """Active plans inside their time-of-day window."""
+    return [plan for plan in list_plans(STATUS_ACTIVE) if in_window(plan)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drip a large historical import into Garmin within an upload budget.')
+    parser.add_argument('--from-date', required=True, help='First day to import (YYYY-MM-DD)')
+    parser.add_argument('--to-date', default=None, help='Last day to import (YYYY-MM-DD, default: today)')
+    parser.add_argument('--hourly', type=int, default=None, help=f'Upload calls per hour (default: {config.BACKFILL_HOURLY_BUDGET})')
+    parser.add_argument('--daily', type=int, default=None, help=f'Upload calls per day (default: {config.BACKFILL_DAILY_BUDGET})')
+    parser.add_argument('--window', default=None, help='Allowed local time of day, e.g. 01:00-06:00')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    args = parser.parse_args()
+
+    start_ts, end_ts = date_range(args.from_date, args.to_date)
+    window_start, window_end = args.window.split('-') if args.window else (None, None)
+    plan_id = create(start_ts, end_ts, account=args.account, hourly_budget=args.hourly,
+                     daily_budget=args.daily, window_start=window_start, window_end=window_end)
+    print(f"Backfill #{plan_id} created. The running server imports it in steps every {config.BACKFILL_TICK_MINUTES} minutes.")
+
+
+if __name__ == "__main__":
+    main()
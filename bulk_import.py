@@ -0,0 +1,361 @@
+"""
+Bulk manual import: CSV or JSON files of body measurements uploaded to Garmin.
+
+Files are streamed row by row, so memory use depends on IMPORT_BATCH_SIZE and not
+on the file size. Each row is validated and converted to kg like a manual entry,
+checked against the weigh-ins already in Garmin (read in bulk, RECONCILE_CHUNK_DAYS
+days per request, once per batch of rows) and uploaded through a single Garmin
+session spaced by the account's rate limiter. Uploads that fail go to the retry queue.
+
+Columns / keys: timestamp (or date), weight, fat_ratio, muscle_mass, bone_mass,
+hydration, bmi and an optional per-row unit ('kg' or 'lbs').
+"""
+import argparse
+import csv
+import io
+import json
+import os
+from datetime import datetime, timedelta
+
+import tzlocal
+
+import accounts
+import circuit_breaker
+import config
+import outbox
+import priority
+import reconcile
+import sync_app
+
+FORMAT_CSV = 'csv'
+FORMAT_JSON = 'json'
+
+VALUE_FIELDS = ('weight', 'fat_ratio', 'muscle_mass', 'bone_mass', 'hydration', 'bmi')
+
+# Rows reported individually in the log; the rest are only counted
+MAX_REPORTED_ROWS = 20
+
+_READ_CHUNK = 64 * 1024
+
+
+class RowError(ValueError):
+    pass
+
+
+class InvalidFileError(ValueError):
+    """The file as a whole cannot be read (as opposed to a single bad row)."""
+
+
+def detect_format(path):
+    return FORMAT_JSON if os.path.splitext(path)[1].lower() in ('.json', '.ndjson', '.jsonl') else FORMAT_CSV
+
+
+def _iter_json_array(text):
+    """Yields the elements of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buf = text.read(_READ_CHUNK).lstrip()
+    if not buf.startswith('['):
+        raise InvalidFileError("JSON import files must contain an array or one object per line.")
+    buf = buf[1:]
+    eof = False
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if buf.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise InvalidFileError(f"truncated or malformed JSON array ({e.msg})") from e
+            chunk = text.read(_READ_CHUNK)
+            eof = not chunk
+            buf += chunk
+            continue
+        yield item
+        buf = buf[end:]
+
+
+def read_rows(stream, fmt):
+    """
+    Yields (row number, dict) from a binary stream. JSON files may hold an array of
+    objects or one object per line (NDJSON).
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        yield from _read_text(text, fmt)
+    finally:
+        # The caller owns the stream (and reads its position for progress)
+        text.detach()
+
+
+def _read_text(text, fmt):
+    if fmt == FORMAT_CSV:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, {(k or '').strip().lower(): v for k, v in row.items()}
+        return
+
+    first = text.read(1)
+    while first.isspace():
+        first = text.read(1)
+    if not first:
+        return
+    text = _Prefixed(first, text)
+    if first == '[':
+        yield from enumerate(_iter_json_array(text), 1)
+        return
+    for number, line in enumerate(text, 1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except json.JSONDecodeError as e:
+                # Rejected like any other invalid row (see _batches)
+                yield number, RowError(f"invalid JSON ({e.msg})")
+
+
+class _Prefixed:
+    """A text stream with already consumed characters put back in front."""
+
+    def __init__(self, prefix, text):
+        self.prefix = prefix
+        self.text = text
+
+    def read(self, size=-1):
+        prefix, self.prefix = self.prefix, ''
+        if size is None or size < 0:
+            return prefix + self.text.read()
+        return prefix + self.text.read(max(0, size - len(prefix)))
+
+    def __iter__(self):
+        first = self.prefix + self.text.readline()
+        self.prefix = ''
+        if first:
+            yield first
+        yield from self.text
+
+
+def parse_timestamp(value):
+    """ISO date/time (naive values are local time) or Unix time in seconds or milliseconds -> aware datetime."""
+    if value is None or str(value).strip() == '':
+        raise RowError("missing timestamp")
+    local_tz = tzlocal.get_localzone()
+    if isinstance(value, (int, float)) or str(value).strip().replace('.', '', 1).isdigit():
+        ts = float(value)
+        if ts > 1e11:
+            ts /= 1000
+        return datetime.fromtimestamp(ts, local_tz)
+    try:
+        dt = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise RowError(f"invalid timestamp {value!r}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=local_tz)
+    return dt
+
+
+def _number(row, field):
+    value = row.get(field)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RowError(f"{field} is not a number ({value!r})")
+
+
+def validate(row, unit='kg'):
+    """Returns the Garmin payload of a row (see sync_app.manual_payload) plus its datetime. Raises RowError."""
+    if not isinstance(row, dict):
+        raise RowError("not an object")
+    dt = parse_timestamp(row.get('timestamp', row.get('date')))
+    values = {field: _number(row, field) for field in VALUE_FIELDS}
+
+    row_unit = (row.get('unit') or unit or 'kg').strip().lower()
+    if row_unit in ('lb', 'lbs'):
+        row_unit = 'lbs'
+    elif row_unit != 'kg':
+        raise RowError(f"unknown unit {row_unit!r}")
+    values['weight'], values['muscle_mass'], values['bone_mass'] = sync_app.masses_to_kg(
+        row_unit, values['weight'], values['muscle_mass'], values['bone_mass'])
+
+    weight = values['weight']
+    if weight is None:
+        raise RowError("missing weight")
+    if not 1 <= weight <= 500:
+        raise RowError(f"weight out of range ({weight:.1f} kg)")
+    for field in ('fat_ratio', 'hydration'):
+        if values[field] is not None and not 0 < values[field] < 100:
+            raise RowError(f"{field} out of range ({values[field]})")
+    for field in ('muscle_mass', 'bone_mass'):
+        if values[field] is not None and not 0 < values[field] <= weight:
+            raise RowError(f"{field} out of range ({values[field]:.1f} kg)")
+    if values['bmi'] is not None and not 0 < values['bmi'] < 200:
+        raise RowError(f"bmi out of range ({values['bmi']})")
+
+    payload = sync_app.manual_payload(
+        weight, values['fat_ratio'], values['muscle_mass'], values['bone_mass'],
+        values['hydration'], values['bmi'], dt.isoformat()
+    )
+    return dt, payload
+
+
+class ImportStats:
+    def __init__(self):
+        self.rows = 0
+        self.uploaded = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.queued = 0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class GarminWeighIns:
+    """
+    Keys (see reconcile.weight_key) of the weigh-ins already in Garmin, read one
+    RECONCILE_CHUNK_DAYS window at a time. Only the windows used by the current batch
+    are kept, so sorted files of any length need a bounded number of reads and memory.
+    A row matches a weigh-in with the same weight up to reconcile.MATCH_SECONDS away,
+    also across window boundaries.
+    """
+
+    def __init__(self, garmin):
+        self.garmin = garmin
+        self.windows = {}
+        self.reads = 0
+        self.local_tz = tzlocal.get_localzone()
+
+    def _window(self, ts):
+        return datetime.fromtimestamp(ts, self.local_tz).date().toordinal() // max(1, config.RECONCILE_CHUNK_DAYS)
+
+    def _windows(self, ts):
+        return {self._window(ts - reconcile.MATCH_SECONDS), self._window(ts + reconcile.MATCH_SECONDS)}
+
+    def _load(self, window):
+        chunk = max(1, config.RECONCILE_CHUNK_DAYS)
+        # One extra day on each side: Garmin filters by its own calendar days
+        start = datetime.fromordinal(window * chunk) - timedelta(days=1)
+        end = datetime.fromordinal(window * chunk + chunk - 1) + timedelta(days=1)
+        existing = circuit_breaker.GARMIN.call(
+            self.garmin.get_body_composition, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+        self.reads += 1
+        keys = reconcile.KeySet()
+        for entry in (existing or {}).get('dateWeightList') or []:
+            key = reconcile.garmin_weight_key(entry)
+            if key:
+                keys.add(key)
+        return keys
+
+    def prepare(self, batch):
+        """Reads the windows the batch needs and drops the others."""
+        needed = set()
+        for dt, _ in batch:
+            needed |= self._windows(dt.timestamp())
+        self.windows = {window: self.windows.get(window) or self._load(window) for window in sorted(needed)}
+
+    def key(self, dt, payload):
+        return reconcile.weight_key(dt.timestamp(), payload['weight'])
+
+    def __contains__(self, key):
+        return any(key in self.windows.get(window, ()) for window in self._windows(key[0]))
+
+    def add(self, key):
+        self.windows.setdefault(self._window(key[0]), reconcile.KeySet()).add(key)
+
+
+def _batches(rows, stats, unit, size):
+    """Validated (datetime, payload) rows in lists of `size`; invalid rows are counted and logged."""
+    batch = []
+    for number, row in rows:
+        stats.rows += 1
+        try:
+            if isinstance(row, RowError):
+                raise row
+            batch.append(validate(row, unit))
+        except RowError as e:
+            stats.invalid += 1
+            if stats.invalid <= MAX_REPORTED_ROWS:
+                print(f"  Row {number} skipped: {e}")
+            continue
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_import(path, fmt=None, unit='kg', account=None, dry_run=False, progress_callback=None):
+    """
+    Imports a CSV / JSON file into Garmin. Returns the ImportStats as a dict.
+    progress_callback(current, total) receives the bytes of the file read so far.
+    """
+    settings = accounts.resolve(account)
+    if not settings['garmin_email'] or not settings['garmin_password']:
+        raise Exception("Garmin credentials not configured.")
+    fmt = fmt or detect_format(path)
+    total_bytes = os.path.getsize(path)
+    stats = ImportStats()
+
+    print(f"Importing {os.path.basename(path)} ({fmt.upper()}, {total_bytes} bytes, default unit {unit})...")
+    print("Connecting to Garmin...")
+    garmin = circuit_breaker.GARMIN.call(sync_app.login_garmin, settings)
+    existing = GarminWeighIns(garmin)
+    rate_limiter = accounts.get_rate_limiter(settings)
+
+    try:
+        with open(path, 'rb') as stream:
+            for batch in _batches(read_rows(stream, fmt), stats, unit, max(1, config.IMPORT_BATCH_SIZE)):
+                existing.prepare(batch)
+                for dt, payload in batch:
+                    key = existing.key(dt, payload)
+                    if key in existing:
+                        stats.duplicates += 1
+                        continue
+                    existing.add(key)
+                    if dry_run:
+                        stats.uploaded += 1
+                        continue
+
+                    # Bulk work: manual entries and daily syncs go first
+                    priority.GATE.wait_turn()
+                    rate_limiter.wait()
+                    try:
+                        circuit_breaker.GARMIN.call(garmin.add_body_composition, **payload)
+                        stats.uploaded += 1
+                    except Exception as e:
+                        outbox.enqueue(settings, outbox.KIND_WEIGHT, payload, type(e).__name__)
+                        stats.queued += 1
+                        if stats.queued <= MAX_REPORTED_ROWS:
+                            print(f"  Upload of {payload['timestamp']} queued for retry ({type(e).__name__}).")
+
+                print(f"  {stats.rows} row(s) read: {stats.uploaded} {'to upload' if dry_run else 'uploaded'}, "
+                      f"{stats.duplicates} already in Garmin, {stats.invalid} skipped, {stats.queued} queued.")
+                if progress_callback:
+                    progress_callback(stream.tell(), total_bytes)
+    except InvalidFileError as e:
+        print(f"\nImport Failed: {os.path.basename(path)} is not a valid {fmt.upper()} file: {e}. "
+              f"{stats.uploaded} measurement(s) {'would have been uploaded' if dry_run else 'uploaded'} before the error.")
+        return stats.to_dict()
+
+    if progress_callback:
+        progress_callback(total_bytes, total_bytes)
+    print(f"\nImport finished: {stats.uploaded} measurement(s) {'would be uploaded' if dry_run else 'uploaded'}, "
+          f"{stats.duplicates} already in Garmin, {stats.invalid} invalid row(s) skipped, "
+          f"{stats.queued} queued for retry ({existing.reads} Garmin range read(s)).")
+    return stats.to_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload a CSV or JSON file of body measurements to Garmin.')
+    parser.add_argument('file', help='CSV or JSON file (columns: timestamp, weight, fat_ratio, muscle_mass, bone_mass, hydration, bmi, unit)')
+    parser.add_argument('--format', choices=[FORMAT_CSV, FORMAT_JSON], default=None, help='File format (default: from the file extension)')
+    parser.add_argument('--unit', choices=['kg', 'lbs'], default='kg', help='Unit of rows without a unit column (default: kg)')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be uploaded')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    args = parser.parse_args()
+    run_import(args.file, fmt=args.format, unit=args.unit, account=args.account, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Checkpoints for long historical syncs.
+
+Every historical sync job records its range and, after each processed group, the
+timestamp / grpid of that group in sync_checkpoints. Groups are processed oldest first,
+so a job that was interrupted (restart, crash, Garmin outage) can be resumed right
+after the last processed group instead of starting over.
+
+Checkpoints have a kind: API historical syncs and export imports (see withings_export)
+share the table, but each only resumes its own jobs. They also record the instance running
+them, so an instance starting up only interrupts its own jobs, not those running on
+other instances sharing data/.
+"""
+import socket
+import sqlite3
+import time
+
+import accounts
+import config
+
+STATUS_RUNNING = 'running'
+STATUS_INTERRUPTED = 'interrupted'
+STATUS_COMPLETED = 'completed'
+
+KIND_HISTORICAL = 'historical'
+KIND_EXPORT = 'export'
+
+# Instance running a job: unlike job_leases.INSTANCE_ID (host name and process id) the
+# default survives a restart, so the restarted instance finds its own jobs
+OWNER = config.INSTANCE_ID or socket.gethostname()
+
+# A running job of another instance without progress for this long was cut off with it
+STALE_SECONDS = 6 * 3600
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS sync_checkpoints
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      account_id INTEGER NOT NULL,
+                      start_ts INTEGER NOT NULL,
+                      end_ts INTEGER NOT NULL,
+                      last_date INTEGER,
+                      last_grpid INTEGER,
+                      processed INTEGER NOT NULL DEFAULT 0,
+                      status TEXT NOT NULL,
+                      created_at INTEGER,
+                      updated_at INTEGER)''')
+        # Checkpoints written before kinds existed are all API historical syncs
+        c.execute("PRAGMA table_info(sync_checkpoints)")
+        columns = [row[1] for row in c.fetchall()]
+        if 'kind' not in columns:
+            c.execute(f"ALTER TABLE sync_checkpoints ADD COLUMN kind TEXT NOT NULL DEFAULT '{KIND_HISTORICAL}'")
+        if 'owner' not in columns:
+            c.execute("ALTER TABLE sync_checkpoints ADD COLUMN owner TEXT")
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+class Checkpoint:
+    """Progress record of one historical sync job."""
+
+    def __init__(self, checkpoint_id, account_id, start_ts, end_ts, last_date=None, last_grpid=None, processed=0):
+        self.id = checkpoint_id
+        self.account_id = account_id
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.last_date = last_date
+        self.last_grpid = last_grpid
+        self.processed = processed
+        self.finished = False
+
+    @property
+    def resume_from(self):
+        """First timestamp that still has to be synced."""
+        return self.last_date + 1 if self.last_date else self.start_ts
+
+    def advance(self, date, grpid=None):
+        """Records a group as processed."""
+        self.last_date = date
+        self.last_grpid = grpid
+        self.processed += 1
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE sync_checkpoints SET last_date=?, last_grpid=?, processed=?, updated_at=? WHERE id=?",
+                      (date, grpid, self.processed, int(time.time()), self.id))
+            conn.commit()
+
+    def finish(self, completed):
+        self.finished = True
+        _set_status(self.id, STATUS_COMPLETED if completed else STATUS_INTERRUPTED)
+
+
+def _set_status(checkpoint_id, status):
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE sync_checkpoints SET status=?, updated_at=? WHERE id=?",
+                  (status, int(time.time()), checkpoint_id))
+        conn.commit()
+
+
+def _from_row(row):
+    return Checkpoint(row['id'], row['account_id'], row['start_ts'], row['end_ts'],
+                      row['last_date'], row['last_grpid'], row['processed'])
+
+
+def start(account, start_ts, end_ts, kind=KIND_HISTORICAL):
+    """Creates the checkpoint of a new historical sync job (or export import, see KIND_EXPORT)."""
+    _ensure_db()
+    now = int(time.time())
+    key = accounts._account_key(account)
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO sync_checkpoints
+                     (account_id, start_ts, end_ts, processed, status, kind, owner, created_at, updated_at)
+                     VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?)''',
+                  (key, start_ts, end_ts, STATUS_RUNNING, kind, OWNER, now, now))
+        checkpoint_id = c.lastrowid
+        # Forget completed jobs after a month
+        c.execute("DELETE FROM sync_checkpoints WHERE status=? AND updated_at<?", (STATUS_COMPLETED, now - 30 * 86400))
+        conn.commit()
+        return Checkpoint(checkpoint_id, key, start_ts, end_ts)
+
+
+def latest_resumable(account=None, kind=KIND_HISTORICAL):
+    """Returns the newest interrupted job of the account and kind, or None."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute('''SELECT * FROM sync_checkpoints WHERE account_id=? AND status=? AND kind=?
+                     ORDER BY updated_at DESC, id DESC LIMIT 1''',
+                  (accounts._account_key(account), STATUS_INTERRUPTED, kind))
+        row = c.fetchone()
+        return dict(row) if row else None
+
+
+def resume(checkpoint_id):
+    """Marks an interrupted job as running again and returns its Checkpoint, or None."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM sync_checkpoints WHERE id=? AND status=?", (checkpoint_id, STATUS_INTERRUPTED))
+        row = c.fetchone()
+    if not row:
+        return None
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE sync_checkpoints SET status=?, owner=?, updated_at=? WHERE id=?",
+                  (STATUS_RUNNING, OWNER, int(time.time()), checkpoint_id))
+        conn.commit()
+    return _from_row(row)
+
+
+def interrupt_running():
+    """
+    Jobs of this instance still marked running were cut off by its restart; makes them
+    resumable. Called at startup. Running jobs of other instances are left alone unless
+    they made no progress for STALE_SECONDS (that instance is gone).
+    """
+    _ensure_db()
+    now = int(time.time())
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''UPDATE sync_checkpoints SET status=?, updated_at=?
+                     WHERE status=? AND (owner=? OR owner IS NULL OR updated_at<?)''',
+                  (STATUS_INTERRUPTED, now, STATUS_RUNNING, OWNER, now - STALE_SECONDS))
+        conn.commit()
+        return c.rowcount
@@ -0,0 +1,233 @@
+"""
+Circuit breakers for the Withings and Garmin APIs.
+
+After BREAKER_FAILURE_THRESHOLD consecutive failures a breaker opens and calls fail
+immediately with CircuitOpenError instead of waiting for timeouts. Only outages count
+(network errors, timeouts, 5xx responses, see is_outage): a wrong password or a rejected
+measurement of one account says nothing about the service and must not block the
+others. Once BREAKER_RESET_SECONDS have passed it is half-open: exactly one caller claims
+the trial call, closing the breaker on success or re-opening it on failure; the others
+are rejected until the trial is over (or has been running for BREAKER_RESET_SECONDS).
+
+The state is kept in garmin_import.db so scheduled runs, worker processes and the
+outbox drainer all see the same picture of an outage.
+"""
+import asyncio
+import socket
+import sqlite3
+import threading
+import time
+
+import aiohttp
+import requests
+from garminconnect import GarminConnectAuthenticationError, GarminConnectTooManyRequestsError
+
+import accounts
+import config
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Exception names of HTTP clients without a status (e.g. curl_cffi) that mean the service was not reached
+_NETWORK_ERROR_NAMES = frozenset(('ConnectionError', 'ConnectTimeout', 'ReadTimeout', 'Timeout', 'TimeoutError'))
+
+_db_ready = False
+# Serializes trial claims within the process (BEGIN IMMEDIATE does it across processes)
+_claim_lock = threading.Lock()
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS circuit_breakers
+                     (name TEXT PRIMARY KEY,
+                      state TEXT NOT NULL,
+                      failures INTEGER NOT NULL DEFAULT 0,
+                      opened_at INTEGER,
+                      updated_at INTEGER)''')
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, name, retry_at=None):
+        self.name = name
+        self.retry_at = retry_at
+        super().__init__(f"{name} circuit is open")
+
+
+def _status_code(exc):
+    status = getattr(exc, 'status', None) # aiohttp.ClientResponseError
+    if not isinstance(status, int):
+        status = getattr(getattr(exc, 'response', None), 'status_code', None) # requests / garth
+    return status if isinstance(status, int) else None
+
+
+def is_outage(exc):
+    """
+    Whether an exception (or one it was raised from) means the service is down or
+    unreachable: a network error, a timeout or a 5xx response. Authentication errors,
+    rate limits and other 4xx rejections are about the call, not the service.
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, (CircuitOpenError, GarminConnectAuthenticationError, GarminConnectTooManyRequestsError)):
+            return False
+        status = _status_code(exc)
+        if status is not None:
+            return status >= 500
+        if isinstance(exc, (requests.ConnectionError, requests.Timeout, aiohttp.ClientConnectionError,
+                            asyncio.TimeoutError, ConnectionError, TimeoutError, socket.gaierror)):
+            return True
+        if type(exc).__name__ in _NETWORK_ERROR_NAMES:
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+class CircuitBreaker:
+    def __init__(self, name, label=None, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self.label = label or name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def _threshold(self):
+        return self.failure_threshold or config.BREAKER_FAILURE_THRESHOLD
+
+    def _timeout(self):
+        return self.reset_timeout or config.BREAKER_RESET_SECONDS
+
+    def _load(self):
+        """(state, failures, opened_at, updated_at) as stored; HALF_OPEN means a trial call is running."""
+        _ensure_db()
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT state, failures, opened_at, updated_at FROM circuit_breakers WHERE name=?", (self.name,))
+            row = c.fetchone()
+        return row or (CLOSED, 0, None, None)
+
+    def _save(self, state, failures, opened_at):
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("INSERT OR REPLACE INTO circuit_breakers (name, state, failures, opened_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                      (self.name, state, failures, opened_at, int(time.time())))
+            conn.commit()
+
+    def _retry_at(self, state, opened_at, updated_at):
+        if state == OPEN and opened_at:
+            return opened_at + self._timeout()
+        if state == HALF_OPEN and updated_at:
+            # A trial that never reported back may be taken over then
+            return updated_at + self._timeout()
+        return None
+
+    def state(self):
+        state, _, opened_at, _ = self._load()
+        if state == OPEN and opened_at and time.time() >= opened_at + self._timeout():
+            return HALF_OPEN
+        return state
+
+    def retry_at(self):
+        """Time at which a blocked breaker lets the next trial call through (None if calls are not blocked)."""
+        state, _, opened_at, updated_at = self._load()
+        retry_at = self._retry_at(state, opened_at, updated_at)
+        return retry_at if retry_at and retry_at > time.time() else None
+
+    def allow(self):
+        """Whether a call could go through now (closed, or a trial call is due). Claims nothing."""
+        state, _, opened_at, updated_at = self._load()
+        return state == CLOSED or time.time() >= (self._retry_at(state, opened_at, updated_at) or 0)
+
+    def check(self):
+        """Raises CircuitOpenError if calls are currently blocked."""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_at())
+
+    def enter(self):
+        """
+        Admits one call. Returns True if it is the half-open trial call (claimed atomically,
+        other callers are rejected until it reports back), False for a regular call.
+        Raises CircuitOpenError if the call is blocked.
+        """
+        if self._load()[0] == CLOSED:
+            return False
+        now = int(time.time())
+        with _claim_lock, sqlite3.connect(accounts.DB_PATH, timeout=30) as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT state, opened_at, updated_at FROM circuit_breakers WHERE name=?", (self.name,))
+            row = c.fetchone()
+            if row is None or row[0] == CLOSED:
+                conn.rollback()
+                return False
+            retry_at = self._retry_at(*row)
+            if retry_at and now < retry_at:
+                conn.rollback()
+                raise CircuitOpenError(self.name, retry_at)
+            c.execute("UPDATE circuit_breakers SET state=?, updated_at=? WHERE name=?", (HALF_OPEN, now, self.name))
+            conn.commit()
+        return True
+
+    def release(self):
+        """Ends a trial call that neither reached nor missed the service (e.g. rejected credentials)."""
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            c = conn.cursor()
+            # opened_at is kept, so the next caller may try again right away
+            c.execute("UPDATE circuit_breakers SET state=? WHERE name=? AND state=?", (OPEN, self.name, HALF_OPEN))
+            conn.commit()
+
+    def record_success(self):
+        state, failures, _, _ = self._load()
+        if state != CLOSED or failures:
+            if state != CLOSED:
+                print(f"{self.label} is reachable again, circuit closed.")
+            self._save(CLOSED, 0, None)
+
+    def record_failure(self):
+        state, failures, _, _ = self._load()
+        failures += 1
+        # Calls only get through a blocked breaker as the trial: a failed trial re-opens it
+        if state != CLOSED or failures >= self._threshold():
+            print(f"{self.label} failed {failures} time(s) in a row, pausing calls for {self._timeout()}s (circuit open).")
+            self._save(OPEN, failures, int(time.time()))
+        else:
+            self._save(CLOSED, failures, None)
+
+    def call(self, func, *args, **kwargs):
+        """Calls func through the breaker. Only outages (see is_outage) count as failures."""
+        trial = self.enter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_outage(e):
+                self.record_failure()
+            elif trial:
+                self.release()
+            raise
+        self.record_success()
+        return result
+
+    def reset(self):
+        _ensure_db()
+        self._save(CLOSED, 0, None)
+
+    def status(self):
+        state, failures, _, _ = self._load()
+        return {"name": self.name, "state": self.state(), "failures": failures, "retry_at": self.retry_at()}
+
+
+WITHINGS = CircuitBreaker('withings', 'Withings')
+GARMIN = CircuitBreaker('garmin', 'Garmin')
+
+BREAKERS = {breaker.name: breaker for breaker in (WITHINGS, GARMIN)}
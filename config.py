@@ -35,3 +35,94 @@ if not WITHINGS_REDIRECT_URI:
 # Garmin Credentials
 GARMIN_EMAIL = get_credential('GARMIN_EMAIL', 'garmin_email')
 GARMIN_PASSWORD = get_credential('GARMIN_PASSWORD', 'garmin_password')
+
+# Multi-account sync tuning
+# Max number of account syncs running in parallel
+MAX_SYNC_WORKERS = int(os.getenv('MAX_SYNC_WORKERS', '4'))
+# Minimum seconds between two Garmin uploads of the same account
+GARMIN_MIN_INTERVAL = float(os.getenv('GARMIN_MIN_INTERVAL', '1'))
+
+# Sync execution mode: "thread" (inside the web process) or "process" (isolated worker processes)
+SYNC_EXECUTION_MODE = os.getenv('SYNC_EXECUTION_MODE', 'thread').lower()
+# Max number of sync worker processes alive at once, per priority lane (process mode only)
+SYNC_PROCESS_WORKERS = int(os.getenv('SYNC_PROCESS_WORKERS', '2'))
+
+# Sync pipeline tuning
+# Max items buffered between two pipeline stages
+PIPELINE_QUEUE_DEPTH = int(os.getenv('PIPELINE_QUEUE_DEPTH', '16'))
+# Size of the time windows a historical sync fetches from Withings
+PIPELINE_WINDOW_DAYS = int(os.getenv('PIPELINE_WINDOW_DAYS', '90'))
+# Withings groups measured within this many seconds of each other are merged into one
+# upload (e.g. weight and a later recomputed fat ratio); 0 = only identical timestamps
+MERGE_WINDOW_SECONDS = int(os.getenv('MERGE_WINDOW_SECONDS', '60'))
+# Days the cached height history is reused before it is fetched from Withings again
+HEIGHT_CACHE_TTL_DAYS = int(os.getenv('HEIGHT_CACHE_TTL_DAYS', '30'))
+# Minutes between "anything new?" probes that trigger a sync when Withings has new data (0 = off).
+# Initial value only; the interval can be changed from the web UI.
+PROBE_INTERVAL_MINUTES = int(os.getenv('PROBE_INTERVAL_MINUTES', '0'))
+
+# Withings push notifications
+# Seconds to wait for more notifications before syncing the merged window
+WITHINGS_NOTIFY_DEBOUNCE_SECONDS = int(os.getenv('WITHINGS_NOTIFY_DEBOUNCE_SECONDS', '60'))
+# Optional secret the webhook requires as ?secret=... (included in the subscribed callback URL)
+WITHINGS_NOTIFY_SECRET = os.getenv('WITHINGS_NOTIFY_SECRET', '')
+
+# Retry queue (outbox) for failed Garmin uploads
+# Minutes between two runs of the outbox drainer
+OUTBOX_DRAIN_INTERVAL_MINUTES = int(os.getenv('OUTBOX_DRAIN_INTERVAL_MINUTES', '5'))
+# Delay before the first retry in seconds; doubled after every failed attempt up to OUTBOX_MAX_DELAY
+OUTBOX_BASE_DELAY = int(os.getenv('OUTBOX_BASE_DELAY', '300'))
+OUTBOX_MAX_DELAY = int(os.getenv('OUTBOX_MAX_DELAY', '21600'))
+# Attempts after which an upload is given up (dead-lettered)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+
+# Circuit breakers for the Withings / Garmin APIs
+# Consecutive failures after which calls to a service are paused
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+# Seconds a paused service is left alone before a single trial call is allowed
+BREAKER_RESET_SECONDS = int(os.getenv('BREAKER_RESET_SECONDS', '600'))
+
+# Number of Withings time windows a sync plan (dry run) fetches in parallel
+PLAN_FETCH_CONCURRENCY = int(os.getenv('PLAN_FETCH_CONCURRENCY', '4'))
+
+# Per-day reconciliation between the local Withings copy and Garmin
+# Days checked by default / by the scheduled check
+RECONCILE_DAYS = int(os.getenv('RECONCILE_DAYS', '365'))
+# Days of Garmin data read per request
+RECONCILE_CHUNK_DAYS = int(os.getenv('RECONCILE_CHUNK_DAYS', '30'))
+# Hours between scheduled consistency checks of all accounts (0 = off)
+RECONCILE_INTERVAL_HOURS = int(os.getenv('RECONCILE_INTERVAL_HOURS', '0'))
+
+# Drip backfills (large imports spread over days)
+# Minutes between two backfill steps
+BACKFILL_TICK_MINUTES = int(os.getenv('BACKFILL_TICK_MINUTES', '10'))
+# Default Garmin upload calls a backfill may make per hour / per day
+BACKFILL_HOURLY_BUDGET = int(os.getenv('BACKFILL_HOURLY_BUDGET', '60'))
+BACKFILL_DAILY_BUDGET = int(os.getenv('BACKFILL_DAILY_BUDGET', '500'))
+
+# Bulk manual import (CSV / JSON files)
+# Rows validated and checked against Garmin per batch
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '200'))
+
+# Extra targets every synced measurement is written to besides Garmin (comma separated: csv, sqlite, http)
+SINKS = [name.strip().lower() for name in os.getenv('SINKS', '').split(',') if name.strip()]
+SINK_CSV_PATH = os.getenv('SINK_CSV_PATH', os.path.join('data', 'measurements.csv'))
+SINK_SQLITE_PATH = os.getenv('SINK_SQLITE_PATH', os.path.join('data', 'measurements.db'))
+# The http sink POSTs each measurement as JSON; the token is sent as "Authorization: Bearer ..."
+SINK_HTTP_URL = os.getenv('SINK_HTTP_URL', '')
+SINK_HTTP_TOKEN = os.getenv('SINK_HTTP_TOKEN', '')
+SINK_HTTP_TIMEOUT = float(os.getenv('SINK_HTTP_TIMEOUT', '10'))
+
+# Points per series returned by /api/trends (charts on the home page)
+TREND_POINTS = int(os.getenv('TREND_POINTS', '300'))
+
+# Minutes before each scheduled sync its sessions are prepared (Withings token, Garmin login,
+# height cache, Garmin blood pressure entries); 0 = off
+PREWARM_MINUTES = int(os.getenv('PREWARM_MINUTES', '3'))
+
+# Several instances sharing data/: name of this instance (default: hostname and process id)
+INSTANCE_ID = os.getenv('INSTANCE_ID', '')
+# Seconds a claimed scheduled run stays with an instance that stopped renewing it
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '120'))
+# Scheduled syncs missed while every instance was down are run once if at most this many minutes late
+SCHEDULE_MISFIRE_GRACE_MINUTES = int(os.getenv('SCHEDULE_MISFIRE_GRACE_MINUTES', '720'))
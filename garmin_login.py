@@ -0,0 +1,175 @@
+"""
+Garmin login sessions for the Credentials page.
+
+A login runs in a background thread; the request that starts it returns a session id
+right away. The page then long-polls the session for state changes (connecting ->
+mfa_required -> verifying -> connected / failed) and submits the MFA code without
+waiting for Garmin. Every attempt has its own session, so concurrent logins never see
+each other's state: a session logs in fresh into its own temporary token directory and
+moves the tokens into place only once the login succeeded. Sessions expire: an
+unanswered MFA prompt fails after MFA_TIMEOUT_SECONDS and sessions are forgotten (and
+cancelled if still running) SESSION_TTL_SECONDS after their last change.
+"""
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+
+from garminconnect import Garmin
+
+STATUS_CONNECTING = 'connecting'
+STATUS_MFA_REQUIRED = 'mfa_required'
+STATUS_VERIFYING = 'verifying'
+STATUS_CONNECTED = 'connected'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+FINISHED = (STATUS_CONNECTED, STATUS_FAILED, STATUS_CANCELLED)
+
+# Seconds the login waits for the MFA code
+MFA_TIMEOUT_SECONDS = 120
+# Seconds after its last change a session is forgotten
+SESSION_TTL_SECONDS = 600
+# Longest long-poll wait
+MAX_WAIT_SECONDS = 25
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class LoginError(Exception):
+    pass
+
+
+class LoginSession:
+    def __init__(self, email, password, token_dir, on_success=None):
+        self.id = secrets.token_urlsafe(16)
+        self.email = email
+        self.password = password
+        self.token_dir = token_dir
+        self.on_success = on_success
+        self.status = STATUS_CONNECTING
+        self.error = None
+        self.version = 0
+        self.updated_at = time.time()
+        self._mfa_code = None
+        self._cancelled = threading.Event()
+        self._cond = threading.Condition()
+
+    def _update(self, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.updated_at = time.time()
+            self._cond.notify_all()
+
+    def state(self):
+        with self._cond:
+            return {'session_id': self.id, 'status': self.status, 'error': self.error, 'version': self.version,
+                    'mfa_required': self.status == STATUS_MFA_REQUIRED}
+
+    def wait(self, since, timeout):
+        """Waits until the version moves past `since` (or the timeout); returns the state."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != since or self.status in FINISHED,
+                                timeout=min(max(0, timeout), MAX_WAIT_SECONDS))
+        return self.state()
+
+    def _prompt_mfa(self):
+        """Called by the Garmin client inside login(): waits for submit_mfa."""
+        self._update(status=STATUS_MFA_REQUIRED)
+        with self._cond:
+            self._cond.wait_for(lambda: self._mfa_code or self._cancelled.is_set(),
+                                timeout=MFA_TIMEOUT_SECONDS)
+            code, self._mfa_code = self._mfa_code, None
+            if self._cancelled.is_set():
+                raise LoginError("Login cancelled")
+        if not code:
+            raise LoginError("MFA timed out")
+        return code
+
+    def submit_mfa(self, code):
+        with self._cond:
+            if self.status != STATUS_MFA_REQUIRED:
+                raise LoginError("No verification code is expected for this login.")
+            self._mfa_code = code
+        self._update(status=STATUS_VERIFYING)
+
+    def cancel(self):
+        """Stops the login: an MFA prompt gives up at once and nothing is saved afterwards."""
+        self._cancelled.set()
+        if self.status not in FINISHED:
+            self._update(status=STATUS_CANCELLED, password=None)
+
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise LoginError("Login cancelled")
+
+    def _login(self, temp_dir):
+        """Credential login: the empty temp_dir has no tokens to load, and receives the new ones."""
+        garmin = Garmin(self.email, self.password, prompt_mfa=self._prompt_mfa)
+        garmin.login(tokenstore=temp_dir)
+
+    def _install_tokens(self, temp_dir):
+        """Moves the new tokens into token_dir; every file is replaced atomically."""
+        os.makedirs(self.token_dir, exist_ok=True)
+        names = set(os.listdir(temp_dir))
+        if not names:
+            raise LoginError("Garmin login did not return any tokens")
+        for name in names:
+            os.replace(os.path.join(temp_dir, name), os.path.join(self.token_dir, name))
+        # Files of an older token format would be loaded before the new ones
+        for name in os.listdir(self.token_dir):
+            path = os.path.join(self.token_dir, name)
+            if name not in names and os.path.isfile(path):
+                os.unlink(path)
+
+    def run(self):
+        parent = os.path.dirname(os.path.abspath(self.token_dir))
+        os.makedirs(parent, exist_ok=True)
+        # Next to token_dir, so the files can be renamed into place
+        temp_dir = tempfile.mkdtemp(prefix=f".garmin-login-{self.id[:8]}-", dir=parent)
+        try:
+            self._check_cancelled()
+            self._login(temp_dir)
+            self._check_cancelled()
+            self._install_tokens(temp_dir)
+            if self.on_success:
+                self.on_success(self.email, self.password)
+            self._update(status=STATUS_CONNECTED, password=None)
+        except Exception as e:
+            if not self._cancelled.is_set():
+                print(f"Garmin login failed. Error type: {type(e).__name__}")
+                self._update(status=STATUS_FAILED, error=str(e) or type(e).__name__, password=None)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _purge():
+    """Forgets sessions without a change for SESSION_TTL_SECONDS, cancelling abandoned ones."""
+    now = time.time()
+    with _sessions_lock:
+        expired = [session for session in _sessions.values() if now - session.updated_at > SESSION_TTL_SECONDS]
+        for session in expired:
+            del _sessions[session.id]
+    for session in expired:
+        session.cancel()
+
+
+def start(email, password, token_dir, on_success=None):
+    """Starts a login in the background. on_success(email, password) runs in the login thread."""
+    _purge()
+    session = LoginSession(email, password, token_dir, on_success)
+    with _sessions_lock:
+        _sessions[session.id] = session
+    threading.Thread(target=session.run, name=f"garmin-login-{session.id[:6]}", daemon=True).start()
+    return session
+
+
+def get(session_id):
+    _purge()
+    with _sessions_lock:
+        return _sessions.get(session_id)
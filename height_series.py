@@ -0,0 +1,113 @@
+"""
+Height history used for BMI.
+
+All height measurements of an account are fetched once (paginated), cached in
+garmin_import.db and kept as a sorted time series, so every weigh-in gets its BMI
+from the height in effect at that time. The cache is refreshed when it is older
+than HEIGHT_CACHE_TTL_DAYS or when a sync sees a new height measurement.
+"""
+import sqlite3
+import time
+from array import array
+from bisect import bisect_right
+
+import accounts
+import config
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS height_measurements
+                     (account_id INTEGER NOT NULL,
+                      date INTEGER NOT NULL,
+                      height REAL NOT NULL,
+                      PRIMARY KEY (account_id, date))''')
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        accounts._ensure_db()
+        init_db()
+        _db_ready = True
+
+
+class HeightSeries:
+    """Sorted (timestamp, height in m) points with bisect lookup."""
+
+    __slots__ = ('dates', 'heights')
+
+    def __init__(self, points=()):
+        points = sorted(points)
+        self.dates = array('q', (p[0] for p in points))
+        self.heights = array('d', (p[1] for p in points))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def at(self, ts):
+        """
+        Height in effect at `ts`: the latest measurement taken at or before it.
+        Weigh-ins older than the first measurement use the first known height.
+        """
+        if not self.dates:
+            return None
+        i = bisect_right(self.dates, ts) - 1
+        return self.heights[max(i, 0)]
+
+    def add(self, ts, height):
+        """Inserts a measurement in order. Returns False if it was already known."""
+        i = bisect_right(self.dates, ts)
+        if i and self.dates[i - 1] == ts and self.heights[i - 1] == height:
+            return False
+        self.dates.insert(i, ts)
+        self.heights.insert(i, height)
+        return True
+
+    def latest(self):
+        return self.heights[-1] if self.heights else None
+
+    def points(self):
+        return list(zip(self.dates, self.heights))
+
+
+def load_cached(account=None):
+    """Returns the cached series, or None if there is no cache or it has expired."""
+    _ensure_db()
+    fetched_at = accounts.get_cursor(account, 'height_fetched_at')
+    if fetched_at is None:
+        return None
+    if time.time() - float(fetched_at) > config.HEIGHT_CACHE_TTL_DAYS * 86400:
+        return None
+
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT date, height FROM height_measurements WHERE account_id=? ORDER BY date",
+                  (accounts._account_key(account),))
+        return HeightSeries(c.fetchall())
+
+
+def store(account, series):
+    _ensure_db()
+    key = accounts._account_key(account)
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM height_measurements WHERE account_id=?", (key,))
+        c.executemany("INSERT OR REPLACE INTO height_measurements (account_id, date, height) VALUES (?, ?, ?)",
+                      [(key, d, h) for d, h in series.points()])
+        conn.commit()
+    accounts.set_cursor(account, 'height_fetched_at', int(time.time()))
+
+
+def invalidate(account=None):
+    """Forces the next sync to re-fetch the height history."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM sync_cursors WHERE account_id=? AND name='height_fetched_at'",
+                  (accounts._account_key(account),))
+        conn.commit()
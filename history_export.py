@@ -0,0 +1,157 @@
+"""
+Export of the measurement history kept by the app.
+
+Streams the local measurement store (every Withings group seen by a sync or imported
+from an export archive) as CSV, NDJSON or Parquet: Withings grpid, timestamp, decoded
+values and the outcome of the Garmin upload. Rows are read from sqlite one page at a
+time and written out in chunks, so exporting years of data needs little memory.
+Parquet needs the optional pyarrow package.
+"""
+import argparse
+import csv
+import io
+import json
+import time
+from datetime import datetime, timezone
+
+import tzlocal
+
+import measurement_store
+from measurements import TYPE_FIELDS, VALUE_FIELDS, get_measure_value
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMAT_PARQUET = 'parquet'
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON, FORMAT_PARQUET)
+
+MIMETYPES = {
+    FORMAT_CSV: 'text/csv',
+    FORMAT_NDJSON: 'application/x-ndjson',
+    FORMAT_PARQUET: 'application/vnd.apache.parquet',
+}
+
+COLUMNS = ('grpid', 'timestamp', 'datetime', 'source') + VALUE_FIELDS + ('garmin_status', 'synced_at')
+
+# Rows per written chunk / Parquet row group
+CHUNK_ROWS = 1000
+
+
+def date_range(from_date=None, to_date=None):
+    """YYYY-MM-DD bounds (whole days, UTC like historical syncs) -> (start_ts, end_ts). Open ends cover everything."""
+    start = datetime.strptime(from_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) if from_date else None
+    end = datetime.strptime(to_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59, tzinfo=timezone.utc) \
+        if to_date else None
+    return (int(start.timestamp()) if start else 0,
+            int(end.timestamp()) if end else int(time.time()) + 86400)
+
+
+def rows(account=None, start_ts=0, end_ts=None):
+    """Yields the export rows (dicts with COLUMNS) of a range, oldest first."""
+    local_tz = tzlocal.get_localzone()
+    for stored in measurement_store.iter_rows(account, start_ts, end_ts or int(time.time()) + 86400):
+        row = dict.fromkeys(COLUMNS)
+        row['grpid'] = stored['grpid']
+        row['timestamp'] = stored['date']
+        row['datetime'] = datetime.fromtimestamp(stored['date'], local_tz).isoformat()
+        # Groups read from a Withings export archive have synthetic negative ids
+        row['source'] = 'export' if stored['grpid'] < 0 else 'withings'
+        for measure in json.loads(stored['measures']):
+            field = TYPE_FIELDS.get(measure['type'])
+            if field:
+                row[field] = round(get_measure_value(measure), max(0, -measure['unit']))
+        row['garmin_status'] = stored['garmin_status']
+        row['synced_at'] = stored['synced_at']
+        yield row
+
+
+def _chunks(iterable, size=CHUNK_ROWS):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_csv(export_rows):
+    """Yields the CSV text in chunks."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    for chunk in _chunks(export_rows):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(export_rows):
+    """Yields one JSON object per line, in chunks."""
+    for chunk in _chunks(export_rows):
+        yield ''.join(json.dumps(row) + '\n' for row in chunk)
+
+
+def write_parquet(export_rows, target):
+    """Writes the rows to a Parquet file (path or binary file object), one row group per chunk."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow).")
+
+    types = {'grpid': pa.int64(), 'timestamp': pa.int64(), 'datetime': pa.string(), 'source': pa.string(),
+             'garmin_status': pa.string(), 'synced_at': pa.int64()}
+    schema = pa.schema([(column, types.get(column, pa.float64())) for column in COLUMNS])
+    written = 0
+    with pq.ParquetWriter(target, schema) as writer:
+        for chunk in _chunks(export_rows):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            written += len(chunk)
+    return written
+
+
+def export_to_file(path, fmt, account=None, from_date=None, to_date=None):
+    """Writes an export file in chunks. Returns the number of rows written."""
+    start_ts, end_ts = date_range(from_date, to_date)
+    counted = _Counter(rows(account, start_ts, end_ts))
+    if fmt == FORMAT_PARQUET:
+        return write_parquet(counted, path)
+    stream = stream_csv if fmt == FORMAT_CSV else stream_ndjson
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        for chunk in stream(counted):
+            f.write(chunk)
+    return counted.count
+
+
+class _Counter:
+    """Passes an iterable through, counting its items."""
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.count += 1
+            yield item
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the synced measurement history.')
+    parser.add_argument('output', help='File to write')
+    parser.add_argument('--format', choices=FORMATS, default=None, help='Output format (default: from the file extension, else csv)')
+    parser.add_argument('--from-date', default=None, help='First day to export (YYYY-MM-DD)')
+    parser.add_argument('--to-date', default=None, help='Last day to export (YYYY-MM-DD)')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    args = parser.parse_args()
+
+    fmt = args.format or next((f for f in FORMATS if args.output.lower().endswith('.' + f)), FORMAT_CSV)
+    count = export_to_file(args.output, fmt, account=args.account, from_date=args.from_date, to_date=args.to_date)
+    print(f"Exported {count} measurement group(s) to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
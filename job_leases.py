@@ -0,0 +1,236 @@
+"""
+Coordination of scheduled jobs between server instances sharing data/.
+
+Every instance runs the same scheduler, so each scheduled run is claimed in the shared
+database first: the instance that claims an occurrence (job id + scheduled time) gets a
+lease on the job with a fencing token, one higher than the previous token of that job.
+The lease is renewed while the run lasts and expires JOB_LEASE_SECONDS after its holder
+stops renewing it (e.g. the container died), after which another instance may take the
+run over with a new token. Results are only recorded with the current token, so an
+instance that lost its lease cannot overwrite the run of the instance that took over.
+
+Occurrences missed while every instance was down are run once (only the latest, within
+SCHEDULE_MISFIRE_GRACE_MINUTES) by whichever instance notices first.
+"""
+import contextlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import tzlocal
+
+import accounts
+import config
+
+STATUS_RUNNING = 'running'
+STATUS_SUCCESS = 'success'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+
+# Occurrences up to this many seconds in the future count as due (clock skew between instances)
+CLOCK_SKEW_SECONDS = 60
+
+# Days of run history kept
+RUN_HISTORY_DAYS = 30
+
+INSTANCE_ID = config.INSTANCE_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS job_leases
+                     (job_id TEXT PRIMARY KEY,
+                      owner TEXT,
+                      token INTEGER NOT NULL,
+                      scheduled_for INTEGER,
+                      expires_at INTEGER NOT NULL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS job_runs
+                     (job_id TEXT NOT NULL,
+                      scheduled_for INTEGER NOT NULL,
+                      owner TEXT,
+                      token INTEGER NOT NULL,
+                      status TEXT NOT NULL,
+                      started_at INTEGER,
+                      finished_at INTEGER,
+                      PRIMARY KEY (job_id, scheduled_for))''')
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+def _connect():
+    return sqlite3.connect(accounts.DB_PATH, timeout=30)
+
+
+def last_occurrence(hour, minute, now=None):
+    """Epoch seconds of the latest daily hour:minute (local time) that is due at `now`."""
+    now = now or datetime.now(tzlocal.get_localzone())
+    occurrence = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if occurrence.timestamp() > now.timestamp() + CLOCK_SKEW_SECONDS:
+        occurrence = (occurrence - timedelta(days=1)).replace(hour=hour, minute=minute)
+    return int(occurrence.timestamp())
+
+
+class Lease:
+    """A claimed job (occurrence). valid() / renew() / finish() only succeed with the current token."""
+
+    def __init__(self, job_id, token, scheduled_for=None):
+        self.job_id = job_id
+        self.token = token
+        self.scheduled_for = scheduled_for
+
+    def renew(self):
+        _ensure_db()
+        with _connect() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE job_leases SET expires_at=? WHERE job_id=? AND token=?",
+                      (int(time.time()) + config.JOB_LEASE_SECONDS, self.job_id, self.token))
+            conn.commit()
+            return c.rowcount == 1
+
+    def valid(self):
+        _ensure_db()
+        with _connect() as conn:
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM job_leases WHERE job_id=? AND token=? AND expires_at>?",
+                      (self.job_id, self.token, int(time.time())))
+            return c.fetchone() is not None
+
+    def finish(self, status):
+        """Records the outcome and releases the lease. False if the lease was lost (nothing recorded)."""
+        _ensure_db()
+        now = int(time.time())
+        with _connect() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE job_leases SET expires_at=0 WHERE job_id=? AND token=?", (self.job_id, self.token))
+            released = c.rowcount == 1
+            if released and self.scheduled_for is not None:
+                c.execute('''UPDATE job_runs SET status=?, finished_at=?
+                             WHERE job_id=? AND scheduled_for=? AND token=?''',
+                          (status, now, self.job_id, self.scheduled_for, self.token))
+                c.execute("DELETE FROM job_runs WHERE job_id=? AND started_at<?",
+                          (self.job_id, now - RUN_HISTORY_DAYS * 86400))
+            conn.commit()
+        return released
+
+    @contextlib.contextmanager
+    def kept_alive(self):
+        """Renews the lease in the background while the block runs."""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(max(1, config.JOB_LEASE_SECONDS / 3)):
+                try:
+                    if not self.renew():
+                        print(f"Warning: Lost the lease on {self.job_id} to another instance.")
+                        return
+                except Exception as e:
+                    print(f"Warning: Could not renew the lease on {self.job_id}. Error type: {type(e).__name__}")
+
+        thread = threading.Thread(target=renew, name=f"lease-{self.job_id}", daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _take(c, job_id, scheduled_for, now):
+    """Takes the job's lease unless it is held (by any instance, this one included). Call inside a write transaction."""
+    c.execute("SELECT token, expires_at FROM job_leases WHERE job_id=?", (job_id,))
+    row = c.fetchone()
+    if row and row[1] > now:
+        return None
+    token = (row[0] if row else 0) + 1
+    c.execute('''INSERT INTO job_leases (job_id, owner, token, scheduled_for, expires_at) VALUES (?, ?, ?, ?, ?)
+                 ON CONFLICT(job_id) DO UPDATE SET owner=excluded.owner, token=excluded.token,
+                 scheduled_for=excluded.scheduled_for, expires_at=excluded.expires_at''',
+              (job_id, INSTANCE_ID, token, scheduled_for, now + config.JOB_LEASE_SECONDS))
+    return token
+
+
+def claim_run(job_id, scheduled_for):
+    """
+    Claims one occurrence of a scheduled job. Returns a Lease, or None if the occurrence
+    already ran or is running (a run whose lease expired is taken over).
+    """
+    _ensure_db()
+    now = int(time.time())
+    with _connect() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT status FROM job_runs WHERE job_id=? AND scheduled_for=?", (job_id, scheduled_for))
+        run = c.fetchone()
+        if run and run[0] != STATUS_RUNNING:
+            conn.rollback()
+            return None
+        token = _take(c, job_id, scheduled_for, now)
+        if token is None:
+            conn.rollback()
+            return None
+        c.execute('''INSERT OR REPLACE INTO job_runs (job_id, scheduled_for, owner, token, status, started_at)
+                     VALUES (?, ?, ?, ?, ?, ?)''', (job_id, scheduled_for, INSTANCE_ID, token, STATUS_RUNNING, now))
+        conn.commit()
+    if run:
+        print(f"Taking over {job_id} from an instance that stopped responding.")
+    return Lease(job_id, token, scheduled_for)
+
+
+def acquire(job_id):
+    """Lease on a recurring job without occurrences (interval jobs), or None if another instance runs it."""
+    _ensure_db()
+    with _connect() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        token = _take(c, job_id, None, int(time.time()))
+        conn.commit()
+    return Lease(job_id, token) if token is not None else None
+
+
+@contextlib.contextmanager
+def exclusive(job_id):
+    """Yields a kept-alive Lease, or None if another instance is running the job right now."""
+    lease = acquire(job_id)
+    if lease is None:
+        yield None
+        return
+    try:
+        with lease.kept_alive():
+            yield lease
+    finally:
+        lease.finish(STATUS_SUCCESS)
+
+
+def missed(job_id, scheduled_for):
+    """
+    Whether an occurrence was missed: nothing claimed it, although the job ran before
+    (so new schedules do not run right away for a time that passed before they existed).
+    """
+    _ensure_db()
+    with _connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT MAX(scheduled_for) FROM job_runs WHERE job_id=?", (job_id,))
+        latest = c.fetchone()[0]
+        return latest is not None and latest < scheduled_for
+
+
+def recent_runs(limit=50):
+    _ensure_db()
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute('''SELECT job_id, scheduled_for, owner, token, status, started_at, finished_at
+                     FROM job_runs ORDER BY started_at DESC LIMIT ?''', (limit,))
+        return [dict(row) for row in c.fetchall()]
@@ -0,0 +1,195 @@
+"""
+Local copy of the Withings measure groups seen by syncs.
+
+Every group with body-composition or blood pressure values that passes through the
+sync pipeline is kept in withings_groups (raw measures plus the few decoded values
+reconciliation compares), so consistency checks against Garmin can read a whole range
+locally instead of fetching it from Withings again. The outcome of each group's Garmin
+upload is recorded next to it for the history export.
+"""
+import json
+import sqlite3
+import time
+
+import accounts
+import config
+from measurements import WEIGHT_FIELDS
+
+# Garmin status of a stored group
+STATUS_SYNCED = 'synced'
+STATUS_DUPLICATE = 'duplicate' # Blood pressure reading already on Garmin
+STATUS_QUEUED = 'queued'       # Upload failed, waiting in the retry queue
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS withings_groups
+                     (account_id INTEGER NOT NULL,
+                      grpid INTEGER NOT NULL,
+                      date INTEGER NOT NULL,
+                      weight REAL,
+                      systolic INTEGER,
+                      diastolic INTEGER,
+                      heart_rate INTEGER,
+                      measures TEXT NOT NULL,
+                      PRIMARY KEY (account_id, grpid))''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_withings_groups_date ON withings_groups (account_id, date)")
+
+        # Outcome of the Garmin upload (STATUS_*) and when it happened
+        c.execute("PRAGMA table_info(withings_groups)")
+        columns = [row[1] for row in c.fetchall()]
+        if 'garmin_status' not in columns:
+            c.execute("ALTER TABLE withings_groups ADD COLUMN garmin_status TEXT")
+        if 'synced_at' not in columns:
+            c.execute("ALTER TABLE withings_groups ADD COLUMN synced_at INTEGER")
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+def _value(column, i, cast=float):
+    val = column[i]
+    return cast(val) if val == val else None # NaN = missing
+
+
+def save_page(account, groups, batch):
+    """Stores the body-composition / blood pressure groups of a decoded page (batch = decode_page(groups))."""
+    _ensure_db()
+    key = accounts._account_key(account)
+    columns = batch.columns
+    rows = [
+        (key, batch.grpids[i], batch.dates[i],
+         _value(columns['weight'], i), _value(columns['systolic'], i, int),
+         _value(columns['diastolic'], i, int), _value(columns['heart_rate'], i, int),
+         json.dumps(groups[i]['measures']))
+        for i in range(len(batch))
+        if batch.grpids[i] and (batch.has_any(i, WEIGHT_FIELDS) or batch.has_bp(i))
+    ]
+    if not rows:
+        return 0
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        # Upserts keep the Garmin status of groups seen before
+        c.executemany('''INSERT INTO withings_groups
+                         (account_id, grpid, date, weight, systolic, diastolic, heart_rate, measures)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (account_id, grpid) DO UPDATE SET
+                         date=excluded.date, weight=excluded.weight, systolic=excluded.systolic,
+                         diastolic=excluded.diastolic, heart_rate=excluded.heart_rate, measures=excluded.measures''', rows)
+        conn.commit()
+    return len(rows)
+
+
+def values(account, start_ts, end_ts):
+    """Returns [(grpid, date, weight, systolic, diastolic, heart_rate)] of a range, oldest first."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''SELECT grpid, date, weight, systolic, diastolic, heart_rate FROM withings_groups
+                     WHERE account_id=? AND date BETWEEN ? AND ? ORDER BY date''',
+                  (accounts._account_key(account), start_ts, end_ts))
+        return c.fetchall()
+
+
+def load_groups(account, grpids):
+    """Returns the stored groups in Withings' measuregrps format, oldest first."""
+    _ensure_db()
+    grpids = list(grpids)
+    groups = []
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        # Stay below sqlite's bound parameter limit
+        for i in range(0, len(grpids), 500):
+            chunk = grpids[i:i + 500]
+            c.execute(f'''SELECT grpid, date, measures FROM withings_groups
+                          WHERE account_id=? AND grpid IN ({",".join("?" * len(chunk))})''',
+                      (accounts._account_key(account), *chunk))
+            groups.extend({'grpid': grpid, 'date': date, 'category': 1, 'measures': json.loads(measures)}
+                          for grpid, date, measures in c.fetchall())
+    groups.sort(key=lambda g: g['date'])
+    return groups
+
+
+def iter_pages(account, start_ts, end_ts, page_size=500, exported_only=False):
+    """
+    Yields the stored groups of a range in Withings' measuregrps format, oldest first, one
+    page at a time. exported_only limits it to groups read from a Withings export archive.
+    """
+    _ensure_db()
+    key = accounts._account_key(account)
+    # Keyset pagination on (date, grpid); export groups have negative ids
+    last = (start_ts, -2 ** 63)
+    while True:
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute(f'''SELECT grpid, date, measures FROM withings_groups
+                          WHERE account_id=? AND (date, grpid) > (?, ?) AND date <= ?
+                          {"AND grpid < 0" if exported_only else ""}
+                          ORDER BY date, grpid LIMIT ?''',
+                      (key, last[0], last[1], end_ts, page_size))
+            rows = c.fetchall()
+        if not rows:
+            return
+        yield [{'grpid': grpid, 'date': date, 'category': 1, 'measures': json.loads(measures)}
+               for grpid, date, measures in rows]
+        last = (rows[-1][1], rows[-1][0])
+
+
+def iter_rows(account, start_ts, end_ts, page_size=500):
+    """Yields every stored row of a range as a dict, oldest first, reading one page at a time."""
+    _ensure_db()
+    key = accounts._account_key(account)
+    last = (start_ts, -2 ** 63)
+    while True:
+        with sqlite3.connect(accounts.DB_PATH) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            c.execute('''SELECT * FROM withings_groups
+                         WHERE account_id=? AND (date, grpid) > (?, ?) AND date <= ?
+                         ORDER BY date, grpid LIMIT ?''',
+                      (key, last[0], last[1], end_ts, page_size))
+            rows = c.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict(row)
+        last = (rows[-1]['date'], rows[-1]['grpid'])
+
+
+def mark_status(account, start_ts, end_ts, status):
+    """Records the Garmin outcome of the groups measured in [start_ts, end_ts] (one merged upload)."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE withings_groups SET garmin_status=?, synced_at=? WHERE account_id=? AND date BETWEEN ? AND ?",
+                  (status, int(time.time()), accounts._account_key(account), start_ts, end_ts))
+        conn.commit()
+
+
+def mark_retried(account, ts):
+    """A queued upload of the record measured at `ts` went through on retry."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''UPDATE withings_groups SET garmin_status=?, synced_at=?
+                     WHERE account_id=? AND date BETWEEN ? AND ? AND garmin_status=?''',
+                  (STATUS_SYNCED, int(time.time()), accounts._account_key(account),
+                   ts, ts + config.MERGE_WINDOW_SECONDS, STATUS_QUEUED))
+        conn.commit()
+
+
+def count(account=None):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), MIN(date), MAX(date) FROM withings_groups WHERE account_id=?",
+                  (accounts._account_key(account),))
+        return c.fetchone()
@@ -0,0 +1,208 @@
+"""
+Decoding of Withings measure groups.
+
+Withings encodes every measure as an integer `value` plus a power-of-ten `unit`
+(real value = value * 10^unit). Type codes are mapped to record fields through a
+dispatch table and the powers of ten come from a precomputed table, so decoding a
+group is a couple of dict lookups per measure instead of an if/elif chain and a pow.
+"""
+import math
+from array import array
+
+# Withings measure type -> MeasurementGroup field
+TYPE_FIELDS = {
+    1: 'weight',        # Weight (kg)
+    4: 'height',        # Height (m)
+    6: 'fat_ratio',     # Fat Ratio (%)
+    9: 'diastolic',     # Diastolic (mmHg)
+    10: 'systolic',     # Systolic (mmHg)
+    11: 'heart_rate',   # Heart Rate (bpm)
+    12: 'visceral_fat', # Visceral Fat
+    76: 'muscle_mass',  # Muscle Mass (kg)
+    77: 'hydration',    # Hydration (kg)
+    88: 'bone_mass',    # Bone Mass (kg)
+}
+
+WEIGHT_FIELDS = ('weight', 'fat_ratio', 'muscle_mass', 'hydration', 'bone_mass', 'visceral_fat')
+BP_FIELDS = ('systolic', 'diastolic', 'heart_rate')
+VALUE_FIELDS = WEIGHT_FIELDS + BP_FIELDS + ('height',)
+
+# Fields reported as whole numbers
+INT_FIELDS = frozenset(BP_FIELDS)
+
+# 10 ** unit for every unit Withings uses in practice
+POW10 = {unit: 10 ** unit for unit in range(-12, 13)}
+
+
+def get_measure_value(measure):
+    """
+    Helper to calculate the real value from value and unit.
+    value * 10^unit
+    """
+    unit = measure['unit']
+    scale = POW10.get(unit)
+    if scale is None:
+        scale = 10 ** unit
+    return measure['value'] * scale
+
+
+class MeasurementGroup:
+    """One decoded Withings measure group. Missing values are None."""
+
+    __slots__ = ('grpid', 'date') + VALUE_FIELDS
+
+    def __init__(self, grpid=None, date=None, **values):
+        self.grpid = grpid
+        self.date = date
+        for field in VALUE_FIELDS:
+            setattr(self, field, values.get(field))
+
+    @property
+    def has_weight(self):
+        return bool(self.weight)
+
+    @property
+    def has_bp(self):
+        return bool(self.systolic and self.diastolic)
+
+    def copy(self, clear=()):
+        """Returns a copy, optionally with some fields cleared (e.g. clear=BP_FIELDS)."""
+        other = MeasurementGroup(self.grpid, self.date)
+        for field in VALUE_FIELDS:
+            setattr(other, field, None if field in clear else getattr(self, field))
+        return other
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        values = ", ".join(f"{f}={getattr(self, f)}" for f in VALUE_FIELDS if getattr(self, f) is not None)
+        return f"MeasurementGroup(grpid={self.grpid}, date={self.date}, {values})"
+
+
+def decode_group(group):
+    """Decodes a single Withings measure group into a MeasurementGroup."""
+    record = MeasurementGroup(group.get('grpid'), group['date'])
+    for measure in group['measures']:
+        field = TYPE_FIELDS.get(measure['type'])
+        if field is None:
+            continue
+        val = get_measure_value(measure)
+        setattr(record, field, int(val) if field in INT_FIELDS else val)
+    return record
+
+
+class MeasurementBatch:
+    """
+    Columnar form of a page of measure groups: one array per field, row i is group i.
+    Missing values are NaN. Rows are only materialized as MeasurementGroup on demand.
+    """
+
+    __slots__ = ('grpids', 'dates', 'columns')
+
+    def __init__(self, size=0):
+        self.grpids = array('q', [0]) * size
+        self.dates = array('q', [0]) * size
+        missing = array('d', [math.nan]) * size
+        self.columns = {field: array('d', missing) for field in VALUE_FIELDS}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def has_weight(self, i):
+        weight = self.columns['weight'][i]
+        return weight == weight and weight != 0 # NaN != NaN
+
+    def has_bp(self, i):
+        systolic = self.columns['systolic'][i]
+        diastolic = self.columns['diastolic'][i]
+        return systolic == systolic and diastolic == diastolic and int(systolic) != 0 and int(diastolic) != 0
+
+    def has_any(self, i, fields):
+        columns = self.columns
+        return any(columns[field][i] == columns[field][i] for field in fields)
+
+    def row(self, i):
+        record = MeasurementGroup(self.grpids[i] or None, self.dates[i])
+        for field, column in self.columns.items():
+            val = column[i]
+            if val == val:
+                setattr(record, field, int(val) if field in INT_FIELDS else val)
+        return record
+
+    def rows(self, predicate=None):
+        for i in range(len(self)):
+            if predicate is None or predicate(i):
+                yield self.row(i)
+
+
+def decode_page(measuregrps):
+    """Decodes a page of Withings `measuregrps` into a MeasurementBatch in one pass."""
+    batch = MeasurementBatch(len(measuregrps))
+    grpids, dates, columns = batch.grpids, batch.dates, batch.columns
+    type_fields, pow10 = TYPE_FIELDS, POW10
+
+    for i, group in enumerate(measuregrps):
+        grpids[i] = group.get('grpid') or 0
+        dates[i] = group['date']
+        for measure in group['measures']:
+            field = type_fields.get(measure['type'])
+            if field is None:
+                continue
+            unit = measure['unit']
+            scale = pow10.get(unit)
+            columns[field][i] = measure['value'] * (scale if scale is not None else 10 ** unit)
+    return batch
+
+
+def merge_groups(parts):
+    """
+    Merges the groups of one weigh-in into a single record. Conflict policy:
+    timestamp and grpid of the earliest group; each body-composition field from the
+    latest group that has it (recomputed values win); the blood pressure reading
+    (systolic, diastolic and pulse together) from the latest group that has one.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    parts = sorted(parts, key=lambda r: (r.date, r.grpid or 0))
+    merged = MeasurementGroup(parts[0].grpid, parts[0].date)
+    bp_part = None
+    for part in parts:
+        for field in WEIGHT_FIELDS + ('height', 'heart_rate'):
+            val = getattr(part, field)
+            if val is not None:
+                setattr(merged, field, val)
+        if part.has_bp:
+            bp_part = part
+    if bp_part is not None:
+        for field in BP_FIELDS:
+            setattr(merged, field, getattr(bp_part, field))
+    return merged
+
+
+class GroupCoalescer:
+    """
+    Collects records (fed oldest first) measured within `window` seconds of the first
+    one and merges them with merge_groups. add() / flush() return (merged, parts) once a
+    window is complete; parts are the source records, oldest first.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._parts = []
+
+    def __len__(self):
+        return len(self._parts)
+
+    def add(self, record):
+        done = None
+        if self._parts and record.date - self._parts[0].date > self.window:
+            done = self.flush()
+        self._parts.append(record)
+        return done
+
+    def flush(self):
+        parts, self._parts = self._parts, []
+        if not parts:
+            return None
+        return merge_groups(parts), parts
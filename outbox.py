@@ -0,0 +1,295 @@
+"""
+Durable outbox for Garmin uploads.
+
+Uploads that fail (Garmin outage, expired session, rate limiting, ...) are stored in the
+garmin_outbox table with their full payload instead of being dropped. A background
+drainer retries due entries with exponential backoff; entries that keep failing for
+OUTBOX_MAX_ATTEMPTS attempts are moved to the 'dead' state for manual inspection.
+Only upload attempts count: while the Garmin login fails (or the circuit is open) the
+entries stay due. A failed attempt may still have reached Garmin (e.g. a timeout after
+the upload went through), so every retry first checks whether Garmin has the measurement.
+"""
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+import accounts
+import circuit_breaker
+import config
+import measurement_store
+import reconcile
+import sync_app
+
+KIND_WEIGHT = 'weight'
+KIND_BP = 'bp'
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_DEAD = 'dead'
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS garmin_outbox
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      account_id INTEGER NOT NULL,
+                      kind TEXT NOT NULL,
+                      payload TEXT NOT NULL,
+                      status TEXT NOT NULL,
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      next_attempt_at INTEGER,
+                      last_error TEXT,
+                      created_at INTEGER,
+                      updated_at INTEGER)''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_garmin_outbox_due ON garmin_outbox (status, next_attempt_at)")
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+def backoff_delay(attempts):
+    """Seconds to wait before the next attempt after `attempts` failed attempts."""
+    delay = config.OUTBOX_BASE_DELAY * (2 ** max(attempts - 1, 0))
+    return min(delay, config.OUTBOX_MAX_DELAY)
+
+
+def enqueue(account, kind, payload, error=None):
+    """
+    Stores a failed upload for retry. The failed attempt counts as the first one.
+    An identical pending entry is not queued twice.
+    """
+    _ensure_db()
+    key = accounts._account_key(account)
+    payload_json = json.dumps(payload, sort_keys=True)
+    now = int(time.time())
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM garmin_outbox WHERE account_id=? AND kind=? AND payload=? AND status=?",
+                  (key, kind, payload_json, STATUS_PENDING))
+        row = c.fetchone()
+        if row:
+            return row[0]
+        c.execute('''INSERT INTO garmin_outbox
+                     (account_id, kind, payload, status, attempts, next_attempt_at, last_error, created_at, updated_at)
+                     VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)''',
+                  (key, kind, payload_json, STATUS_PENDING, now + backoff_delay(1), error, now, now))
+        conn.commit()
+        return c.lastrowid
+
+
+def discard_pending(account, kind, payload):
+    """Drops a pending entry whose upload has since succeeded (e.g. the range was synced again)."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM garmin_outbox WHERE account_id=? AND kind=? AND payload=? AND status=?",
+                  (accounts._account_key(account), kind, json.dumps(payload, sort_keys=True), STATUS_PENDING))
+        conn.commit()
+
+
+def _row_to_entry(row):
+    entry = dict(row)
+    entry['payload'] = json.loads(entry['payload'])
+    return entry
+
+
+def due_entries(limit=None):
+    _ensure_db()
+    query = "SELECT * FROM garmin_outbox WHERE status=? AND next_attempt_at<=? ORDER BY next_attempt_at, id"
+    params = [STATUS_PENDING, int(time.time())]
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(query, params)
+        return [_row_to_entry(row) for row in c.fetchall()]
+
+
+def list_entries(status=None, limit=100):
+    _ensure_db()
+    query = "SELECT * FROM garmin_outbox"
+    params = []
+    if status:
+        query += " WHERE status=?"
+        params.append(status)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(query, params)
+        return [_row_to_entry(row) for row in c.fetchall()]
+
+
+def counts():
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT status, COUNT(*) FROM garmin_outbox GROUP BY status")
+        result = {STATUS_PENDING: 0, STATUS_DONE: 0, STATUS_DEAD: 0}
+        result.update(dict(c.fetchall()))
+        return result
+
+
+def mark_done(entry_id):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE garmin_outbox SET status=?, last_error=NULL, updated_at=? WHERE id=?",
+                  (STATUS_DONE, int(time.time()), entry_id))
+        conn.commit()
+
+
+def _mark_retried(account_id, payload):
+    """Updates the Garmin status of the stored Withings groups behind a retried upload."""
+    try:
+        ts = int(datetime.fromisoformat(payload['timestamp']).timestamp())
+        measurement_store.mark_retried(account_id, ts)
+    except Exception:
+        pass # Manual entries have no stored group; the status is informational only
+
+
+def mark_failed(entry_id, error):
+    """Records a failed attempt: schedules the next one, or dead-letters the entry."""
+    _ensure_db()
+    now = int(time.time())
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT attempts FROM garmin_outbox WHERE id=?", (entry_id,))
+        row = c.fetchone()
+        if not row:
+            return
+        attempts = row[0] + 1
+        if attempts >= config.OUTBOX_MAX_ATTEMPTS:
+            c.execute("UPDATE garmin_outbox SET status=?, attempts=?, next_attempt_at=NULL, last_error=?, updated_at=? WHERE id=?",
+                      (STATUS_DEAD, attempts, error, now, entry_id))
+        else:
+            c.execute("UPDATE garmin_outbox SET attempts=?, next_attempt_at=?, last_error=?, updated_at=? WHERE id=?",
+                      (attempts, now + backoff_delay(attempts), error, now, entry_id))
+        conn.commit()
+
+
+def retry(entry_id):
+    """Puts a (dead) entry back in the queue for an immediate attempt."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE garmin_outbox SET status=?, attempts=0, next_attempt_at=?, updated_at=? WHERE id=? AND status!=?",
+                  (STATUS_PENDING, int(time.time()), int(time.time()), entry_id, STATUS_DONE))
+        conn.commit()
+        return c.rowcount > 0
+
+
+def delete(entry_id):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM garmin_outbox WHERE id=?", (entry_id,))
+        conn.commit()
+        return c.rowcount > 0
+
+
+def purge_done(older_than_days=7):
+    _ensure_db()
+    cutoff = int(time.time()) - older_than_days * 86400
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM garmin_outbox WHERE status=? AND updated_at<?", (STATUS_DONE, cutoff))
+        conn.commit()
+
+
+def on_garmin(garmin_client, kind, payload):
+    """Whether Garmin already has the measurement of an outbox payload."""
+    dt = datetime.fromisoformat(payload['timestamp'])
+    if dt.tzinfo is None:
+        dt = dt.astimezone()
+    # One extra day on each side: Garmin filters by its own calendar days
+    start = (dt - timedelta(days=1)).strftime('%Y-%m-%d')
+    end = (dt + timedelta(days=1)).strftime('%Y-%m-%d')
+    if kind == KIND_BP:
+        existing = garmin_client.get_blood_pressure(start, end) or {}
+        measurements = [metric for summary in existing.get('measurementSummaries') or []
+                        for metric in summary.get('measurements', [])]
+        return sync_app.is_duplicate_bp(dt.astimezone(timezone.utc), payload['systolic'], payload['diastolic'],
+                                        payload.get('pulse'), measurements)
+    existing = garmin_client.get_body_composition(start, end) or {}
+    keys = reconcile.KeySet(filter(None, map(reconcile.garmin_weight_key, existing.get('dateWeightList') or [])))
+    return reconcile.weight_key(dt.timestamp(), payload['weight']) in keys
+
+
+def send(garmin_client, kind, payload):
+    """
+    Performs one Garmin upload from an outbox payload. Returns False without uploading if
+    Garmin already has the measurement.
+    """
+    if kind not in (KIND_WEIGHT, KIND_BP):
+        raise ValueError(f"Unknown outbox entry kind: {kind}")
+    if on_garmin(garmin_client, kind, payload):
+        return False
+    if kind == KIND_WEIGHT:
+        garmin_client.add_body_composition(**payload)
+    else:
+        garmin_client.set_blood_pressure(**payload)
+    return True
+
+
+def drain(is_busy=None, limit=None):
+    """
+    Retries all due entries, logging in to Garmin once per account.
+    Accounts for which is_busy(account_id) is true are left for the next run.
+    Returns (sent, failed).
+    """
+    by_account = {}
+    for entry in due_entries(limit):
+        by_account.setdefault(entry['account_id'], []).append(entry)
+
+    sent = failed = 0
+    for key, entries in by_account.items():
+        account_id = key or None
+        if is_busy and is_busy(account_id):
+            continue
+        if not circuit_breaker.GARMIN.allow():
+            print("Garmin is still unavailable (circuit open), leaving queued uploads for later.")
+            break
+
+        print(f"Retrying {len(entries)} queued Garmin upload(s)...")
+        try:
+            garmin = circuit_breaker.GARMIN.call(sync_app.login_garmin, account_id)
+        except Exception as e:
+            # Nothing was attempted: the entries stay due, like with an open circuit
+            print(f"  Garmin login failed, leaving the queued uploads for later. Error type: {type(e).__name__}")
+            continue
+
+        rate_limiter = accounts.get_rate_limiter(account_id)
+        for entry in entries:
+            rate_limiter.wait()
+            try:
+                uploaded = circuit_breaker.GARMIN.call(send, garmin, entry['kind'], entry['payload'])
+                mark_done(entry['id'])
+                _mark_retried(account_id, entry['payload'])
+                sent += 1
+                if uploaded:
+                    print(f"  Uploaded queued {entry['kind']} from {entry['payload'].get('timestamp')}.")
+                else:
+                    print(f"  Queued {entry['kind']} from {entry['payload'].get('timestamp')} is already on Garmin.")
+            except circuit_breaker.CircuitOpenError:
+                # Not an attempt: the entries stay due for the next drain
+                break
+            except Exception as e:
+                mark_failed(entry['id'], type(e).__name__)
+                failed += 1
+                print(f"  Retry failed for {entry['kind']} from {entry['payload'].get('timestamp')}. Error type: {type(e).__name__}")
+
+    purge_done()
+    return sent, failed
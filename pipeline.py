@@ -0,0 +1,595 @@
+"""
+Streaming sync pipeline shared by the daily and the historical sync:
+
+    fetch page -> decode -> merge -> dedup -> upload (Garmin and the other sinks)
+
+Each stage is a coroutine and the stages are connected by bounded asyncio queues.
+Uploads start as soon as the first page arrives, and memory is bounded by the queue
+depth rather than by the size of the history being synced.
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import tzlocal
+
+import accounts
+import circuit_breaker
+import config
+import height_series
+import measurement_store
+import outbox
+import priority
+import sinks
+import sync_app
+import sync_engine
+from measurements import BP_FIELDS, WEIGHT_FIELDS, GroupCoalescer, decode_page
+
+_END = object()
+
+
+class FetchError(Exception):
+    """A source could not fetch the rest of its range."""
+
+
+class UploadLimitReached(Exception):
+    """The next group would exceed the pipeline's max_uploads Garmin calls."""
+
+
+class LeaseLost(Exception):
+    """Another instance took over the scheduled run (see job_leases) this pipeline belongs to."""
+
+# --- Sources ---
+# A source is an async generator of pages: (groups, window_start_ts, window_end_ts).
+# The window bounds tell the dedup stage which Garmin range to prefetch (None = unknown).
+
+async def range_pages(session, access_token, startdate, enddate=None, window_days=None, concurrency=1):
+    """
+    Yields the groups of [startdate, enddate] one time window at a time, oldest first.
+    With concurrency > 1, that many windows are fetched in parallel (still yielded in order).
+    """
+    enddate = enddate or int(time.time())
+    window = (window_days or config.PIPELINE_WINDOW_DAYS) * 86400
+
+    windows = []
+    window_start = startdate
+    while window_start <= enddate:
+        window_end = min(window_start + window - 1, enddate)
+        windows.append((window_start, window_end))
+        window_start = window_end + 1
+
+    concurrency = max(1, concurrency)
+    for i in range(0, len(windows), concurrency):
+        chunk = windows[i:i + concurrency]
+        results = await asyncio.gather(*(
+            sync_engine.fetch_measure_groups(session, access_token, startdate=start, enddate=end)
+            for start, end in chunk
+        ))
+        for (window_start, window_end), groups in zip(chunk, results):
+            if groups is None:
+                print("Stopping: could not fetch the remaining data from Withings.")
+                raise FetchError()
+            if groups:
+                groups.sort(key=lambda g: g['date'])
+                yield groups, window_start, window_end
+
+
+async def yield_to_interactive():
+    """Bulk jobs call this between groups: waits while an interactive sync runs (see priority)."""
+    if priority.GATE.interactive_running():
+        print("Pausing for an interactive sync...")
+        await sync_engine.run_blocking(priority.GATE.wait_turn)
+        print("Continuing.")
+
+
+async def latest_page(session, access_token):
+    """Yields the newest page of groups (newest first)."""
+    print("\nFetching data from Withings...")
+    groups = await sync_engine.fetch_measure_groups(session, access_token, max_pages=1)
+    if groups:
+        yield groups, None, None
+
+
+class GarminSink(sinks.Sink):
+    """The pipeline's Garmin upload as a sink (failed uploads go to the outbox)."""
+
+    name = 'garmin'
+
+    def __init__(self, sync_pipeline):
+        self.pipeline = sync_pipeline
+        self.client = None
+        self.heights = None
+
+    async def open(self):
+        self.client = await self.pipeline.garmin_task
+        self.heights = await self.pipeline.height_task
+
+    async def send(self, record, row, bp_duplicate=False):
+        """Returns the measurement_store status of the record."""
+        self.heights = self.pipeline._merge_heights(self.heights)
+        return await self.pipeline.upload_record(self.client, record, self.heights, bp_duplicate)
+
+
+class PlanReport:
+    """Outcome of a dry run: what a sync would do, per local day."""
+
+    OUTCOMES = ('upload', 'duplicate', 'rejected')
+
+    def __init__(self):
+        self.days = {}
+        self.weights = 0
+        self.blood_pressures = 0
+
+    def add(self, day, outcome):
+        counts = self.days.setdefault(day, dict.fromkeys(self.OUTCOMES, 0))
+        counts[outcome] += 1
+
+    def totals(self):
+        totals = dict.fromkeys(self.OUTCOMES, 0)
+        for counts in self.days.values():
+            for outcome, n in counts.items():
+                totals[outcome] += n
+        return totals
+
+    def to_dict(self):
+        totals = self.totals()
+        return {
+            "groups": sum(totals.values()),
+            **totals,
+            "weights": self.weights,
+            "blood_pressures": self.blood_pressures,
+            "days": [{"date": day, **self.days[day]} for day in sorted(self.days)],
+        }
+
+    def print_summary(self):
+        totals = self.totals()
+        print(f"\nSync Plan: {totals['upload']} group(s) to upload "
+              f"({self.weights} weight, {self.blood_pressures} blood pressure), "
+              f"{totals['duplicate']} duplicate(s), {totals['rejected']} rejected.")
+        for day in sorted(self.days):
+            counts = self.days[day]
+            print(f"  {day}: upload {counts['upload']}, duplicate {counts['duplicate']}, rejected {counts['rejected']}")
+
+
+class SyncPipeline:
+    """
+    Runs a source through decode -> merge -> dedup -> upload.
+
+    garmin_task / height_task are futures resolving to the logged-in Garmin client and the
+    user's HeightSeries; the stages only wait for them when they actually need them, so
+    fetching overlaps with the Garmin login.
+    """
+
+    def __init__(self, garmin_task, height_task, account=None, progress_callback=None, queue_depth=None,
+                 checkpoint=None, plan=False, store=True, max_uploads=None, bulk=False, lease=None):
+        self.garmin_task = garmin_task
+        self.height_task = height_task
+        self.account = account
+        self.progress_callback = progress_callback
+        self.queue_depth = queue_depth or config.PIPELINE_QUEUE_DEPTH
+        self.local_tz = tzlocal.get_localzone()
+        self.rate_limiter = accounts.get_rate_limiter(account)
+        # checkpoints.Checkpoint advanced after every processed group (historical syncs)
+        self.checkpoint = checkpoint
+        self.interrupted = False
+        # Dry run: classify groups instead of uploading them, and write nothing
+        self.plan = PlanReport() if plan else None
+        # Keep fetched pages in the local measurement store (off when re-sending stored data)
+        self.store = store and not plan
+        # Budget of Garmin upload calls for this run (drip backfills); the run stops before exceeding it
+        self.max_uploads = max_uploads
+        self.upload_calls = 0
+        # Bulk jobs pause between groups while interactive syncs run
+        self.bulk = bulk
+        # job_leases.Lease of the scheduled run; checked before every group is uploaded
+        self.lease = lease
+
+        self.groups_fetched = 0
+        self.total = 0
+        self.processed = 0
+        self.merged_groups = 0
+        self.success_count = 0
+        self.fail_count = 0
+        self.newest_date = None
+
+        # Height measurements seen in the synced data, merged into the height series on upload
+        self._seen_heights = []
+        self._heights_changed = False
+
+        # Garmin BP records loaded for duplicate checks: [(start_date_str, end_date_str, task)]
+        self._bp_ranges = []
+
+    # --- Garmin BP cache ---
+
+    def _local_date(self, ts):
+        return datetime.fromtimestamp(ts, timezone.utc).astimezone(self.local_tz).strftime('%Y-%m-%d')
+
+    async def _load_bp(self, start_date_str, end_date_str):
+        try:
+            garmin = await self.garmin_task
+        except Exception:
+            return None # Login failure is reported by the upload stage
+        try:
+            print(f"\nChecking Garmin for existing blood pressure entries from {start_date_str} to {end_date_str}...")
+            existing = await sync_engine.fetch_garmin_bp(garmin, start_date_str, end_date_str)
+            print(f"  Found {len(existing)} existing blood pressure records on Garmin.")
+            return existing
+        except Exception as e:
+            print(f"  Warning: Could not fetch existing Garmin blood pressure records. Error: {e}")
+            return None
+
+    def preload_bp(self, start_date_str, end_date_str):
+        """Starts loading existing Garmin BP records for a date range in the background."""
+        task = asyncio.ensure_future(self._load_bp(start_date_str, end_date_str))
+        self._bp_ranges.append((start_date_str, end_date_str, task))
+        return task
+
+    def seed_bp(self, start_date_str, end_date_str, existing):
+        """Registers Garmin BP records the caller already fetched for a date range."""
+        task = sync_engine._completed(existing)
+        self._bp_ranges.append((start_date_str, end_date_str, task))
+
+    async def existing_bp_for(self, date_str, window=None):
+        # Range sources move forward in time: ranges ending before this date are no longer needed
+        self._bp_ranges = [r for r in self._bp_ranges if r[1] >= date_str or not r[2].done()]
+        for start, end, task in self._bp_ranges:
+            if start <= date_str <= end:
+                return await task or []
+        if window and window[0] is not None:
+            start, end = self._local_date(window[0]), self._local_date(window[1])
+        else:
+            start = end = date_str
+        return await self.preload_bp(start, end) or []
+
+    # --- Stages ---
+
+    async def _fetch(self, pages, out_q):
+        try:
+            async for groups, window_start, window_end in pages:
+                self.groups_fetched += len(groups)
+                if window_start is not None:
+                    # Warm the Garmin BP cache for this window while the page moves down the pipeline
+                    self.preload_bp(self._local_date(window_start), self._local_date(window_end))
+                await out_q.put((groups, (window_start, window_end)))
+        except FetchError:
+            # Finish what was already fetched; the checkpoint keeps the rest resumable
+            self.interrupted = True
+        await out_q.put(_END)
+
+    async def _decode(self, in_q, out_q, select_latest):
+        while True:
+            item = await in_q.get()
+            if item is _END:
+                break
+            groups, window = item
+            batch = decode_page(groups)
+            if self.store:
+                await self._store(groups, batch)
+
+            heights = batch.columns['height']
+            for i in range(len(batch)):
+                if heights[i] == heights[i]:
+                    self._seen_heights.append((batch.dates[i], heights[i]))
+
+            # Only groups with body-composition or blood pressure values are materialized as
+            # records (partial ones too: the merge stage may complete them)
+            def relevant(i):
+                if batch.has_any(i, WEIGHT_FIELDS) or batch.has_bp(i):
+                    return True
+                if self.plan:
+                    self.plan.add(self._local_date(batch.dates[i]), 'rejected')
+                return False
+            records = list(batch.rows(relevant))
+            if select_latest:
+                records.reverse() # The latest page is newest first; the merge stage wants oldest first
+
+            for record in records:
+                await out_q.put((record, window))
+        await out_q.put(_END)
+
+    async def _merge(self, in_q, out_q, select_latest):
+        """
+        Merges groups measured within MERGE_WINDOW_SECONDS of each other (a weigh-in split
+        into weight and recomputed fat groups, one BP reading from several devices) into
+        one record. Emits (record, window, last part); the last part is what a checkpoint
+        has to advance to.
+        """
+        coalescer = GroupCoalescer(config.MERGE_WINDOW_SECONDS)
+        merged = []
+        # Fetch window of the first pending part (the BP duplicate check prefetches by window)
+        pending_window = None
+
+        async def emit(done, window):
+            if done is None:
+                return
+            record, parts = done
+            if len(parts) > 1:
+                self.merged_groups += len(parts) - 1
+            if select_latest:
+                merged.append((record, window, parts[-1]))
+            elif record.has_weight or record.has_bp:
+                self.total += 1
+                await out_q.put((record, window, parts[-1]))
+            elif self.plan:
+                self.plan.add(self._local_date(record.date), 'rejected')
+
+        while True:
+            item = await in_q.get()
+            if item is _END:
+                break
+            record, window = item
+            done_window = pending_window
+            if not coalescer:
+                pending_window = window
+            done = coalescer.add(record)
+            if done:
+                await emit(done, done_window)
+                pending_window = window
+        await emit(coalescer.flush(), pending_window)
+
+        for item in self._select_latest(merged):
+            self.total += 1
+            await out_q.put(item)
+        await out_q.put(_END)
+
+    async def _store(self, groups, batch):
+        """Keeps a local copy of the page for reconciliation; never fails the sync."""
+        try:
+            await sync_engine.run_blocking(measurement_store.save_page, self.account, groups, batch)
+        except Exception as e:
+            print(f"  Warning: Could not store measurements locally. Error type: {type(e).__name__}")
+
+    async def _mark(self, record, last, status):
+        """Records the Garmin outcome of a record's groups in the local store; never fails the sync."""
+        try:
+            await sync_engine.run_blocking(measurement_store.mark_status, self.account, record.date, last.date, status)
+        except Exception as e:
+            print(f"  Warning: Could not record the sync status locally. Error type: {type(e).__name__}")
+
+    def _select_latest(self, items):
+        """Keeps only the newest weight and the newest blood pressure measurement (items are oldest first)."""
+        if not items:
+            return []
+        weight_item = next((item for item in reversed(items) if item[0].has_weight), None)
+        bp_item = next((item for item in reversed(items) if item[0].has_bp), None)
+
+        if weight_item is None:
+            print("No weight measurement found.")
+        if bp_item is None:
+            print("No blood pressure measurement found.")
+        if weight_item is bp_item:
+            return [weight_item] if weight_item is not None else []
+
+        selected = []
+        if weight_item is not None:
+            record, window, last = weight_item
+            selected.append((record.copy(clear=BP_FIELDS), window, last))
+        if bp_item is not None:
+            record, window, last = bp_item
+            selected.append((record.copy(clear=WEIGHT_FIELDS), window, last))
+        return selected
+
+    async def _dedup(self, in_q, out_q):
+        while True:
+            item = await in_q.get()
+            if item is _END:
+                break
+            record, window, last = item
+            bp_duplicate = False
+            if record.has_bp:
+                existing = await self.existing_bp_for(self._local_date(record.date), window)
+                dt = datetime.fromtimestamp(record.date, timezone.utc)
+                bp_duplicate = sync_app.is_duplicate_bp(
+                    dt, record.systolic, record.diastolic, record.heart_rate, existing
+                )
+            await out_q.put((record, bp_duplicate, last))
+        await out_q.put(_END)
+
+    def _classify(self, record, bp_duplicate, last):
+        upload_bp = record.has_bp and not bp_duplicate
+        if record.has_weight:
+            self.plan.weights += 1
+        if upload_bp:
+            self.plan.blood_pressures += 1
+        outcome = 'upload' if record.has_weight or upload_bp else 'duplicate'
+        self.plan.add(self._local_date(record.date), outcome)
+
+    async def _upload(self, in_q):
+        if self.plan:
+            while True:
+                item = await in_q.get()
+                if item is _END:
+                    return
+                self.processed += 1
+                self._classify(*item)
+
+        garmin = GarminSink(self)
+        await garmin.open()
+        # The other targets (and the local trend cache) get every record at the same time as Garmin
+        fan_out = sinks.FanOut(sinks.configured() + [sinks.TimeseriesSink(self.account)], self.account)
+        await fan_out.open()
+        try:
+            await self._upload_all(in_q, garmin, fan_out)
+        finally:
+            await fan_out.close()
+
+    async def _upload_all(self, in_q, garmin, fan_out):
+        while True:
+            item = await in_q.get()
+            if item is _END:
+                break
+            record, bp_duplicate, last = item
+            if self.bulk:
+                await yield_to_interactive()
+            if self.max_uploads is not None:
+                calls = int(record.has_weight) + int(record.has_bp and not bp_duplicate)
+                # The first group always goes through, so a budget smaller than a group still progresses
+                if self.upload_calls and self.upload_calls + calls > self.max_uploads:
+                    raise UploadLimitReached()
+                self.upload_calls += calls
+            if self.lease is not None and not await sync_engine.run_blocking(self.lease.valid):
+                raise LeaseLost()
+            status, _ = await asyncio.gather(garmin.send(record, None, bp_duplicate), fan_out.send(record))
+            await self._mark(record, last, status)
+            # Merged groups count as processed up to the last one
+            if self.newest_date is None or last.date > self.newest_date:
+                self.newest_date = last.date
+            if self.checkpoint:
+                await sync_engine.run_blocking(self.checkpoint.advance, last.date, last.grpid)
+
+    def _merge_heights(self, heights):
+        """Adds heights measured during the synced period to the series (cache is invalidated after the run)."""
+        while self._seen_heights:
+            if heights is None:
+                heights = height_series.HeightSeries()
+            if heights.add(*self._seen_heights.pop()):
+                self._heights_changed = True
+        return heights
+
+    async def _enqueue(self, kind, payload, error):
+        try:
+            await sync_engine.run_blocking(outbox.enqueue, self.account, kind, payload, type(error).__name__)
+            print("  Queued for automatic retry.")
+        except Exception as e:
+            print(f"  Could not queue the upload for retry. Error type: {type(e).__name__}")
+
+    async def upload_record(self, garmin_client, record, heights, bp_duplicate=False):
+        self.processed += 1
+        if self.progress_callback:
+            self.progress_callback(self.processed, self.total)
+
+        # Stop right away (before pacing) while Garmin is known to be down; the
+        # checkpoint keeps this and the remaining groups for a later run
+        await sync_engine.run_blocking(circuit_breaker.GARMIN.check)
+
+        # Avoid hitting rate limits (Garmin doesn't like rapid fire requests sometimes).
+        # The limiter is shared by all jobs of this account.
+        await sync_engine.run_blocking(self.rate_limiter.wait)
+
+        dt = datetime.fromtimestamp(record.date, timezone.utc)
+        dt_local = dt.astimezone(self.local_tz)
+        print(f"Processing measurement {self.processed}/{self.total} for {dt} (UTC) -> {dt_local} (Local)...")
+
+        group_success = False
+        queued = False
+        uploaded = False
+        weight = record.weight
+
+        # --- UPLOAD WEIGHT ---
+        if record.has_weight:
+            print(f"  Weight: {weight} kg")
+
+            percent_hydration = None
+            if record.hydration and weight:
+                percent_hydration = (record.hydration / weight) * 100
+
+            # BMI uses the height in effect at the time of the weigh-in
+            bmi = None
+            user_height = heights.at(record.date) if heights else None
+            if user_height:
+                bmi = weight / (user_height * user_height)
+
+            payload = dict(
+                timestamp=dt_local.isoformat(),
+                weight=weight,
+                percent_fat=record.fat_ratio,
+                percent_hydration=percent_hydration,
+                visceral_fat_rating=record.visceral_fat,
+                bone_mass=record.bone_mass,
+                muscle_mass=record.muscle_mass,
+                bmi=bmi
+            )
+            try:
+                await sync_engine.run_blocking(circuit_breaker.GARMIN.call, garmin_client.add_body_composition, **payload)
+                print(f"  Successfully synced Weight.")
+                group_success = uploaded = True
+                await sync_engine.run_blocking(outbox.discard_pending, self.account, outbox.KIND_WEIGHT, payload)
+            except Exception as e:
+                print(f"  Failed to upload Weight. Error type: {type(e).__name__}")
+                await self._enqueue(outbox.KIND_WEIGHT, payload, e)
+                queued = True
+
+        # --- UPLOAD BLOOD PRESSURE ---
+        if record.has_bp:
+            print(f"  BP: {record.systolic}/{record.diastolic} mmHg, HR: {record.heart_rate}")
+
+            if bp_duplicate:
+                print("  Blood pressure measurement already synced. Skipping.")
+                group_success = True
+            else:
+                payload = dict(
+                    systolic=record.systolic,
+                    diastolic=record.diastolic,
+                    pulse=record.heart_rate,
+                    timestamp=dt_local.isoformat()
+                )
+                try:
+                    await sync_engine.run_blocking(circuit_breaker.GARMIN.call, garmin_client.set_blood_pressure, **payload)
+                    print(f"  Successfully synced Blood Pressure.")
+                    group_success = uploaded = True
+                    await sync_engine.run_blocking(outbox.discard_pending, self.account, outbox.KIND_BP, payload)
+                except Exception as e:
+                    print(f"  Failed to upload Blood Pressure. Error type: {type(e).__name__}")
+                    await self._enqueue(outbox.KIND_BP, payload, e)
+                    queued = True
+
+        if group_success:
+            self.success_count += 1
+        else:
+            self.fail_count += 1
+
+        if queued:
+            return measurement_store.STATUS_QUEUED
+        return measurement_store.STATUS_SYNCED if uploaded else measurement_store.STATUS_DUPLICATE
+
+    async def run(self, pages, select_latest=False):
+        """Runs all stages to completion. A failing stage cancels the others and re-raises."""
+        decode_q = asyncio.Queue(self.queue_depth)
+        merge_q = asyncio.Queue(self.queue_depth)
+        dedup_q = asyncio.Queue(self.queue_depth)
+        upload_q = asyncio.Queue(self.queue_depth)
+
+        tasks = [
+            asyncio.ensure_future(self._fetch(pages, decode_q)),
+            asyncio.ensure_future(self._decode(decode_q, merge_q, select_latest)),
+            asyncio.ensure_future(self._merge(merge_q, dedup_q, select_latest)),
+            asyncio.ensure_future(self._dedup(dedup_q, upload_q)),
+            asyncio.ensure_future(self._upload(upload_q)),
+        ]
+        completed = False
+        try:
+            await asyncio.gather(*tasks)
+            completed = not self.interrupted
+        except UploadLimitReached:
+            # The rest of the range is left to the next run
+            self.interrupted = True
+            print(f"\nUpload budget of {self.max_uploads} reached, stopping for now.")
+        except LeaseLost:
+            # The instance that took over syncs the rest; nothing more is recorded here
+            self.interrupted = True
+            print("\nAnother instance took over this scheduled run, stopping.")
+            return
+        finally:
+            for task in tasks:
+                task.cancel()
+            for _, _, task in self._bp_ranges:
+                task.cancel()
+            if self.checkpoint:
+                self.checkpoint.finish(completed)
+
+        if self.plan:
+            self.plan.print_summary()
+            return
+
+        if self._heights_changed:
+            height_series.invalidate(self.account)
+
+        if not self.groups_fetched:
+            print("No measures found on Withings for the requested period.")
+            return
+
+        print(f"\nBatch Sync Complete. Success (Groups): {self.success_count}, Failures/Partial: {self.fail_count}")
+
+        if self.newest_date:
+            # Remember the newest measurement seen for this account
+            accounts.set_cursor(self.account, 'last_group_date', self.newest_date)
@@ -0,0 +1,78 @@
+"""
+Warm-up ahead of scheduled syncs.
+
+PREWARM_MINUTES before each schedule the account's sessions are prepared, so the sync
+itself only fetches and uploads new data: the Withings token is refreshed if it would
+expire around the sync, Garmin is logged into (rebuilding the token store if needed),
+the height history cache is filled and the Garmin blood pressure entries the duplicate
+check needs are read. The Garmin client and those entries are handed to the next daily
+sync of the account (sync_engine.take_warm). With SYNC_EXECUTION_MODE=process the sync
+runs in another process, so only the token, the token store and the height cache carry over.
+"""
+import asyncio
+import time
+
+import accounts
+import circuit_breaker
+import config
+import sync_app
+import sync_engine
+
+
+def warm_time(hour, minute):
+    """(hour, minute) PREWARM_MINUTES before a schedule (across midnight)."""
+    return divmod((hour * 60 + minute - config.PREWARM_MINUTES) % (24 * 60), 60)
+
+
+async def _warm_up(settings):
+    prepared = {}
+    for breaker in (circuit_breaker.WITHINGS, circuit_breaker.GARMIN):
+        retry_at = await sync_engine.run_blocking(breaker.retry_at)
+        if retry_at and retry_at > time.time():
+            print(f"Warm-up skipped: {breaker.label} has been failing.")
+            return prepared
+
+    garmin_task = asyncio.ensure_future(
+        sync_engine.run_blocking(circuit_breaker.GARMIN.call, sync_app.login_garmin, settings))
+    async with sync_engine.client_session() as session:
+        try:
+            # Valid until well after the sync starts, so the sync does not refresh it again
+            margin = sync_engine.TOKEN_EXPIRY_MARGIN + config.PREWARM_MINUTES * 60 + sync_engine.WARM_GRACE_SECONDS
+            access_token = await sync_engine.get_access_token(session, settings, margin=margin)
+            if access_token:
+                prepared['withings'] = True
+                prepared['height'] = bool(await sync_engine.load_height_series(session, access_token, settings))
+        except Exception as e:
+            print(f"Warning: Withings warm-up failed. Error type: {type(e).__name__}")
+
+    try:
+        garmin = await garmin_task
+    except Exception as e:
+        print(f"Warning: Garmin warm-up failed. Error type: {type(e).__name__}")
+        return prepared
+    prepared['garmin'] = True
+
+    bp = None
+    start, end = sync_engine.latest_bp_window()
+    try:
+        bp = (start, end, await sync_engine.fetch_garmin_bp(garmin, start, end))
+        prepared['bp'] = len(bp[2])
+    except Exception as e:
+        print(f"Warning: Could not read Garmin blood pressure entries. Error type: {type(e).__name__}")
+    sync_engine.keep_warm(settings, garmin=garmin, bp=bp)
+    return prepared
+
+
+def warm_up(account=None):
+    """Prepares the sessions of an account for its next daily sync. Returns what was prepared; never raises."""
+    settings = accounts.resolve(account)
+    if not settings['garmin_email'] or not settings['garmin_password']:
+        return {}
+    started = time.time()
+    try:
+        prepared = asyncio.run(_warm_up(settings))
+    except Exception as e:
+        print(f"Warning: Warm-up failed. Error type: {type(e).__name__}")
+        return {}
+    print(f"Warm-up finished in {time.time() - started:.1f}s: {', '.join(prepared) or 'nothing prepared'}.")
+    return prepared
@@ -0,0 +1,67 @@
+"""
+Priority lanes for sync work.
+
+Interactive work (daily syncs, Sync Now, manual entries) goes ahead of bulk work
+(historical imports, drip backfills, consistency checks): while any interactive job
+runs, bulk pipelines pause at their next group boundary and continue once it is done,
+so user-facing actions don't queue behind a multi-year import or share its Garmin
+rate limit. The flag is a multiprocessing Event, so bulk jobs running in worker
+processes (SYNC_EXECUTION_MODE=process) pause as well.
+
+The gate is deliberately global: an interactive job of one account pauses the bulk
+jobs of every account. All accounts reach Garmin (and Withings) from this server, whose
+requests are throttled together, and share its stdout capture, so the bulk work of
+another account would still slow the interactive job down.
+"""
+import contextlib
+import multiprocessing
+import threading
+
+
+class PriorityGate:
+    def __init__(self, event):
+        # Set while bulk work may run
+        self._event = event
+        self._event.set()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._local = threading.local()
+
+    @property
+    def event(self):
+        return self._event
+
+    def attach(self, event):
+        """Uses the web process' event (called inside sync worker processes)."""
+        self._event = event
+
+    @contextlib.contextmanager
+    def interactive(self):
+        """Marks an interactive job as running for the duration of the block."""
+        with self._lock:
+            self._active += 1
+            self._event.clear()
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+            with self._lock:
+                self._active -= 1
+                if not self._active:
+                    self._event.set()
+
+    def in_interactive(self):
+        """Whether the calling thread runs an interactive job."""
+        return getattr(self._local, 'depth', 0) > 0
+
+    def interactive_running(self):
+        return not self._event.is_set()
+
+    def wait_turn(self):
+        """Called by bulk jobs between groups: blocks while interactive work runs."""
+        self._event.wait()
+
+
+# Created in the start method of the sync workers (see sync_worker) so it can be handed to them
+GATE = PriorityGate(multiprocessing.get_context('spawn').Event())
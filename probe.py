@@ -0,0 +1,48 @@
+"""
+Cheap "anything new?" check used by the high-frequency scheduler.
+
+A probe is a Withings getmeas call with `lastupdate` set to the last time the account
+was known to be in sync; all its pages are read (usually one), so the count and the
+start of the changes cover every changed group. The access token is only refreshed when it is about
+to expire and Garmin is never contacted, so probing every few minutes costs one light
+API call per account. A real sync is started only when the probe reports new groups.
+"""
+import time
+
+import accounts
+import sync_engine
+from measurements import decode_page
+
+
+async def check_for_changes(account=None):
+    """
+    Asks Withings whether weight / blood pressure groups changed since the last probe.
+    Returns (new_groups, checked_at, since), or None if Withings is not connected or the call
+    failed. `since` is where a sync of the changes has to start: the last check, or the date of
+    an older measurement that was added since. Pass checked_at to mark_checked() once the
+    changes are synced.
+    """
+    settings = accounts.resolve(account)
+    lastupdate = accounts.get_cursor(settings, 'probe_lastupdate')
+    if lastupdate is None:
+        # First probe: anything newer than the last synced measurement counts as new
+        last_group_date = accounts.get_cursor(settings, 'last_group_date')
+        lastupdate = int(last_group_date) + 1 if last_group_date else int(time.time())
+
+    checked_at = int(time.time())
+    async with sync_engine.client_session() as session:
+        access_token = await sync_engine.get_access_token(session, settings)
+        if not access_token:
+            return None
+        groups = await sync_engine.fetch_measure_groups(session, access_token, lastupdate=int(lastupdate))
+
+    if groups is None:
+        return None
+    batch = decode_page(groups)
+    changed = [i for i in range(len(batch)) if batch.has_weight(i) or batch.has_bp(i)]
+    since = min([int(lastupdate)] + [batch.dates[i] for i in changed])
+    return len(changed), checked_at, since
+
+
+def mark_checked(account, checked_at):
+    accounts.set_cursor(account, 'probe_lastupdate', checked_at)
@@ -0,0 +1,367 @@
+"""
+Per-day reconciliation between Withings and Garmin.
+
+Instead of re-running a historical sync to verify a range, both sides are reduced to
+one digest per local day: the number of weigh-ins and blood pressure readings and a
+hash of their (timestamp, value) keys, weights in whole grams. Days whose digests differ
+are matched again with MATCH_SECONDS of tolerance, so readings stored a few seconds apart
+on the two sides are not reported as missing. The Withings side is read from the
+local measurement store, the Garmin side with one bulk request per data type and
+RECONCILE_CHUNK_DAYS days. Stored groups are merged the way the sync pipeline merges
+them before upload (MERGE_WINDOW_SECONDS). Only the measurements of days whose digests differ go
+through the regular upload pipeline, so a consistency check costs a few reads per
+month of data instead of per-measurement work.
+"""
+import argparse
+import asyncio
+import hashlib
+from bisect import bisect_left, insort
+from datetime import datetime, timezone, timedelta
+
+import tzlocal
+
+import accounts
+import config
+import measurement_store
+import pipeline
+import sync_app
+import sync_engine
+from measurements import (BP_FIELDS, TYPE_FIELDS, WEIGHT_FIELDS, GroupCoalescer, MeasurementGroup, decode_group,
+                          decode_page)
+
+WEIGHT_TYPES = frozenset(t for t, field in TYPE_FIELDS.items() if field in WEIGHT_FIELDS)
+BP_TYPES = frozenset(t for t, field in TYPE_FIELDS.items() if field in BP_FIELDS)
+
+# Measurements with the same values at most this many seconds apart are the same measurement
+MATCH_SECONDS = 60
+
+
+def weight_key(ts, weight):
+    """(timestamp, weight in grams). Grams are exact on both sides (Withings 10^-3 kg, Garmin g)."""
+    return (int(round(ts)), int(round(weight * 1000)))
+
+
+def bp_key(ts, systolic, diastolic, pulse):
+    return (int(round(ts)), int(systolic), int(diastolic), int(pulse or 0))
+
+
+def garmin_weight_key(entry):
+    """weight_key of a Garmin dateWeightList entry, or None without timestamp or weight."""
+    ts_ms = entry.get('timestampGMT') or entry.get('date')
+    if not ts_ms or not entry.get('weight'):
+        return None
+    return weight_key(ts_ms / 1000, entry['weight'] / 1000) # grams
+
+
+class KeySet:
+    """
+    Measurement keys (timestamp, *values). A key is `in` the set when one with the same
+    values is at most MATCH_SECONDS away from it.
+    """
+
+    def __init__(self, keys=()):
+        self._times = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        insort(self._times.setdefault(key[1:], []), key[0])
+
+    def __contains__(self, key):
+        times = self._times.get(key[1:])
+        if not times:
+            return False
+        i = bisect_left(times, key[0] - MATCH_SECONDS)
+        return i < len(times) and times[i] <= key[0] + MATCH_SECONDS
+
+    def __iter__(self):
+        for values, times in self._times.items():
+            for ts in times:
+                yield (ts,) + values
+
+    def __len__(self):
+        return sum(len(times) for times in self._times.values())
+
+
+async def garmin_weights(garmin, start_ts, end_ts):
+    """KeySet of the Garmin weigh-ins of [start_ts, end_ts], read RECONCILE_CHUNK_DAYS days per request."""
+    local_tz = tzlocal.get_localzone()
+    # One extra day on each side: Garmin filters by its own calendar days
+    day = datetime.fromtimestamp(start_ts, local_tz).date() - timedelta(days=1)
+    last = datetime.fromtimestamp(end_ts, local_tz).date() + timedelta(days=1)
+    keys = KeySet()
+    while day <= last:
+        chunk_end = min(day + timedelta(days=max(1, config.RECONCILE_CHUNK_DAYS) - 1), last)
+        for entry in await sync_engine.fetch_garmin_weights(garmin, day.isoformat(), chunk_end.isoformat()):
+            key = garmin_weight_key(entry)
+            if key:
+                keys.add(key)
+        day = chunk_end + timedelta(days=1)
+    return keys
+
+
+class DayDigest:
+    """Weight / blood pressure keys of one side for one day."""
+
+    __slots__ = ('weights', 'bps')
+
+    def __init__(self):
+        self.weights = set()
+        self.bps = set()
+
+    def digest(self):
+        h = hashlib.sha1()
+        for key in sorted(self.weights):
+            h.update(repr(key).encode())
+        h.update(b'|')
+        for key in sorted(self.bps):
+            h.update(repr(key).encode())
+        return len(self.weights), len(self.bps), h.hexdigest()
+
+
+class Reconciler:
+    def __init__(self, account, start_ts, end_ts):
+        self.account = account
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.local_tz = tzlocal.get_localzone()
+        self.start_day = self._day(start_ts)
+        self.end_day = self._day(end_ts)
+
+        self.withings = {}
+        self.garmin = {}
+        # (day, key) -> grpids of the stored Withings groups merged into that measurement
+        self.weight_groups = {}
+        self.bp_groups = {}
+        # day -> Garmin BP records, handed to the pipeline's duplicate check
+        self.garmin_bp = {}
+        # Every Garmin measurement of the range, for matches across midnight
+        self.garmin_weights = KeySet()
+        self.garmin_bps = KeySet()
+
+    def _day(self, ts):
+        return datetime.fromtimestamp(ts, timezone.utc).astimezone(self.local_tz).strftime('%Y-%m-%d')
+
+    def _add_withings(self, record, parts):
+        day = self._day(record.date)
+        digest = self.withings.setdefault(day, DayDigest())
+        grpids = [part.grpid for part in parts]
+        if record.has_weight:
+            key = weight_key(record.date, record.weight)
+            digest.weights.add(key)
+            self.weight_groups[(day, key)] = grpids
+        if record.has_bp:
+            key = bp_key(record.date, record.systolic, record.diastolic, record.heart_rate)
+            digest.bps.add(key)
+            self.bp_groups[(day, key)] = grpids
+
+    def load_withings(self):
+        rows = measurement_store.values(self.account, self.start_ts, self.end_ts)
+        coalescer = GroupCoalescer(config.MERGE_WINDOW_SECONDS)
+        for grpid, date, weight, systolic, diastolic, heart_rate in rows:
+            record = MeasurementGroup(grpid, date, weight=weight, systolic=systolic,
+                                      diastolic=diastolic, heart_rate=heart_rate)
+            done = coalescer.add(record)
+            if done:
+                self._add_withings(*done)
+        done = coalescer.flush()
+        if done:
+            self._add_withings(*done)
+        return len(rows)
+
+    def _chunks(self):
+        day = datetime.strptime(self.start_day, '%Y-%m-%d')
+        last = datetime.strptime(self.end_day, '%Y-%m-%d')
+        while day <= last:
+            chunk_end = min(day + timedelta(days=config.RECONCILE_CHUNK_DAYS - 1), last)
+            yield day.strftime('%Y-%m-%d'), chunk_end.strftime('%Y-%m-%d')
+            day = chunk_end + timedelta(days=1)
+
+    def _add_garmin(self, ts, weight=None, bp=None):
+        day = self._day(ts)
+        if not self.start_day <= day <= self.end_day:
+            return
+        digest = self.garmin.setdefault(day, DayDigest())
+        if weight:
+            key = weight_key(ts, weight)
+            digest.weights.add(key)
+            self.garmin_weights.add(key)
+        if bp:
+            key = bp_key(ts, bp.get('systolic'), bp.get('diastolic'), bp.get('pulse'))
+            digest.bps.add(key)
+            self.garmin_bps.add(key)
+            self.garmin_bp.setdefault(day, []).append(bp)
+
+    async def load_garmin(self, garmin):
+        for start, end in self._chunks():
+            await pipeline.yield_to_interactive()
+            weights, bps = await asyncio.gather(
+                sync_engine.fetch_garmin_weights(garmin, start, end),
+                sync_engine.fetch_garmin_bp(garmin, start, end),
+            )
+            for entry in weights:
+                key = garmin_weight_key(entry)
+                if key:
+                    self._add_garmin(key[0], weight=key[1] / 1000)
+            for bp in bps:
+                dt = sync_app.parse_garmin_timestamp(bp.get('measurementTimestampGMT'))
+                if dt and bp.get('systolic') and bp.get('diastolic'):
+                    if dt.tzinfo is None:
+                        dt = dt.replace(tzinfo=timezone.utc)
+                    self._add_garmin(dt.timestamp(), bp=bp)
+
+    def compare(self):
+        """Returns the report rows of the days whose digests differ."""
+        empty = DayDigest()
+        differing = []
+        for day in sorted(set(self.withings) | set(self.garmin)):
+            local = self.withings.get(day, empty)
+            remote = self.garmin.get(day, empty)
+            if local.digest() == remote.digest():
+                continue
+            local_weights, local_bps = KeySet(local.weights), KeySet(local.bps)
+            missing_weights = sorted(key for key in local.weights if key not in self.garmin_weights)
+            missing_bp = sorted(key for key in local.bps if key not in self.garmin_bps)
+            only_on_garmin = sum(key not in local_weights for key in remote.weights) + \
+                sum(key not in local_bps for key in remote.bps)
+            if not missing_weights and not missing_bp and not only_on_garmin:
+                # Same measurements, timestamps a few seconds apart
+                continue
+            differing.append({
+                "date": day,
+                "withings_weights": len(local.weights),
+                "garmin_weights": len(remote.weights),
+                "withings_bp": len(local.bps),
+                "garmin_bp": len(remote.bps),
+                "missing_weights": missing_weights,
+                "missing_bp": missing_bp,
+                "only_on_garmin": only_on_garmin,
+            })
+        return differing
+
+    def groups_to_send(self, differing):
+        """
+        Stored groups holding the missing measurements, per day. Each group is checked against
+        the Garmin measurements again: weights or blood pressure Garmin already has are dropped.
+        """
+        pages = []
+        for row in differing:
+            day = row['date']
+            missing_weight = {grpid for key in row['missing_weights'] for grpid in self.weight_groups[(day, key)]}
+            grpids = missing_weight | {grpid for key in row['missing_bp'] for grpid in self.bp_groups[(day, key)]}
+            if not grpids:
+                continue
+            groups = []
+            for group in measurement_store.load_groups(self.account, grpids):
+                record = decode_group(group)
+                if group['grpid'] not in missing_weight or \
+                        (record.has_weight and weight_key(record.date, record.weight) in self.garmin_weights):
+                    # Only the blood pressure is missing: don't upload the weigh-in a second time
+                    group['measures'] = [m for m in group['measures'] if m['type'] not in WEIGHT_TYPES]
+                if record.has_bp and bp_key(record.date, record.systolic, record.diastolic,
+                                            record.heart_rate) in self.garmin_bps:
+                    group['measures'] = [m for m in group['measures'] if m['type'] not in BP_TYPES]
+                if group['measures']:
+                    groups.append(group)
+            if groups:
+                pages.append((day, groups))
+        return pages
+
+
+async def refresh_store(session, access_token, account, start_ts, end_ts):
+    """Reads a range from Withings into the local store (no uploads)."""
+    print("Refreshing the local copy of the Withings data...")
+    stored = 0
+    async for groups, _, _ in pipeline.range_pages(session, access_token, start_ts, end_ts,
+                                                   concurrency=config.PLAN_FETCH_CONCURRENCY):
+        stored += await sync_engine.run_blocking(measurement_store.save_page, account, groups, decode_page(groups))
+    print(f"  Stored {stored} measurement group(s).")
+
+
+async def stored_pages(pages):
+    for _, groups in pages:
+        yield groups, None, None
+
+
+async def reconcile(start_ts, end_ts, account=None, refresh=False, dry_run=False):
+    """
+    Compares [start_ts, end_ts] day by day and uploads what Garmin is missing.
+    Returns the report dict, or None if the check could not run.
+    """
+    settings = accounts.resolve(account)
+    async with sync_engine.client_session() as session:
+        connected = await sync_engine._connect(session, settings)
+        if not connected:
+            return None
+        token_data, garmin_task = connected
+        try:
+            if refresh:
+                await refresh_store(session, token_data['access_token'], settings, start_ts, end_ts)
+
+            reconciler = Reconciler(settings, start_ts, end_ts)
+            stored = await sync_engine.run_blocking(reconciler.load_withings)
+            if not stored:
+                print("No local Withings data for this period. Run a historical sync or use refresh first.")
+            print(f"\nComparing {reconciler.start_day} to {reconciler.end_day} with Garmin...")
+            await reconciler.load_garmin(await garmin_task)
+        except pipeline.FetchError:
+            return None
+        except Exception as e:
+            print(f"Reconciliation Failed. Error type: {type(e).__name__}")
+            garmin_task.cancel()
+            return None
+
+        days = set(reconciler.withings) | set(reconciler.garmin)
+        differing = reconciler.compare()
+        report = {
+            "days": len(days),
+            "matching": len(days) - len(differing),
+            "differing": differing,
+            "resent": 0,
+        }
+        print(f"  {report['matching']} of {report['days']} day(s) match, {len(differing)} differ.")
+        for row in differing:
+            print(f"  {row['date']}: Withings {row['withings_weights']} weight / {row['withings_bp']} BP, "
+                  f"Garmin {row['garmin_weights']} weight / {row['garmin_bp']} BP")
+
+        pages = await sync_engine.run_blocking(reconciler.groups_to_send, differing)
+        if not pages or dry_run:
+            return report
+
+        report["resent"] = sum(len(groups) for _, groups in pages)
+        print(f"\nUploading {report['resent']} missing measurement group(s)...")
+        await sync_engine._run_pipeline(
+            session, token_data, garmin_task, lambda access_token: stored_pages(pages),
+            account=settings, store=False, bulk=True, seed_bp=[(day, day, reconciler.garmin_bp.get(day, [])) for day, _ in pages],
+        )
+    return report
+
+
+def run_reconcile(days=None, from_date=None, to_date=None, account=None, refresh=False, dry_run=False):
+    """Synchronous entry point; see reconcile(). Defaults to the last RECONCILE_DAYS days."""
+    now = datetime.now(timezone.utc)
+    try:
+        start = datetime.strptime(from_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) if from_date \
+            else now - timedelta(days=days or config.RECONCILE_DAYS)
+        end = datetime.strptime(to_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59, tzinfo=timezone.utc) \
+            if to_date else now
+    except ValueError as e:
+        print(f"Error parsing dates: {e}")
+        return None
+    return asyncio.run(reconcile(int(start.timestamp()), int(end.timestamp()), account=account,
+                                 refresh=refresh, dry_run=dry_run))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare Withings and Garmin day by day and upload what is missing.')
+    parser.add_argument('--days', type=int, default=None, help=f'Number of days to check (default: {config.RECONCILE_DAYS})')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    parser.add_argument('--refresh', action='store_true', help='Re-read the period from Withings into the local store first')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the differing days')
+    args = parser.parse_args()
+
+    run_reconcile(args.days, account=args.account, refresh=args.refresh, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
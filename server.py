@@ -1,6 +1,7 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, Response, stream_with_context
 import sys
 import io
+import asyncio
 import contextlib
 import requests
 import json
@@ -9,6 +10,7 @@ import re
 import atexit
 import time
 import secrets
+import hmac
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Force immediate log output
@@ -16,17 +18,37 @@ print("DEBUG: Server module loading...", flush=True)
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import sync_app
 from datetime import datetime
 import tzlocal
 from config import WITHINGS_CLIENT_ID, WITHINGS_CLIENT_SECRET, WITHINGS_REDIRECT_URI, GARMIN_EMAIL, GARMIN_PASSWORD
 
 import sync_historical
+import accounts
+import config
+import height_series
+import measurement_store
+import reconcile
+import probe
+import outbox
+import priority
+import checkpoints
+import backfill
+import sinks
+import history_export
+import timeseries
+import bulk_import
+import prewarm
+import job_leases
+import circuit_breaker
+import withings_notify
+import withings_export
+import sync_worker
 import sqlite3
 import threading
 from garminconnect import Garmin
-
-GARMIN_AUTH_SESSION = None
+import garmin_login
 
 
 print("DEBUG: Imports complete. Initializing App...", flush=True)
@@ -39,9 +61,6 @@ try:
     # Explicitly use local timezone
     local_tz = tzlocal.get_localzone()
     scheduler = BackgroundScheduler(timezone=str(local_tz))
-    scheduler.start()
-    atexit.register(lambda: scheduler.shutdown())
-    print(f"DEBUG: Scheduler started with timezone: {local_tz}", flush=True)
 except Exception as e:
     print(f"DEBUG: Scheduler failed to start. Error type: {type(e).__name__}", flush=True)
     sys.exit(1)
@@ -132,14 +151,34 @@ def init_db():
             # Ensure table exists if it didn't
             c.execute('''CREATE TABLE IF NOT EXISTS schedule_config
                          (id INTEGER PRIMARY KEY AUTOINCREMENT, hour INTEGER, minute INTEGER, enabled BOOLEAN)''')
+
+            # Schedules can target a specific account (NULL = default account)
+            c.execute("PRAGMA table_info(schedule_config)")
+            if 'account_id' not in [row[1] for row in c.fetchall()]:
+                c.execute("ALTER TABLE schedule_config ADD COLUMN account_id INTEGER")
+
+            # Change-detection probe interval (0 = disabled)
+            c.execute('''CREATE TABLE IF NOT EXISTS probe_config
+                         (id INTEGER PRIMARY KEY CHECK (id = 1), interval_minutes INTEGER)''')
+            c.execute("INSERT OR IGNORE INTO probe_config (id, interval_minutes) VALUES (1, ?)",
+                      (config.PROBE_INTERVAL_MINUTES,))
             
             conn.commit()
+        accounts.init_accounts_db(DB_PATH)
+        height_series.init_db(DB_PATH)
+        measurement_store.init_db(DB_PATH)
+        outbox.init_db(DB_PATH)
+        checkpoints.init_db(DB_PATH)
+        backfill.init_db(DB_PATH)
+        sinks.init_db(DB_PATH)
+        job_leases.init_db(DB_PATH)
+        circuit_breaker.init_db(DB_PATH)
+        # Historical syncs still marked running were cut off by the restart
+        checkpoints.interrupt_running()
         print("DEBUG: Database initialized success.", flush=True)
     except Exception as e:
         print(f"DEBUG: Database initialization failed. Error type: {type(e).__name__}", flush=True)
 
-init_db()
-
 # Global progress state
 SYNC_PROGRESS = {
     "status": "idle", # idle, running, completed, error
@@ -149,10 +188,24 @@ SYNC_PROGRESS = {
     "log": ""
 }
 
-def add_schedule(hour, minute):
+# Progress of the running bulk manual import
+IMPORT_PROGRESS = {
+    "status": "idle",
+    "current": 0,
+    "total": 0,
+    "message": "",
+    "log": ""
+}
+
+# Background jobs polled by id (GET /jobs/<job_id>), e.g. sync plans
+BACKGROUND_JOBS = {}
+# Seconds a finished background job can still be read
+BACKGROUND_JOB_TTL_SECONDS = 3600
+
+def add_schedule(hour, minute, account_id=None):
     with sqlite3.connect(DB_PATH) as conn:
         c = conn.cursor()
-        c.execute("INSERT INTO schedule_config (hour, minute, enabled) VALUES (?, ?, 1)", (hour, minute))
+        c.execute("INSERT INTO schedule_config (hour, minute, enabled, account_id) VALUES (?, ?, 1, ?)", (hour, minute, account_id))
         conn.commit()
         return c.lastrowid
 
@@ -166,10 +219,23 @@ def get_schedules():
     with sqlite3.connect(DB_PATH) as conn:
         conn.row_factory = sqlite3.Row
         c = conn.cursor()
-        c.execute("SELECT id, hour, minute, enabled FROM schedule_config")
+        c.execute("SELECT id, hour, minute, enabled, account_id FROM schedule_config")
         rows = c.fetchall()
         return [dict(row) for row in rows]
 
+def get_probe_interval():
+    with sqlite3.connect(DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT interval_minutes FROM probe_config WHERE id=1")
+        row = c.fetchone()
+        return row[0] if row and row[0] else 0
+
+def set_probe_interval(minutes):
+    with sqlite3.connect(DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("INSERT OR REPLACE INTO probe_config (id, interval_minutes) VALUES (1, ?)", (minutes,))
+        conn.commit()
+
 def append_history(status, log_output):
     """Appends a new entry to the history database, keeping only the last 50."""
     now_local = datetime.now(tzlocal.get_localzone())
@@ -196,8 +262,62 @@ def get_sync_history():
         print(f"Error reading history. Error type: {type(e).__name__}")
     return entries
 
+class ThreadLocalStdout:
+    """
+    sys.stdout replacement that routes writes to a per-thread buffer while a capture is active.
+    contextlib.redirect_stdout swaps the process-wide stdout, which mixes the logs of syncs
+    running in parallel (e.g. several accounts in the worker pool).
+    """
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, 'target', None) or self.fallback
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+    @contextlib.contextmanager
+    def capture(self, buffer):
+        previous = getattr(self._local, 'target', None)
+        self._local.target = buffer
+        try:
+            yield buffer
+        finally:
+            self._local.target = previous
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+if not isinstance(sys.stdout, ThreadLocalStdout):
+    sys.stdout = ThreadLocalStdout(sys.stdout)
+
+def capture_stdout(buffer):
+    return sys.stdout.capture(buffer)
+
+def _run_sync_in_process(target_func, progress_dict=None, **kwargs):
+    """Process-mode counterpart of run_sync_logic: the job runs in a worker process and its output streams back."""
+    def on_log(s):
+        if progress_dict is not None:
+            progress_dict['log'] += s
+
+    on_progress = kwargs.pop('progress_callback', None)
+    ok, output = sync_worker.run_in_process(target_func, on_log=on_log, on_progress=on_progress, **kwargs)
+
+    status = "Success" if ok else "Failed"
+    if "Error" in output or "Failed" in output or "Traceback" in output:
+        status = "Failed"
+    return status, output
+
 def run_sync_logic(target_func=sync_app.main, progress_dict=None, *args, **kwargs):
     """Shared logic for running sync and capturing output. Optionally updates progress_dict['log'] live."""
+    if config.SYNC_EXECUTION_MODE == 'process' and not args:
+        return _run_sync_in_process(target_func, progress_dict, **kwargs)
+
     f = io.StringIO()
     status = "Failed"
     
@@ -217,7 +337,7 @@ def run_sync_logic(target_func=sync_app.main, progress_dict=None, *args, **kwarg
         if progress_dict is not None:
             buffer = LiveBuffer(f, progress_dict)
             
-        with contextlib.redirect_stdout(buffer):
+        with capture_stdout(buffer):
             target_func(*args, **kwargs)
         status = "Success"
         output = f.getvalue()
@@ -232,36 +352,297 @@ def run_sync_logic(target_func=sync_app.main, progress_dict=None, *args, **kwarg
         
     return status, output
 
-def scheduled_sync_job():
-    print(f"Running scheduled sync...")
-    status, output = run_sync_logic(target_func=sync_app.main)
-    append_history(f"Scheduled ({status})", output)
+# Bounded pool running account syncs in parallel (one job per account at a time)
+account_pool = accounts.AccountSyncPool(config.MAX_SYNC_WORKERS)
+atexit.register(account_pool.shutdown)
+
+def _account_label(account_id):
+    if not account_id:
+        return ""
+    account = accounts.get_account(account_id)
+    return f" [{account['name'] if account else account_id}]"
+
+def run_account_sync(account_id, label, lease=None):
+    """
+    Runs the daily sync for one account and records the result. Executed on the account pool.
+    lease: the claimed scheduled run; nothing is done if another instance has taken it over meanwhile.
+    """
+    if lease is not None and not lease.valid():
+        print("Scheduled sync skipped: another instance took it over.")
+        return "Skipped", ""
+    # Interactive lane: running historical imports / backfills pause until this is done
+    with priority.GATE.interactive():
+        status, output = run_sync_logic(target_func=sync_app.main, account=account_id, lease=lease)
+    append_history(f"{label}{_account_label(account_id)} ({status})", output)
+    accounts.record_sync_result(account_id, status)
+    return status, output
+
+def _run_schedule(schedule, scheduled_for, label):
+    """Runs one occurrence of a schedule unless it already ran (on this or another instance sharing data/)."""
+    lease = job_leases.claim_run(f"daily_sync_{schedule['id']}", scheduled_for)
+    if lease is None:
+        print("Scheduled sync skipped: it already ran or is running on another instance.")
+        return
+    account_id = schedule.get('account_id')
+    print("Running scheduled sync...")
+    with lease.kept_alive():
+        future = account_pool.submit(account_id, run_account_sync, account_id, label, lease)
+        if future is None:
+            print("Scheduled sync skipped: a sync for this account is already running.")
+            lease.finish(job_leases.STATUS_SKIPPED)
+            return
+        status, _ = future.result()
+    lease.finish(job_leases.STATUS_SUCCESS if status == "Success" else job_leases.STATUS_FAILED)
     print(f"Scheduled sync finished: {status}")
 
-# Restore schedule on startup
-print("DEBUG: Attempting to restore schedules...", flush=True)
-try:
-    schedules = get_schedules()
-    count = 0
-    for s in schedules:
-        if s.get('enabled'):
-            h = s['hour']
-            m = s['minute']
-            sid = s['id']
-            scheduler.add_job(
-                func=scheduled_sync_job,
-                trigger=CronTrigger(hour=h, minute=m),
-                id=f'daily_sync_{sid}',
-                name=f'daily_sync_job_{sid}',
-                replace_existing=True
-            )
-            count += 1
-    print(f"DEBUG: Restored {count} schedules.", flush=True)
-except Exception as e:
-    print(f"DEBUG: Failed to restore schedule. Error type: {type(e).__name__}", flush=True)
-    # Don't exit, just continue without schedule
+def scheduled_sync_job(schedule_id):
+    # Another instance may have changed or removed the schedule since it was loaded here
+    schedule = next((s for s in get_schedules() if s['id'] == schedule_id), None)
+    if not schedule or not schedule.get('enabled'):
+        return
+    _run_schedule(schedule, job_leases.last_occurrence(schedule['hour'], schedule['minute']), "Scheduled")
+
+def schedule_catchup_job():
+    """Runs the latest occurrence of every schedule that no instance ran (all were down), once."""
+    now = time.time()
+    for schedule in get_schedules():
+        if not schedule.get('enabled'):
+            continue
+        scheduled_for = job_leases.last_occurrence(schedule['hour'], schedule['minute'])
+        late = now - scheduled_for
+        # Recent occurrences are left to the cron jobs of running instances
+        if late < 120 or late > config.SCHEDULE_MISFIRE_GRACE_MINUTES * 60:
+            continue
+        if job_leases.missed(f"daily_sync_{schedule['id']}", scheduled_for):
+            print(f"Schedule {schedule['hour']:02d}:{schedule['minute']:02d} was missed, running it now.")
+            _run_schedule(schedule, scheduled_for, "Scheduled (missed)")
+
+def run_exclusive(job_id, func, *args):
+    """Runs a recurring job unless another instance sharing data/ is running it right now."""
+    with job_leases.exclusive(job_id) as lease:
+        if lease is not None:
+            func(*args)
+
+def prewarm_job(account_id=None):
+    """Prepares the sessions of an account a few minutes before its scheduled sync."""
+    if account_pool.is_running(account_id):
+        return
+    prewarm.warm_up(account_id)
+
+def _schedule_job(sid, hour, minute, account_id=None):
+    scheduler.add_job(
+        func=scheduled_sync_job,
+        trigger=CronTrigger(hour=hour, minute=minute),
+        args=[sid],
+        id=f'daily_sync_{sid}',
+        name=f'daily_sync_job_{sid}',
+        replace_existing=True
+    )
+    if config.PREWARM_MINUTES:
+        warm_hour, warm_minute = prewarm.warm_time(hour, minute)
+        scheduler.add_job(
+            func=prewarm_job,
+            trigger=CronTrigger(hour=warm_hour, minute=warm_minute),
+            args=[account_id],
+            id=f'prewarm_{sid}',
+            name=f'prewarm_job_{sid}',
+            coalesce=True,
+            max_instances=1,
+            replace_existing=True
+        )
+
+def _unschedule_job(sid):
+    for job_id in (f'daily_sync_{sid}', f'prewarm_{sid}'):
+        job = scheduler.get_job(job_id)
+        if job:
+            job.remove()
+
+def probe_job():
+    """Probes every connected account for new Withings data and syncs the ones that have some."""
+    targets = [None] + [a['id'] for a in accounts.list_accounts() if a['enabled']]
+    for account_id in targets:
+        if account_pool.is_running(account_id):
+            continue
+        try:
+            result = asyncio.run(probe.check_for_changes(account_id))
+        except Exception as e:
+            print(f"Change probe failed{_account_label(account_id)}. Error type: {type(e).__name__}")
+            continue
+        if result is None:
+            continue
+
+        new_groups, checked_at, since = result
+        if not new_groups:
+            probe.mark_checked(account_id, checked_at)
+            continue
+
+        print(f"Change probe found {new_groups} new measurement group(s){_account_label(account_id)}, starting sync...")
+        # Every group changed since the last check, not only the latest weight / blood pressure
+        future = account_pool.submit(account_id, run_window_sync, account_id, since, None, "Auto (new data)")
+        if future is None:
+            continue
+        status, _ = future.result()
+        if status == "Success":
+            probe.mark_checked(account_id, checked_at)
+
+def _schedule_probe(minutes):
+    job = scheduler.get_job('change_probe')
+    if job:
+        job.remove()
+    if minutes:
+        scheduler.add_job(
+            func=run_exclusive,
+            args=['change_probe', probe_job],
+            trigger=IntervalTrigger(minutes=minutes),
+            id='change_probe',
+            name='change_probe_job',
+            coalesce=True,
+            max_instances=1,
+            replace_existing=True
+        )
 
-PUBLIC_ENDPOINTS = {'login', 'logout', 'static'}
+def run_window_sync(account_id, start_ts, end_ts, label="Withings Notification"):
+    """Syncs one time window for an account (end_ts None: up to now). Executed on the account pool."""
+    status, output = run_sync_logic(target_func=sync_historical.run_historical_sync,
+                                    start_ts=start_ts, end_ts=end_ts, account=account_id, resumable=False)
+    append_history(f"{label}{_account_label(account_id)} ({status})", output)
+    accounts.record_sync_result(account_id, status)
+    return status, output
+
+def run_notified_window(account_id, start_ts, end_ts):
+    future = account_pool.submit(account_id, run_window_sync, account_id, start_ts, end_ts)
+    if future is None:
+        return False
+    future.result()
+    return True
+
+notify_coalescer = withings_notify.NotificationCoalescer(scheduler, run_notified_window)
+
+def outbox_drain_job():
+    """Retries queued Garmin uploads that are due. Accounts with a running sync are skipped."""
+    if not outbox.due_entries(limit=1):
+        return
+    f = io.StringIO()
+    with capture_stdout(f):
+        sent, failed = outbox.drain(is_busy=account_pool.is_running)
+    if sent or failed:
+        status = "Success" if not failed else "Failed"
+        append_history(f"Retry Queue ({status})", f.getvalue())
+
+def run_backfill_step(plan):
+    """Runs one budgeted step of a drip backfill. Executed on the account pool."""
+    status, output = run_sync_logic(target_func=backfill.run_step, plan_id=plan['id'])
+    if output.strip():
+        append_history(f"Backfill #{plan['id']}{_account_label(plan['account_id'])} ({status})", output)
+    return status, output
+
+def backfill_job():
+    """Advances every active backfill plan that is inside its time window and has budget left."""
+    for plan in backfill.due_plans():
+        account_id = plan['account_id'] or None
+        # Daily syncs of the account go first; the plan continues on the next tick
+        if account_pool.is_running(account_id) or not backfill.allowance(plan):
+            continue
+        future = account_pool.submit_bulk(account_id, run_backfill_step, plan)
+        if future is not None:
+            future.result()
+
+def run_account_reconcile(account_id, label, log=None, **kwargs):
+    """
+    Reconciles one account with Garmin and records the result. Executed on the account pool.
+    log: background job whose live log receives the output.
+    """
+    f = io.StringIO()
+    with capture_stdout(f if log is None else _JobLog(log, f)):
+        try:
+            report = reconcile.run_reconcile(account=account_id, **kwargs)
+        except Exception as e:
+            print(f"Reconciliation Failed. Error type: {type(e).__name__}")
+            report = None
+    output = f.getvalue()
+    status = "Success" if report is not None and "Failed" not in output else "Failed"
+    append_history(f"{label}{_account_label(account_id)} ({status})", output)
+    return status, report, output
+
+def reconcile_job():
+    """Scheduled consistency check of every account."""
+    targets = [None] + [a['id'] for a in accounts.list_accounts() if a['enabled']]
+    for account_id in targets:
+        future = account_pool.submit_bulk(account_id, run_account_reconcile, account_id, "Consistency Check")
+        if future is not None:
+            future.result()
+
+def start_services():
+    """
+    Startup of the web server: database, scheduler and recurring jobs. Not done on import:
+    spawned sync workers import this module as __mp_main__ (see sync_worker), and must
+    neither interrupt running imports nor schedule anything.
+    """
+    init_db()
+    scheduler.start()
+    atexit.register(lambda: scheduler.shutdown())
+    print(f"DEBUG: Scheduler started with timezone: {local_tz}", flush=True)
+
+    scheduler.add_job(
+        func=run_exclusive,
+        args=['outbox_drain', outbox_drain_job],
+        trigger=IntervalTrigger(minutes=max(1, config.OUTBOX_DRAIN_INTERVAL_MINUTES)),
+        id='outbox_drain',
+        name='outbox_drain_job',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+
+    scheduler.add_job(
+        func=run_exclusive,
+        args=['backfill', backfill_job],
+        trigger=IntervalTrigger(minutes=max(1, config.BACKFILL_TICK_MINUTES)),
+        id='backfill',
+        name='backfill_job',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+
+    if config.RECONCILE_INTERVAL_HOURS:
+        scheduler.add_job(
+            func=run_exclusive,
+            args=['reconcile', reconcile_job],
+            trigger=IntervalTrigger(hours=config.RECONCILE_INTERVAL_HOURS),
+            id='reconcile',
+            name='reconcile_job',
+            coalesce=True,
+            max_instances=1,
+            replace_existing=True
+        )
+
+    scheduler.add_job(
+        func=schedule_catchup_job,
+        trigger=IntervalTrigger(minutes=1),
+        id='schedule_catchup',
+        name='schedule_catchup_job',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+
+    # Restore schedule on startup
+    print("DEBUG: Attempting to restore schedules...", flush=True)
+    try:
+        schedules = get_schedules()
+        count = 0
+        for s in schedules:
+            if s.get('enabled'):
+                _schedule_job(s['id'], s['hour'], s['minute'], s.get('account_id'))
+                count += 1
+        print(f"DEBUG: Restored {count} schedules.", flush=True)
+        _schedule_probe(get_probe_interval())
+    except Exception as e:
+        print(f"DEBUG: Failed to restore schedule. Error type: {type(e).__name__}", flush=True)
+        # Don't exit, just continue without schedule
+
+PUBLIC_ENDPOINTS = {'login', 'logout', 'static', 'withings_webhook'}
 def get_app_version():
     changelog_path = os.path.join(os.path.dirname(__file__), "CHANGELOG.md")
     if os.path.exists(changelog_path):
@@ -456,7 +837,7 @@ def historical_page():
 def manual_entry_page():
     return render_template('manual.html', active_page='manual')
 
-def _run_sync_thread(days, **kwargs):
+def _run_sync_thread(days, account_id=None, **kwargs):
     global SYNC_PROGRESS
     
     # Callback to update granular progress
@@ -466,7 +847,10 @@ def _run_sync_thread(days, **kwargs):
         SYNC_PROGRESS['total'] = total
         SYNC_PROGRESS['message'] = "Syncing measurements..."
         
-    print(f"Starting background sync for {days} days")
+    if kwargs.get('resume'):
+        print("Resuming interrupted background sync")
+    else:
+        print(f"Starting background sync for {days} days")
     
     # Reset State
     SYNC_PROGRESS = {
@@ -484,14 +868,20 @@ def _run_sync_thread(days, **kwargs):
         days=days, 
         from_date=kwargs.get('from_date'),
         to_date=kwargs.get('to_date'),
+        resume=kwargs.get('resume', False),
+        account=account_id,
+        bulk=True,
         progress_callback=progress_callback
     )
     
     # Save to history
-    if kwargs.get('from_date'):
-        msg = f"Historical {kwargs.get('from_date')} to {kwargs.get('to_date')} ({status})"
+    label = _account_label(account_id)
+    if kwargs.get('resume'):
+        msg = f"Historical resume{label} ({status})"
+    elif kwargs.get('from_date'):
+        msg = f"Historical {kwargs.get('from_date')} to {kwargs.get('to_date')}{label} ({status})"
     else:
-        msg = f"Historical {days}d ({status})"
+        msg = f"Historical {days}d{label} ({status})"
         
     append_history(msg, output)
     
@@ -511,13 +901,255 @@ def run_historical_sync_endpoint():
     days = data.get('days', 30)
     from_date = data.get('from_date')
     to_date = data.get('to_date')
+    account_id = data.get('account_id')
     
-    # Start Thread
-    t = threading.Thread(target=_run_sync_thread, args=(days,), kwargs={'from_date': from_date, 'to_date': to_date})
-    t.start()
+    # Runs on the bulk lane: daily syncs and manual entries go first at group boundaries
+    if account_pool.submit_bulk(account_id, _run_sync_thread, days, account_id=account_id,
+                                from_date=from_date, to_date=to_date) is None:
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 400
     
     return jsonify({"status": "started", "message": "Sync started in background"})
 
+def _run_export_thread(path, account_id=None):
+    """Imports an uploaded Withings export archive (see withings_export), reporting through SYNC_PROGRESS."""
+    global SYNC_PROGRESS
+
+    def progress_callback(current, total):
+        SYNC_PROGRESS['current'] = current
+        SYNC_PROGRESS['total'] = total
+
+    SYNC_PROGRESS = {
+        "status": "running",
+        "current": 0,
+        "total": 0,
+        "message": "Reading the export...",
+        "log": ""
+    }
+    try:
+        status, output = run_sync_logic(
+            withings_export.run_export_import,
+            progress_dict=SYNC_PROGRESS,
+            path=path,
+            account=account_id,
+            bulk=True,
+            progress_callback=progress_callback
+        )
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    append_history(f"Withings export import{_account_label(account_id)} ({status})", output)
+    SYNC_PROGRESS['status'] = status
+    SYNC_PROGRESS['log'] = output
+
+@app.route('/historical/export', methods=['POST'])
+def import_withings_export_endpoint():
+    """Imports a Withings data export archive (zip) without calling the Withings API."""
+    if SYNC_PROGRESS['status'] == 'running':
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 400
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({"status": "error", "message": "No file uploaded."}), 400
+
+    import_dir = os.path.join(DATA_DIR, 'imports')
+    os.makedirs(import_dir, exist_ok=True)
+    path = os.path.join(import_dir, f"{secrets.token_hex(8)}.zip")
+    upload.save(path)
+
+    account_id = request.form.get('account_id', type=int)
+    if account_pool.submit_bulk(account_id, _run_export_thread, path, account_id) is None:
+        os.remove(path)
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 400
+    return jsonify({"status": "started", "message": "Export import started in background"})
+
+@app.route('/historical/checkpoint', methods=['GET'])
+def get_historical_checkpoint():
+    pending = checkpoints.latest_resumable(request.args.get('account_id', type=int))
+    if not pending:
+        return jsonify({"resumable": False})
+    resume_from = pending['last_date'] + 1 if pending['last_date'] else pending['start_ts']
+    return jsonify({
+        "resumable": True,
+        "processed": pending['processed'],
+        "resume_from": datetime.fromtimestamp(resume_from).strftime("%Y-%m-%d %H:%M"),
+        "end": datetime.fromtimestamp(pending['end_ts']).strftime("%Y-%m-%d")
+    })
+
+@app.route('/historical/resume', methods=['POST'])
+def resume_historical_sync_endpoint():
+    if SYNC_PROGRESS['status'] == 'running':
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 400
+    account_id = (request.get_json(silent=True) or {}).get('account_id')
+    if not checkpoints.latest_resumable(account_id):
+        return jsonify({"status": "error", "message": "No interrupted sync to resume."}), 404
+
+    if account_pool.submit_bulk(account_id, _run_sync_thread, None, account_id=account_id, resume=True) is None:
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 400
+
+    return jsonify({"status": "started", "message": "Resuming sync in background"})
+
+class _JobLog:
+    """stdout target appending to a background job's live log (and to `copy`, if given)."""
+    def __init__(self, job, copy=None):
+        self.job = job
+        self.copy = copy
+    def write(self, s):
+        self.job['log'] += s
+        if self.copy is not None:
+            self.copy.write(s)
+    def flush(self):
+        pass
+
+def _start_background_job(account_id, func, *args, **kwargs):
+    """
+    Runs func(job, *args, **kwargs) -> (status, result, output) on the bulk lane of the account.
+    Returns the job id, or None if the account is busy. `job` is the dict GET /jobs/<job_id> returns.
+    """
+    now = time.time()
+    for job_id, job in list(BACKGROUND_JOBS.items()):
+        if job['finished_at'] and now - job['finished_at'] > BACKGROUND_JOB_TTL_SECONDS:
+            BACKGROUND_JOBS.pop(job_id, None)
+
+    job_id = secrets.token_hex(8)
+    job = {"id": job_id, "status": "running", "current": 0, "total": 0, "message": "", "log": "",
+           "result": None, "finished_at": None}
+
+    def run():
+        try:
+            status, result, output = func(job, *args, **kwargs)
+        except Exception as e:
+            status, result, output = "Failed", None, job['log'] + f"\nError type: {type(e).__name__}"
+        job.update(result=result, log=output, finished_at=time.time())
+        job['status'] = status
+
+    BACKGROUND_JOBS[job_id] = job
+    if account_pool.submit_bulk(account_id, run) is None:
+        BACKGROUND_JOBS.pop(job_id, None)
+        return None
+    return job_id
+
+def _run_plan_job(job, **kwargs):
+    """Builds a sync plan, reporting the groups read so far through the job."""
+    def progress_callback(current, total):
+        job['current'] = current
+        job['total'] = total
+
+    job['message'] = "Building sync plan..."
+    with capture_stdout(_JobLog(job)):
+        try:
+            plan = sync_historical.run_historical_sync(plan=True, progress_callback=progress_callback, **kwargs)
+        except Exception as e:
+            print(f"Error: {e}")
+            plan = None
+    return ("Success" if plan is not None else "Failed"), plan, job['log']
+
+@app.route('/historical/plan', methods=['POST'])
+def plan_historical_sync_endpoint():
+    """Dry run of a historical sync in the background: poll GET /jobs/<job_id> for the plan. Uploads nothing."""
+    data = request.json or {}
+    job_id = _start_background_job(
+        None, _run_plan_job,
+        days=data.get('days', 30),
+        from_date=data.get('from_date'),
+        to_date=data.get('to_date'),
+        resume=data.get('resume', False)
+    )
+    if job_id is None:
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 409
+    return jsonify({"status": "started", "job_id": job_id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_background_job(job_id):
+    job = BACKGROUND_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown or expired job."}), 404
+    return jsonify(job)
+
+def _run_reconcile_job(job, account_id, **kwargs):
+    job['message'] = "Comparing with Garmin..."
+    return run_account_reconcile(account_id, "Consistency Check", log=job, **kwargs)
+
+@app.route('/reconcile', methods=['POST'])
+def reconcile_endpoint():
+    """
+    Compares a range with Garmin day by day and uploads what is missing (dry_run: report only).
+    Runs in the background: poll GET /jobs/<job_id> for the report.
+    """
+    data = request.json or {}
+    account_id = data.get('account_id')
+    job_id = _start_background_job(
+        account_id, _run_reconcile_job, account_id,
+        days=data.get('days'), from_date=data.get('from_date'), to_date=data.get('to_date'),
+        refresh=bool(data.get('refresh')), dry_run=bool(data.get('dry_run'))
+    )
+    if job_id is None:
+        return jsonify({"status": "Failed", "output": "A sync is already running."}), 409
+    return jsonify({"status": "started", "job_id": job_id}), 202
+
+def _stream_and_remove(path, chunk_size=64 * 1024):
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+@app.route('/export')
+def export_history_endpoint():
+    """Streams the measurement history (format=csv|ndjson|parquet, optional from_date / to_date / account_id)."""
+    fmt = request.args.get('format', history_export.FORMAT_CSV)
+    if fmt not in history_export.FORMATS:
+        return jsonify({"status": "error", "message": f"Unknown format: {fmt}"}), 400
+    account_id = request.args.get('account_id', type=int)
+    try:
+        start_ts, end_ts = history_export.date_range(request.args.get('from_date'), request.args.get('to_date'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    filename = f"measurements.{fmt}"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    export_rows = history_export.rows(account_id, start_ts, end_ts)
+    if fmt == history_export.FORMAT_PARQUET:
+        # Parquet is written to a temporary file (its footer comes last), then streamed
+        export_dir = os.path.join(DATA_DIR, 'exports')
+        os.makedirs(export_dir, exist_ok=True)
+        path = os.path.join(export_dir, f"{secrets.token_hex(8)}.parquet")
+        try:
+            history_export.write_parquet(export_rows, path)
+        except RuntimeError as e:
+            return jsonify({"status": "error", "message": str(e)}), 501
+        return Response(_stream_and_remove(path), mimetype=history_export.MIMETYPES[fmt], headers=headers)
+
+    stream = history_export.stream_csv if fmt == history_export.FORMAT_CSV else history_export.stream_ndjson
+    return Response(stream_with_context(stream(export_rows)), mimetype=history_export.MIMETYPES[fmt], headers=headers)
+
+@app.route('/api/trends')
+def trends_endpoint():
+    """
+    Weight, fat ratio and blood pressure series (with rolling averages) from the local trend
+    cache, downsampled to `points` per series. Range: from_date / to_date or the last `days` (default 365).
+    """
+    account_id = request.args.get('account_id', type=int)
+    points = min(max(request.args.get('points', config.TREND_POINTS, type=int), 3), 5000)
+    method = request.args.get('method', timeseries.METHOD_LTTB)
+    if method not in timeseries.METHODS:
+        return jsonify({"status": "error", "message": f"Unknown method: {method}"}), 400
+    try:
+        if request.args.get('from_date') or request.args.get('to_date'):
+            start_ts, end_ts = history_export.date_range(request.args.get('from_date'), request.args.get('to_date'))
+        else:
+            end_ts = int(time.time())
+            start_ts = end_ts - request.args.get('days', 365, type=int) * 86400
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    result = timeseries.trends(account_id, start_ts, end_ts, points=points, method=method)
+    result.update({"start": start_ts, "end": end_ts, "points": points, "method": method})
+    return jsonify(result)
+
 @app.route('/progress')
 def get_progress():
     return jsonify(SYNC_PROGRESS)
@@ -528,10 +1160,10 @@ def run_sync():
     # For now, let's allow them to overlap or fail naturally, but ideally we should lock.
     # But simple is fine.
     
-    status, output = run_sync_logic(sync_app.main)
-    
-    # Save to history
-    append_history(f"Manual ({status})", output)
+    future = account_pool.submit(None, run_account_sync, None, "Manual")
+    if future is None:
+        return jsonify({"status": "Failed", "output": "A sync is already running."}), 409
+    status, output = future.result()
     
     return jsonify({"status": status, "output": output})
 
@@ -551,11 +1183,7 @@ def run_manual_sync():
         # Handle Unit Conversion
         unit = data.get('selected_unit', 'kg')
         if unit == 'lbs':
-            # 1 lb = 0.45359237 kg
-            lb_to_kg = 0.45359237
-            weight *= lb_to_kg
-            if muscle_mass: muscle_mass *= lb_to_kg
-            if bone_mass: bone_mass *= lb_to_kg
+            weight, muscle_mass, bone_mass = sync_app.masses_to_kg(unit, weight, muscle_mass, bone_mass)
             print(f"Converted lbs to kg: Weight={weight:.2f}")
         
         # If hydration is mass and weight is provided, convert to % for Garmin?
@@ -570,8 +1198,8 @@ def run_manual_sync():
         # but the UI will show a loading spinner.
         
         f = io.StringIO()
-        with contextlib.redirect_stdout(f):
-            sync_app.upload_manual_data(
+        with capture_stdout(f), priority.GATE.interactive():
+            uploaded = sync_app.upload_manual_data(
                 weight=weight,
                 fat_ratio=fat_ratio,
                 muscle_mass=muscle_mass,
@@ -580,7 +1208,7 @@ def run_manual_sync():
                 bmi=bmi,
                 timestamp=timestamp
             )
-        status = "Success"
+        status = "Success" if uploaded else "Queued"
         output = f.getvalue() or "Manual sync successful."
         append_history(f"Manual Entry ({status})", output)
         
@@ -591,6 +1219,69 @@ def run_manual_sync():
         append_history("Manual Entry (Failed)", error_msg)
         return jsonify({"status": "Failed", "output": error_msg}), 500
 
+def _run_import_job(path, fmt, unit, dry_run):
+    """Runs a bulk manual import on the bulk lane and removes the uploaded file afterwards."""
+    global IMPORT_PROGRESS
+
+    def progress_callback(current, total):
+        IMPORT_PROGRESS['current'] = current
+        IMPORT_PROGRESS['total'] = total
+
+    IMPORT_PROGRESS = {
+        "status": "running",
+        "current": 0,
+        "total": 0,
+        "message": "Importing measurements...",
+        "log": ""
+    }
+    try:
+        status, output = run_sync_logic(
+            bulk_import.run_import,
+            progress_dict=IMPORT_PROGRESS,
+            path=path,
+            fmt=fmt,
+            unit=unit,
+            dry_run=dry_run,
+            progress_callback=progress_callback
+        )
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    append_history(f"Manual Import{' (dry run)' if dry_run else ''} ({status})", output)
+    IMPORT_PROGRESS['status'] = status
+    IMPORT_PROGRESS['log'] = output
+
+@app.route('/manual/import', methods=['POST'])
+def run_manual_import():
+    """Uploads a CSV / JSON file of measurements in the background (see bulk_import)."""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({"status": "error", "message": "No file uploaded."}), 400
+    if IMPORT_PROGRESS['status'] == 'running':
+        return jsonify({"status": "error", "message": "An import is already running."}), 400
+
+    ext = os.path.splitext(upload.filename)[1].lower()
+    fmt = request.form.get('format') or bulk_import.detect_format(upload.filename)
+    unit = request.form.get('selected_unit', 'kg')
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
+
+    # Spooled to disk in chunks, the import then streams it row by row
+    import_dir = os.path.join(DATA_DIR, 'imports')
+    os.makedirs(import_dir, exist_ok=True)
+    path = os.path.join(import_dir, f"{secrets.token_hex(8)}{ext}")
+    upload.save(path)
+
+    if account_pool.submit_bulk(None, _run_import_job, path, fmt, unit, dry_run) is None:
+        os.remove(path)
+        return jsonify({"status": "error", "message": "A sync job is already running."}), 400
+    return jsonify({"status": "started", "message": "Import started in background"})
+
+@app.route('/manual/import/progress')
+def get_import_progress():
+    return jsonify(IMPORT_PROGRESS)
+
 @app.route('/schedule', methods=['GET'])
 def get_schedule_endpoint():
     schedules = get_schedules()
@@ -599,24 +1290,190 @@ def get_schedule_endpoint():
         "schedules": schedules
     })
 
+@app.route('/schedule/runs', methods=['GET'])
+def get_schedule_runs_endpoint():
+    """Recent scheduled runs with the instance that ran them (several instances may share data/)."""
+    return jsonify({"instance": job_leases.INSTANCE_ID, "runs": job_leases.recent_runs()})
+
+@app.route('/webhook/withings', methods=['GET', 'HEAD', 'POST'])
+def withings_webhook():
+    # Withings checks that the callback URL answers with a HEAD/GET request when subscribing
+    if request.method != 'POST':
+        return "", 200
+
+    if config.WITHINGS_NOTIFY_SECRET and not hmac.compare_digest(
+            request.args.get('secret', ''), config.WITHINGS_NOTIFY_SECRET):
+        return "", 403
+
+    notification = withings_notify.parse_notification(request.form)
+    if notification is None:
+        return "", 400
+    if notification['appli'] not in withings_notify.SYNC_APPLIS:
+        return "", 200
+
+    settings = withings_notify.find_account(notification['userid'])
+    if settings is None:
+        print("Withings notification ignored: no connected account matches its user.")
+        return "", 200
+
+    # Answer right away; the sync runs once the notifications settle
+    notify_coalescer.add(settings['id'], notification['startdate'], notification['enddate'])
+    return "", 200
+
+def _notify_callback_url(data):
+    callback_url = data.get('callback_url') or request.url_root + 'webhook/withings'
+    if config.WITHINGS_NOTIFY_SECRET and 'secret=' not in callback_url:
+        callback_url += ('&' if '?' in callback_url else '?') + 'secret=' + config.WITHINGS_NOTIFY_SECRET
+    return callback_url
+
+@app.route('/webhook/withings/subscriptions', methods=['GET'])
+def list_withings_subscriptions():
+    account_id = request.args.get('account', type=int)
+    try:
+        profiles = withings_notify.list_subscriptions(account_id)
+    except Exception as e:
+        return jsonify({"message": f"Failed. Error type: {type(e).__name__}"}), 500
+    return jsonify({"subscriptions": profiles, "pending": len(notify_coalescer.pending())})
+
+@app.route('/webhook/withings/subscribe', methods=['POST'])
+def subscribe_withings_notifications():
+    data = request.json or {}
+    try:
+        withings_notify.subscribe(data.get('account_id'), _notify_callback_url(data))
+    except Exception as e:
+        return jsonify({"message": f"Failed. Error type: {type(e).__name__}"}), 500
+    return jsonify({"message": "Subscribed to Withings notifications"})
+
+@app.route('/webhook/withings/revoke', methods=['POST'])
+def revoke_withings_notifications():
+    data = request.json or {}
+    try:
+        withings_notify.revoke(data.get('account_id'), _notify_callback_url(data))
+    except Exception as e:
+        return jsonify({"message": f"Failed. Error type: {type(e).__name__}"}), 500
+    return jsonify({"message": "Withings notifications revoked"})
+
+@app.route('/outbox', methods=['GET'])
+def list_outbox():
+    status = request.args.get('status')
+    return jsonify({"counts": outbox.counts(), "entries": outbox.list_entries(status)})
+
+@app.route('/outbox/drain', methods=['POST'])
+def drain_outbox_endpoint():
+    f = io.StringIO()
+    with capture_stdout(f):
+        sent, failed = outbox.drain(is_busy=account_pool.is_running)
+    return jsonify({"sent": sent, "failed": failed, "output": f.getvalue()})
+
+@app.route('/outbox/<int:entry_id>/retry', methods=['POST'])
+def retry_outbox_entry(entry_id):
+    if not outbox.retry(entry_id):
+        return jsonify({"message": "Entry not found"}), 404
+    return jsonify({"message": "Entry queued for retry"})
+
+@app.route('/outbox/<int:entry_id>', methods=['DELETE'])
+def delete_outbox_entry(entry_id):
+    if not outbox.delete(entry_id):
+        return jsonify({"message": "Entry not found"}), 404
+    return jsonify({"message": "Entry deleted"})
+
+@app.route('/backfill', methods=['GET'])
+def list_backfills():
+    plans = backfill.list_plans(request.args.get('status'))
+    for plan in plans:
+        plan['allowance'] = backfill.allowance(plan) if plan['status'] == backfill.STATUS_ACTIVE else 0
+        plan['in_window'] = backfill.in_window(plan)
+    return jsonify({"plans": plans})
+
+@app.route('/backfill', methods=['POST'])
+def create_backfill():
+    data = request.json or {}
+    try:
+        # UTC days, like the backfill CLI and historical syncs
+        start_ts, end_ts = backfill.date_range(data.get('from_date'), data.get('to_date'), data.get('days', 365))
+        plan_id = backfill.create(
+            start_ts, end_ts, account=data.get('account_id'),
+            hourly_budget=data.get('hourly_budget'), daily_budget=data.get('daily_budget'),
+            window_start=data.get('window_start'), window_end=data.get('window_end')
+        )
+    except (ValueError, TypeError) as e:
+        return jsonify({"message": f"Invalid backfill: {e}"}), 400
+    return jsonify({"message": "Backfill created", "plan": backfill.get(plan_id)})
+
+@app.route('/backfill/<int:plan_id>/pause', methods=['POST'])
+def pause_backfill(plan_id):
+    if not backfill.set_status(plan_id, backfill.STATUS_PAUSED):
+        return jsonify({"message": "Backfill not found"}), 404
+    return jsonify({"message": "Backfill paused"})
+
+@app.route('/backfill/<int:plan_id>/resume', methods=['POST'])
+def resume_backfill(plan_id):
+    if not backfill.set_status(plan_id, backfill.STATUS_ACTIVE):
+        return jsonify({"message": "Backfill not found"}), 404
+    return jsonify({"message": "Backfill resumed"})
+
+@app.route('/backfill/<int:plan_id>', methods=['DELETE'])
+def delete_backfill(plan_id):
+    if not backfill.delete(plan_id):
+        return jsonify({"message": "Backfill not found"}), 404
+    return jsonify({"message": "Backfill deleted"})
+
+@app.route('/sinks', methods=['GET'])
+def list_sinks():
+    """Ledger summary of the extra sinks (sent / failed records per sink)."""
+    return jsonify({"sinks": sinks.summary()})
+
+@app.route('/breakers', methods=['GET'])
+def list_breakers():
+    return jsonify({"breakers": [breaker.status() for breaker in circuit_breaker.BREAKERS.values()]})
+
+@app.route('/breakers/<name>/reset', methods=['POST'])
+def reset_breaker(name):
+    breaker = circuit_breaker.BREAKERS.get(name)
+    if not breaker:
+        return jsonify({"message": "Unknown service"}), 404
+    breaker.reset()
+    return jsonify({"message": f"{breaker.label} circuit closed"})
+
+@app.route('/probe', methods=['GET'])
+def get_probe_endpoint():
+    job = scheduler.get_job('change_probe')
+    return jsonify({
+        "interval_minutes": get_probe_interval(),
+        "next_run": job.next_run_time.strftime("%Y-%m-%d %H:%M:%S") if job and job.next_run_time else None
+    })
+
+@app.route('/probe', methods=['POST'])
+def set_probe_endpoint():
+    data = request.json or {}
+    try:
+        minutes = int(data.get('interval_minutes') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"message": "Invalid interval"}), 400
+    if minutes < 0:
+        return jsonify({"message": "Invalid interval"}), 400
+
+    set_probe_interval(minutes)
+    _schedule_probe(minutes)
+    if minutes:
+        return jsonify({"message": f"Checking Withings for new data every {minutes} minute(s)"})
+    return jsonify({"message": "New-data checks disabled"})
+
 @app.route('/schedule', methods=['POST'])
 def add_schedule_endpoint():
     data = request.json
     h = data.get('hour')
     m = data.get('minute')
+    account_id = data.get('account_id')
     
     if h is None or m is None:
         return jsonify({"message": "Invalid time"}), 400
+
+    if account_id and not accounts.get_account(account_id):
+        return jsonify({"message": "Account not found"}), 404
         
-    sid = add_schedule(h, m)
-    
-    scheduler.add_job(
-        func=scheduled_sync_job,
-        trigger=CronTrigger(hour=h, minute=m),
-        id=f'daily_sync_{sid}',
-        name=f'daily_sync_job_{sid}',
-        replace_existing=True
-    )
+    sid = add_schedule(h, m, account_id)
+    _schedule_job(sid, h, m, account_id)
     
     return jsonify({"message": f"Scheduled daily sync at {h:02d}:{m:02d}", "id": sid})
 
@@ -628,21 +1485,23 @@ def remove_schedule_endpoint():
     if not sid:
         return jsonify({"message": "Schedule ID required"}), 400
 
-    job_id = f'daily_sync_{sid}'
-    job = scheduler.get_job(job_id)
-    if job:
-        job.remove()
-    
+    _unschedule_job(sid)
     delete_schedule(sid)
         
     return jsonify({"message": "Schedule removed"})
 
 @app.route('/auth/withings/login')
 def auth_withings_login():
-    if not WITHINGS_CLIENT_ID or not WITHINGS_CLIENT_SECRET:
+    account_id = request.args.get('account', type=int)
+    try:
+        settings = accounts.resolve(account_id)
+    except Exception:
+        return "Error: Account not found.", 404
+
+    if not settings['withings_client_id'] or not settings['withings_client_secret']:
         return "Error: Withings Credentials not found in environment.", 500
         
-    redirect_uri = WITHINGS_REDIRECT_URI
+    redirect_uri = settings['withings_redirect_uri']
     
     # Dynamic Redirect URI Logic:
     # If the configured URI is localhost (default) but the user is accessing via a different host (IP/Domain),
@@ -654,8 +1513,9 @@ def auth_withings_login():
         redirect_uri = request.url_root + 'auth/withings/callback'
         print(f"DEBUG: Using dynamic redirect URI: {redirect_uri}", flush=True)
     
-    auth = sync_app.SimpleWithingsAuth(WITHINGS_CLIENT_ID, WITHINGS_CLIENT_SECRET, redirect_uri)
-    url = auth.get_authorize_url()
+    auth = sync_app.get_withings_auth(settings, redirect_uri)
+    # The state tells the callback which account's token store to write to
+    url = auth.get_authorize_url(state=f"account-{account_id}" if account_id else 'init_auth')
     
     return f"<script>window.location.href='{url}';</script>"
 
@@ -671,24 +1531,83 @@ def auth_withings_callback():
         return "<h1>Error</h1><p>No code returned.</p><a href='/'>Back</a>"
         
     try:
-        redirect_uri = WITHINGS_REDIRECT_URI
+        state = request.args.get('state') or ''
+        account_id = int(state.split('-', 1)[1]) if state.startswith('account-') else None
+        settings = accounts.resolve(account_id)
+        redirect_uri = settings['withings_redirect_uri']
         
         # Mirror the dynamic logic from login to ensure matching URI for token exchange
         if 'localhost' in redirect_uri and 'localhost' not in request.host:
              redirect_uri = request.url_root + 'auth/withings/callback'
              print(f"DEBUG: Using dynamic redirect URI for callback: {redirect_uri}", flush=True)
 
-        auth = sync_app.SimpleWithingsAuth(WITHINGS_CLIENT_ID, WITHINGS_CLIENT_SECRET, redirect_uri)
+        auth = sync_app.get_withings_auth(settings, redirect_uri)
         token_data = auth.get_credentials(code)
         
         # Save credentials using sync_app's helper
-        sync_app.save_credentials(token_data)
+        sync_app.save_credentials(token_data, settings['token_file'])
+        # A (re)connected Withings user may have a different height history
+        height_series.invalidate(account_id)
         
         return "<h1>Success!</h1><p>Withings connected successfully.</p><script>setTimeout(function(){window.location.href='/';}, 2000);</script>"
         
     except Exception as e:
         return f"<h1>Setup Failed</h1><p>Error type: {type(e).__name__}</p><a href='/'>Back</a>"
 
+@app.route('/accounts', methods=['GET'])
+def list_accounts_endpoint():
+    result = []
+    for account in accounts.list_accounts():
+        view = accounts.public_view(account)
+        view['running'] = account_pool.is_running(account['id'])
+        result.append(view)
+    return jsonify({"accounts": result, "max_workers": config.MAX_SYNC_WORKERS})
+
+@app.route('/accounts', methods=['POST'])
+def add_account_endpoint():
+    data = request.json or {}
+    if not data.get('name'):
+        return jsonify({"message": "Account name is required"}), 400
+    account_id = accounts.add_account(data)
+    return jsonify({"message": f"Account '{data['name']}' added", "id": account_id})
+
+@app.route('/accounts/<int:account_id>', methods=['PUT'])
+def update_account_endpoint(account_id):
+    if not accounts.get_account(account_id):
+        return jsonify({"message": "Account not found"}), 404
+    accounts.update_account(account_id, request.json or {})
+    return jsonify({"message": "Account updated"})
+
+@app.route('/accounts/<int:account_id>', methods=['DELETE'])
+def delete_account_endpoint(account_id):
+    if not accounts.get_account(account_id):
+        return jsonify({"message": "Account not found"}), 404
+
+    for s in get_schedules():
+        if s.get('account_id') == account_id:
+            _unschedule_job(s['id'])
+            delete_schedule(s['id'])
+
+    accounts.delete_account(account_id)
+    return jsonify({"message": "Account removed"})
+
+@app.route('/accounts/<int:account_id>/sync', methods=['POST'])
+def sync_account_endpoint(account_id):
+    if not accounts.get_account(account_id):
+        return jsonify({"message": "Account not found"}), 404
+    future = account_pool.submit(account_id, run_account_sync, account_id, "Manual")
+    if future is None:
+        return jsonify({"status": "error", "message": "A sync for this account is already running."}), 409
+    return jsonify({"status": "started", "message": "Sync queued"})
+
+@app.route('/accounts/sync-all', methods=['POST'])
+def sync_all_accounts_endpoint():
+    started = []
+    for account in accounts.list_accounts():
+        if account.get('enabled') and account_pool.submit(account['id'], run_account_sync, account['id'], "Manual"):
+            started.append(account['id'])
+    return jsonify({"status": "started", "accounts": started})
+
 @app.route('/config/withings', methods=['POST'])
 def save_withings_config():
     client_id = request.form.get('client_id')
@@ -766,133 +1685,52 @@ def _persist_garmin_creds(email, password):
     GARMIN_EMAIL = email
     GARMIN_PASSWORD = password
 
-def garmin_login_thread(email, password):
-    global GARMIN_AUTH_SESSION
-    
-    def prompt_mfa():
-        if not GARMIN_AUTH_SESSION: return ""
-        GARMIN_AUTH_SESSION['status'] = 'mfa_waiting'
-        GARMIN_AUTH_SESSION['mfa_wait_event'].set() # Signal main thread that we are waiting
-        
-        # Wait for user input
-        got_code = GARMIN_AUTH_SESSION['mfa_event'].wait(timeout=120) # 2 mins to enter code
-        if not got_code or not GARMIN_AUTH_SESSION.get('mfa_code'):
-             raise Exception("MFA Timed out")
-        return GARMIN_AUTH_SESSION['mfa_code']
-
-    try:
-        # We use a custom tokenstore location to ensure persistence across reboots/container recreations if mapped
-        token_dir = os.path.join(DATA_DIR, '.garminconnect')
-        
-        # Ensure directory exists, otherwise GarminConnect might fail to read/write
-        if not os.path.exists(token_dir):
-            try:
-                os.makedirs(token_dir, exist_ok=True)
-            except Exception as e:
-                print(f"Error creating token dir: {e}") 
-
-        g = Garmin(email, password, prompt_mfa=prompt_mfa)
-        
-        try:
-            g.login(tokenstore=token_dir)
-        except Exception:
-            try:
-                for f in os.listdir(token_dir):
-                    fp = os.path.join(token_dir, f)
-                    if os.path.isfile(fp):
-                        os.unlink(fp)
-            except Exception:
-                pass
-            g.login(tokenstore=token_dir)
-        
-        GARMIN_AUTH_SESSION['result'] = {'success': True}
-    except Exception as e:
-        if GARMIN_AUTH_SESSION:
-            GARMIN_AUTH_SESSION['result'] = {'success': False, 'error': str(e)}
-        # also signal wait event just in case it failed before mfa
-        if GARMIN_AUTH_SESSION:
-             GARMIN_AUTH_SESSION['mfa_wait_event'].set() 
-        
-    if GARMIN_AUTH_SESSION:
-        GARMIN_AUTH_SESSION['result_event'].set()
-
 @app.route('/config/garmin', methods=['POST'])
 def save_garmin_config():
-    global GARMIN_AUTH_SESSION
-    
+    """Starts a Garmin login in the background; poll /config/garmin/login/<session_id> for its state."""
     email = request.form.get('email')
     password = request.form.get('password')
-    mfa_code = request.form.get('mfa_code')
-    
-    if not email: # Password might be empty if already saved? No, we require it currently.
-        return jsonify({"message": "Email is required"}), 400
-
-    # CASE 1: MFA Code provided -> Existing session expected
-    if mfa_code:
-        if not GARMIN_AUTH_SESSION or GARMIN_AUTH_SESSION['status'] != 'mfa_waiting':
-            return jsonify({"message": "Session expired or invalid. Please try again."}), 400
-            
-        # Pass the code to the waiting thread
-        GARMIN_AUTH_SESSION['mfa_code'] = mfa_code
-        GARMIN_AUTH_SESSION['mfa_event'].set()
-        
-        # Wait for result
-        got_result = GARMIN_AUTH_SESSION['result_event'].wait(timeout=20)
-        
-        if not got_result:
-             GARMIN_AUTH_SESSION = None
-             return jsonify({"message": "Timeout waiting for Garmin verification."}), 500
-             
-        res = GARMIN_AUTH_SESSION['result']
-        if res.get('success'):
-             _persist_garmin_creds(email, password)
-             GARMIN_AUTH_SESSION = None
-             return jsonify({"message": "Garmin Connected Successfully!"})
-        else:
-             GARMIN_AUTH_SESSION = None
-             return jsonify({"message": f"Login Failed: {res.get('error')}"}), 400
-
-    # CASE 2: No MFA Code -> Start Login
-    if GARMIN_AUTH_SESSION and GARMIN_AUTH_SESSION['status'] == 'mfa_waiting':
-        # User might be retrying or something? Reset session.
-        GARMIN_AUTH_SESSION = None
 
+    if not email:
+        return jsonify({"message": "Email is required"}), 400
     if not password:
-         return jsonify({"message": "Password is required"}), 400
-
-    GARMIN_AUTH_SESSION = {
-        'mfa_event': threading.Event(),
-        'mfa_wait_event': threading.Event(),
-        'result_event': threading.Event(),
-        'status': 'init',
-        'result': None,
-        'mfa_code': None
-    }
-    
-    t = threading.Thread(target=garmin_login_thread, args=(email, password))
-    t.daemon = True # ensure it doesn't block shutdown
-    t.start()
-    
-    # Wait up to 20 seconds for something to happen
-    start = time.time()
-    while time.time() - start < 20:
-        if GARMIN_AUTH_SESSION['status'] == 'mfa_waiting':
-            return jsonify({"mfa_required": True})
-        
-        if GARMIN_AUTH_SESSION['result_event'].is_set():
-             # Finished
-             res = GARMIN_AUTH_SESSION['result']
-             if res.get('success'):
-                 _persist_garmin_creds(email, password)
-                 GARMIN_AUTH_SESSION = None
-                 return jsonify({"message": "Garmin Connected Successfully!"})
-             else:
-                 GARMIN_AUTH_SESSION = None
-                 return jsonify({"message": f"Login Failed: {res.get('error')}"}), 401
-        time.sleep(0.5)
-
-    GARMIN_AUTH_SESSION = None
-    return jsonify({"message": "Timeout connecting to Garmin (Backend)."}), 504
+        return jsonify({"message": "Password is required"}), 400
+
+    login = garmin_login.start(email, password, os.path.join(DATA_DIR, '.garminconnect'),
+                               on_success=_persist_garmin_creds)
+    return jsonify(login.state()), 202
+
+@app.route('/config/garmin/login/<session_id>', methods=['GET'])
+def garmin_login_state(session_id):
+    """Login state; with `since` (a version) waits up to `wait` seconds for the next change."""
+    login = garmin_login.get(session_id)
+    if not login:
+        return jsonify({"message": "Login session expired. Please try again."}), 404
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify(login.state())
+    return jsonify(login.wait(since, request.args.get('wait', garmin_login.MAX_WAIT_SECONDS, type=float)))
+
+@app.route('/config/garmin/login/<session_id>/mfa', methods=['POST'])
+def garmin_login_mfa(session_id):
+    login = garmin_login.get(session_id)
+    if not login:
+        return jsonify({"message": "Login session expired. Please try again."}), 404
+    mfa_code = (request.form.get('mfa_code') or (request.get_json(silent=True) or {}).get('mfa_code') or '').strip()
+    if not mfa_code:
+        return jsonify({"message": "Verification code is required"}), 400
+    try:
+        login.submit_mfa(mfa_code)
+    except garmin_login.LoginError as e:
+        return jsonify({"message": str(e)}), 409
+    return jsonify(login.state()), 202
+
+@app.route('/config/garmin/login/<session_id>', methods=['DELETE'])
+def garmin_login_cancel(session_id):
+    login = garmin_login.get(session_id)
+    if login:
+        login.cancel()
+    return jsonify({"message": "Login cancelled"})
 
 @app.route('/config/clear', methods=['POST'])
 def clear_all_credentials():
@@ -907,6 +1745,7 @@ def clear_all_credentials():
         withings_path = os.path.join(DATA_DIR, 'withings_tokens.pkl')
         if os.path.exists(withings_path):
             os.remove(withings_path)
+        height_series.invalidate()
             
         # Clear garmin tokens
         garmin_dir = os.path.join(DATA_DIR, '.garminconnect')
@@ -940,5 +1779,6 @@ def clear_all_credentials():
         return jsonify({"message": f"Error clearing credentials: {str(e)}"}), 500
 
 if __name__ == '__main__':
+    start_services()
     print("Starting server on 0.0.0.0:5000", flush=True)
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,316 @@
+"""
+Targets the synced measurements are written to.
+
+Garmin is always a sink (pipeline.GarminSink). SINKS adds more: a local CSV file, a
+local SQLite time series and an HTTP endpoint that receives every record as JSON. The
+pipeline hands each decoded and merged record to all sinks at once, so a single
+Withings fetch feeds every target.
+
+Every extra sink keeps a ledger of the records it was sent. Records a sink already has
+are skipped when a range is synced again. A failing sink only marks its own ledger
+entries as failed (they are sent again the next time that range is synced); Garmin and
+the other sinks carry on.
+
+The local trend cache (TimeseriesSink) is fed the same way and is always on.
+"""
+import asyncio
+import csv
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+import tzlocal
+
+import accounts
+import config
+import sync_engine
+import timeseries
+from measurements import VALUE_FIELDS
+
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+ROW_FIELDS = ('account_id', 'grpid', 'timestamp', 'datetime') + VALUE_FIELDS
+
+_db_ready = False
+
+
+def init_db(db_path=None):
+    with sqlite3.connect(db_path or accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS sink_ledger
+                     (sink TEXT NOT NULL,
+                      account_id INTEGER NOT NULL,
+                      grpid INTEGER NOT NULL,
+                      date INTEGER NOT NULL,
+                      status TEXT NOT NULL,
+                      error TEXT,
+                      updated_at INTEGER,
+                      PRIMARY KEY (sink, account_id, grpid))''')
+        conn.commit()
+
+
+def _ensure_db():
+    global _db_ready
+    if not _db_ready:
+        init_db()
+        _db_ready = True
+
+
+def record_row(record, account=None):
+    """The dict every extra sink receives for a record."""
+    row = {
+        'account_id': accounts._account_key(account),
+        'grpid': record.grpid,
+        'timestamp': record.date,
+        'datetime': datetime.fromtimestamp(record.date, timezone.utc).astimezone(tzlocal.get_localzone()).isoformat(),
+    }
+    for field in VALUE_FIELDS:
+        row[field] = getattr(record, field)
+    return row
+
+
+# --- Sinks ---
+
+class Sink:
+    """
+    A target for synced records. open() runs once before the first record and close()
+    after the last; send() raises on failure.
+    """
+
+    name = None
+    # Sinks without a ledger get every record and keep track of what they have themselves
+    ledger = True
+
+    async def open(self):
+        pass
+
+    async def send(self, record, row, bp_duplicate=False):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+# Sinks writing to the same local file take turns, also across concurrent account syncs
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def _file_lock(path):
+    with _file_locks_lock:
+        return _file_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+class CsvSink(Sink):
+    """Appends every record to a CSV file (SINK_CSV_PATH)."""
+
+    name = 'csv'
+
+    def __init__(self, path=None):
+        self.path = path or config.SINK_CSV_PATH
+
+    def _append(self, row):
+        with _file_lock(self.path):
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=ROW_FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(row)
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+    async def send(self, record, row, bp_duplicate=False):
+        await sync_engine.run_blocking(self._append, row)
+
+
+class SqliteSink(Sink):
+    """Keeps every record in a SQLite table (SINK_SQLITE_PATH), one row per Withings group."""
+
+    name = 'sqlite'
+
+    def __init__(self, path=None):
+        self.path = path or config.SINK_SQLITE_PATH
+
+    def _init(self):
+        columns = ', '.join(f"{field} REAL" for field in VALUE_FIELDS)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS measurements
+                             (account_id INTEGER NOT NULL, grpid INTEGER NOT NULL, timestamp INTEGER NOT NULL,
+                              datetime TEXT, {columns}, PRIMARY KEY (account_id, grpid))''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_timestamp ON measurements (account_id, timestamp)")
+            conn.commit()
+
+    def _write(self, row):
+        with _file_lock(self.path), sqlite3.connect(self.path) as conn:
+            conn.execute(f"INSERT OR REPLACE INTO measurements ({', '.join(ROW_FIELDS)}) "
+                         f"VALUES ({', '.join('?' * len(ROW_FIELDS))})", [row[field] for field in ROW_FIELDS])
+            conn.commit()
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        await sync_engine.run_blocking(self._init)
+
+    async def send(self, record, row, bp_duplicate=False):
+        await sync_engine.run_blocking(self._write, row)
+
+
+class HttpSink(Sink):
+    """POSTs every record as JSON to SINK_HTTP_URL (with SINK_HTTP_TOKEN as a bearer token if set)."""
+
+    name = 'http'
+
+    def __init__(self, url=None, token=None):
+        self.url = url or config.SINK_HTTP_URL
+        self.token = token if token is not None else config.SINK_HTTP_TOKEN
+        self.session = None
+
+    async def open(self):
+        if not self.url:
+            raise ValueError("SINK_HTTP_URL is not set")
+        headers = {'Authorization': f"Bearer {self.token}"} if self.token else None
+        self.session = aiohttp.ClientSession(headers=headers,
+                                             timeout=aiohttp.ClientTimeout(total=config.SINK_HTTP_TIMEOUT))
+
+    async def send(self, record, row, bp_duplicate=False):
+        async with self.session.post(self.url, json=row) as response:
+            response.raise_for_status()
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+
+class TimeseriesSink(Sink):
+    """
+    Feeds the local trend cache (see timeseries). Always enabled; records are collected
+    and written in one go at the end of the sync.
+    """
+
+    name = 'timeseries'
+    ledger = False
+
+    def __init__(self, account=None):
+        self.account = account
+        self.records = []
+
+    async def send(self, record, row, bp_duplicate=False):
+        self.records.append((record.date, {column: getattr(record, column) for column in timeseries.COLUMNS}))
+
+    async def close(self):
+        if self.records:
+            await sync_engine.run_blocking(timeseries.extend, self.account, self.records)
+            self.records = []
+
+
+SINK_TYPES = {sink.name: sink for sink in (CsvSink, SqliteSink, HttpSink)}
+
+
+def configured():
+    """Instances of the extra sinks listed in SINKS."""
+    result = []
+    for name in config.SINKS:
+        sink_type = SINK_TYPES.get(name)
+        if sink_type is None:
+            print(f"Warning: Unknown sink '{name}' in SINKS, ignoring it.")
+            continue
+        result.append(sink_type())
+    return result
+
+
+# --- Ledger ---
+
+def _delivered(sink_name, account, grpid):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM sink_ledger WHERE sink=? AND account_id=? AND grpid=? AND status=?",
+                  (sink_name, accounts._account_key(account), grpid, STATUS_SENT))
+        return c.fetchone() is not None
+
+
+def _record(sink_name, account, record, status, error=None):
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO sink_ledger (sink, account_id, grpid, date, status, error, updated_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (sink_name, accounts._account_key(account), record.grpid, record.date, status, error, int(time.time())))
+        conn.commit()
+
+
+def summary():
+    """Ledger counts per sink and status, with the latest error of each sink."""
+    _ensure_db()
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT sink, status, COUNT(*), MAX(updated_at) FROM sink_ledger GROUP BY sink, status")
+        result = {}
+        for sink_name, status, count, updated_at in c.fetchall():
+            entry = result.setdefault(sink_name, {'enabled': sink_name in config.SINKS})
+            entry[status] = count
+            entry['updated_at'] = max(entry.get('updated_at') or 0, updated_at or 0)
+        c.execute('''SELECT sink, error FROM sink_ledger WHERE status=? AND error IS NOT NULL
+                     ORDER BY updated_at DESC''', (STATUS_FAILED,))
+        for sink_name, error in c.fetchall():
+            result[sink_name].setdefault('last_error', error)
+    for name in config.SINKS:
+        if name in SINK_TYPES:
+            result.setdefault(name, {'enabled': True})
+    return result
+
+
+class FanOut:
+    """Sends records to the extra sinks concurrently; a failure stays with its sink."""
+
+    def __init__(self, sinks, account=None):
+        self.sinks = sinks
+        self.account = account
+
+    async def open(self):
+        opened = []
+        for sink in self.sinks:
+            try:
+                await sink.open()
+                opened.append(sink)
+            except Exception as e:
+                print(f"Warning: Sink '{sink.name}' is unavailable for this sync. Error type: {type(e).__name__}")
+        self.sinks = opened
+        extra = [sink.name for sink in opened if sink.ledger]
+        if extra:
+            print(f"Also writing measurements to: {', '.join(extra)}")
+
+    async def _send(self, sink, record, row):
+        try:
+            if not sink.ledger:
+                await sink.send(record, row)
+                return
+            if await sync_engine.run_blocking(_delivered, sink.name, self.account, record.grpid):
+                return
+            await sink.send(record, row)
+            await sync_engine.run_blocking(_record, sink.name, self.account, record, STATUS_SENT)
+        except Exception as e:
+            print(f"  Warning: Sink '{sink.name}' failed for this measurement. Error type: {type(e).__name__}")
+            try:
+                await sync_engine.run_blocking(_record, sink.name, self.account, record, STATUS_FAILED, type(e).__name__)
+            except Exception:
+                pass
+
+    async def send(self, record):
+        if not self.sinks:
+            return
+        row = record_row(record, self.account)
+        await asyncio.gather(*(self._send(sink, record, row) for sink in self.sinks))
+
+    async def close(self):
+        for sink in self.sinks:
+            try:
+                await sink.close()
+            except Exception as e:
+                if not sink.ledger:
+                    print(f"Warning: Sink '{sink.name}' could not be written. Error type: {type(e).__name__}")
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import asyncio
 import requests
 import json
 import pickle
@@ -8,7 +9,10 @@ import urllib.parse
 from datetime import datetime, timezone
 import tzlocal
 from config import WITHINGS_CLIENT_ID, WITHINGS_CLIENT_SECRET, WITHINGS_REDIRECT_URI, GARMIN_EMAIL, GARMIN_PASSWORD
-import config
+import accounts
+import circuit_breaker
+import outbox
+import sync_engine
 from garminconnect import Garmin
 
 # Ensure data directory exists
@@ -21,21 +25,24 @@ if not os.path.exists(DATA_DIR):
 
 TOKEN_FILE = os.path.join(DATA_DIR, "withings_tokens.pkl")
 
-def save_credentials(token_data):
+def save_credentials(token_data, token_file=TOKEN_FILE):
     """Saves the token data (dict) to a file."""
     try:
-        os.makedirs(os.path.dirname(TOKEN_FILE), exist_ok=True)
-        with open(TOKEN_FILE, 'wb') as f:
+        if token_data and 'expires_in' in token_data and 'expires_at' not in token_data:
+            # Remember when the access token expires so callers can skip needless refreshes
+            token_data['expires_at'] = int(time.time()) + int(token_data['expires_in'])
+        os.makedirs(os.path.dirname(token_file), exist_ok=True)
+        with open(token_file, 'wb') as f:
             pickle.dump(token_data, f)
         print("Credentials saved successfully.")
     except Exception as e:
         print(f"Error saving credentials. Error type: {type(e).__name__}")
 
-def load_credentials():
+def load_credentials(token_file=TOKEN_FILE):
     """Loads token data from file if it exists."""
-    if os.path.exists(TOKEN_FILE):
+    if os.path.exists(token_file):
         try:
-            with open(TOKEN_FILE, 'rb') as f:
+            with open(token_file, 'rb') as f:
                 return pickle.load(f)
         except Exception as e:
             print(f"Error loading credentials. Error type: {type(e).__name__}")
@@ -47,19 +54,20 @@ class SimpleWithingsAuth:
     """
     AUTH_URL = "https://account.withings.com/oauth2_user/authorize2"
     TOKEN_URL = "https://wbsapi.withings.net/v2/oauth2"
+    NOTIFY_URL = "https://wbsapi.withings.net/notify"
 
     def __init__(self, client_id, client_secret, redirect_uri):
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
 
-    def get_authorize_url(self):
+    def get_authorize_url(self, state='init_auth'):
         params = {
             'response_type': 'code',
             'client_id': self.client_id,
             'redirect_uri': self.redirect_uri,
             'scope': 'user.metrics,user.info,user.activity',
-            'state': 'init_auth'
+            'state': state
         }
         return f"{self.AUTH_URL}?{urllib.parse.urlencode(params)}"
 
@@ -102,8 +110,47 @@ class SimpleWithingsAuth:
         else:
             raise Exception(f"HTTP Error during refresh: {response.status_code}")
 
-def get_withings_credentials():
-    auth = SimpleWithingsAuth(config.WITHINGS_CLIENT_ID, config.WITHINGS_CLIENT_SECRET, config.WITHINGS_REDIRECT_URI)
+    def _notify_request(self, access_token, data):
+        headers = {'Authorization': f'Bearer {access_token}'}
+        response = requests.post(self.NOTIFY_URL, data=data, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"HTTP Error during notify request: {response.status_code}")
+        resp_json = response.json()
+        if resp_json.get('status') != 0:
+            raise Exception(f"Notify request failed. Status: {resp_json.get('status')}")
+        return resp_json.get('body') or {}
+
+    def subscribe_notifications(self, access_token, callback_url, appli, comment='grrminsync'):
+        """Asks Withings to POST to callback_url whenever data of the given appli changes."""
+        return self._notify_request(access_token, {
+            'action': 'subscribe',
+            'callbackurl': callback_url,
+            'appli': appli,
+            'comment': comment
+        })
+
+    def list_notifications(self, access_token, appli=None):
+        data = {'action': 'list'}
+        if appli:
+            data['appli'] = appli
+        return self._notify_request(access_token, data).get('profiles', [])
+
+    def revoke_notifications(self, access_token, callback_url, appli):
+        return self._notify_request(access_token, {
+            'action': 'revoke',
+            'callbackurl': callback_url,
+            'appli': appli
+        })
+
+def get_withings_auth(account=None, redirect_uri=None):
+    """Builds a SimpleWithingsAuth from the account's client credentials."""
+    settings = accounts.resolve(account)
+    return SimpleWithingsAuth(settings['withings_client_id'], settings['withings_client_secret'],
+                              redirect_uri or settings['withings_redirect_uri'])
+
+def get_withings_credentials(account=None):
+    settings = accounts.resolve(account)
+    auth = get_withings_auth(settings)
     
     authorize_url = auth.get_authorize_url()
     print(f"\nPlease visit this URL to authorize the app:\n{authorize_url}\n")
@@ -132,12 +179,13 @@ def get_withings_credentials():
         code = code_input
     
     token_data = auth.get_credentials(code)
-    save_credentials(token_data)
+    save_credentials(token_data, settings['token_file'])
     return token_data
 
-def authenticate_withings():
+def authenticate_withings(account=None):
     """Tries to load credentials, refreshing if necessary."""
-    token_data = load_credentials()
+    settings = accounts.resolve(account)
+    token_data = load_credentials(settings['token_file'])
     if token_data:
         print("Loaded saved credentials checking expiry/validity logic could be here...")
         # Start simple: just use them, if API fails (401), we might need logic to refresh using 'refresh_token'
@@ -151,16 +199,39 @@ def authenticate_withings():
         if refresh_token:
             try:
                 print("Attempting to refresh token...")
-                auth = SimpleWithingsAuth(config.WITHINGS_CLIENT_ID, config.WITHINGS_CLIENT_SECRET, config.WITHINGS_REDIRECT_URI)
+                auth = get_withings_auth(settings)
                 new_token_data = auth.refresh_token(refresh_token)
-                save_credentials(new_token_data)
+                save_credentials(new_token_data, settings['token_file'])
                 return new_token_data
             except Exception as e:
                 print(f"Token refresh failed ({type(e).__name__}), requesting new login.")
         else:
              print("No refresh token found, requesting new login.")
         
-    return get_withings_credentials()
+    return get_withings_credentials(settings)
+
+def login_garmin(account=None):
+    """
+    Logs into Garmin using the account's token store.
+    If the stored tokens are unusable, the store is wiped and a fresh login is attempted.
+    """
+    settings = accounts.resolve(account)
+    token_dir = settings['garmin_token_dir']
+    os.makedirs(token_dir, exist_ok=True)
+    garmin = Garmin(settings['garmin_email'], settings['garmin_password'])
+
+    try:
+        garmin.login(tokenstore=token_dir)
+    except Exception:
+        try:
+            for f in os.listdir(token_dir):
+                fp = os.path.join(token_dir, f)
+                if os.path.isfile(fp):
+                    os.unlink(fp)
+        except Exception:
+            pass
+        garmin.login(tokenstore=token_dir)
+    return garmin
 
 def parse_garmin_timestamp(ts_str):
     if not ts_str:
@@ -197,334 +268,92 @@ def is_duplicate_bp(withings_dt_utc, withings_systolic, withings_diastolic, with
                 return True
     return False
 
-def get_measure_value(measure):
-    """
-    Helper to calculate the real value from value and unit.
-    value * 10^unit
-    """
-    return measure['value'] * (10 ** measure['unit'])
+def sync_data(token_data, garmin_client, account=None):
+    """Syncs the latest weight and blood pressure measurements. See sync_engine.sync_latest."""
+    asyncio.run(sync_engine.sync_latest_with_client(token_data, garmin_client, account=account))
 
-def get_latest_height(access_token):
+def main(account=None, plan=False, lease=None):
     """
-    Fetches the latest height measurement to use for BMI calculation.
+    Daily sync of the latest measurements. With plan=True nothing is uploaded and
+    the plan (see pipeline.PlanReport.to_dict) is returned instead.
+    lease: job_leases.Lease of a scheduled run, checked before every upload.
     """
-    url = "https://wbsapi.withings.net/measure"
-    headers = {'Authorization': f'Bearer {access_token}'}
-    params = {
-        'action': 'getmeas',
-        'meastype': '4', # Height
-        'category': 1,
-        'limit': 1
-    }
-    
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 0:
-                measuregrps = data.get('body', {}).get('measuregrps', [])
-                if measuregrps:
-                    for measure in measuregrps[0]['measures']:
-                        if measure['type'] == 4:
-                            return get_measure_value(measure) # Returns height in meters
-    except Exception as e:
-        print(f"Warning: Could not fetch height. Error type: {type(e).__name__}")
-    return None
-
-def sync_data(token_data, garmin_client):
-    access_token = token_data['access_token']
-    
-    print("\nFetching latest height for BMI calculation...")
-    user_height = get_latest_height(access_token)
-    if user_height:
-        print(f"  Found height: {user_height} m")
-    else:
-        print("  No height found. BMI will not be calculated.")
-
-    print("\nFetching data from Withings...")
-    
-    url = "https://wbsapi.withings.net/measure"
-    headers = {'Authorization': f'Bearer {access_token}'}
-    params = {
-        'action': 'getmeas'
-    }
-    
-    response = requests.get(url, headers=headers, params=params)
-    
-    if response.status_code != 200:
-        print(f"Error fetching data from Withings. Status: {response.status_code}")
-        return
-        
-    data = response.json()
-    
-    if data.get('status') != 0:
-        print(f"Withings API Error. Status: {data.get('status')}")
-        return
-        
-    body = data.get('body', {})
-    measuregrps = body.get('measuregrps', [])
-    
-    if not measuregrps:
-        print("No measures found on Withings.")
-        return
-
-    print(f"Found {len(measuregrps)} measurement groups.")
-    
-    # Search for the latest group that has a weight measurement
-    weight_group = None
-    bp_group = None
-
-    for g in measuregrps:
-        # Check if this group has a weight measure (type 1)
-        # The API returns groups sorted by date descending (newest first) by default
-        has_weight = False
-        has_bp = False
-
-        for m in g['measures']:
-            if m['type'] == 1:
-                has_weight = True
-            if m['type'] in [9, 10]: # Diastolic or Systolic
-                has_bp = True
-        
-        if has_weight and not weight_group:
-            weight_group = g
-        
-        if has_bp and not bp_group:
-            bp_group = g
-            
-        if weight_group and bp_group:
-            break
-            
-    if not weight_group and not bp_group:
-         print("No measurement group with weight or blood pressure found.")
-         return
-    
-    # --- PROCESS WEIGHT ---
-    if weight_group:
-        dt = datetime.fromtimestamp(weight_group['date'], timezone.utc)
-        
-        # Convert to local time
-        local_tz = tzlocal.get_localzone()
-        dt_local = dt.astimezone(local_tz)
-        
-        print(f"\nProcessing Weight measurement for {dt} (UTC) -> {dt_local} (Local)...")
-        
-        weight = None
-        fat_ratio = None
-        muscle_mass = None
-        hydration = None
-        bone_mass = None
-        visceral_fat = None
-        
-        for measure in weight_group['measures']:
-            val = get_measure_value(measure)
-            type_code = measure['type']
-            
-            if type_code == 1: # Weight (kg)
-                weight = val
-            elif type_code == 6: # Fat Ratio (%)
-                fat_ratio = val
-            elif type_code == 76: # Muscle Mass (kg)
-                muscle_mass = val
-            elif type_code == 77: # Hydration (kg) or mass?
-                hydration = val
-            elif type_code == 88: # Bone Mass (kg)
-                bone_mass = val
-            elif type_code == 12: # Visceral Fat
-                visceral_fat = val
-                
-        if weight:
-            print(f"  Weight: {weight} kg")
-            if fat_ratio: print(f"  Fat Ratio: {fat_ratio} %")
-            if muscle_mass: print(f"  Muscle Mass: {muscle_mass} kg")
-            if hydration: print(f"  Hydration: {hydration} kg")
-            
-            percent_hydration = None
-            if hydration and weight:
-                percent_hydration = (hydration / weight) * 100
-                
-            bmi = None
-            if user_height:
-                bmi = weight / (user_height * user_height)
-                print(f"  Calculated BMI: {bmi:.2f}")
-
-            try:
-                timestamp_str = dt_local.isoformat()
-                
-                print(f"  Uploading Weight to Garmin at {timestamp_str}...")
-                
-                garmin_client.add_body_composition(
-                    timestamp=timestamp_str,
-                    weight=weight,
-                    percent_fat=fat_ratio,
-                    percent_hydration=percent_hydration,
-                    visceral_fat_rating=visceral_fat,
-                    bone_mass=bone_mass,
-                    muscle_mass=muscle_mass,
-                    bmi=bmi
-                )
-                print(f"  Successfully synced Weight to Garmin!")
-            except Exception as e:
-                print(f"  Failed to upload Weight to Garmin. Error type: {type(e).__name__}")
-        else:
-            print("  Skipping weight group (No weight found in group).")
-    else:
-        print("No weight measurement found.")
-
-    # --- PROCESS BLOOD PRESSURE ---
-    if bp_group:
-        dt_bp = datetime.fromtimestamp(bp_group['date'], timezone.utc)
-        
-        # Convert to local time
-        local_tz = tzlocal.get_localzone()
-        dt_local_bp = dt_bp.astimezone(local_tz)
-        
-        print(f"\nProcessing Blood Pressure measurement for {dt_bp} (UTC) -> {dt_local_bp} (Local)...")
-        
-        diastolic = None
-        systolic = None
-        heart_rate = None
-        
-        for measure in bp_group['measures']:
-            val = get_measure_value(measure)
-            type_code = measure['type']
-            
-            if type_code == 9: # Diastolic (mmHg)
-                diastolic = int(val)
-            elif type_code == 10: # Systolic (mmHg)
-                systolic = int(val)
-            elif type_code == 11: # Heart Rate (bpm)
-                heart_rate = int(val)
-
-        if diastolic and systolic:
-            print(f"  Systolic: {systolic} mmHg")
-            print(f"  Diastolic: {diastolic} mmHg")
-            if heart_rate: print(f"  Heart Rate: {heart_rate} bpm")
-            
-            try:
-                date_str = dt_local_bp.strftime('%Y-%m-%d')
-                print(f"  Checking Garmin for existing blood pressure entries on {date_str}...")
-                existing_data = garmin_client.get_blood_pressure(date_str)
-                existing_measurements = []
-                if existing_data and "measurementSummaries" in existing_data:
-                    existing_measurements = [
-                        metric 
-                        for x in existing_data["measurementSummaries"] 
-                        for metric in x.get("measurements", [])
-                    ]
-                
-                if is_duplicate_bp(dt_bp, systolic, diastolic, heart_rate, existing_measurements):
-                    print("  Blood pressure measurement already synced to Garmin. Skipping.")
-                else:
-                    print(f"  Uploading Blood Pressure to Garmin at {dt_local_bp.isoformat()}...")
-                    garmin_client.set_blood_pressure(
-                        systolic=systolic,
-                        diastolic=diastolic,
-                        pulse=heart_rate,
-                        timestamp=dt_local_bp.isoformat()
-                    )
-                    print(f"  Successfully synced Blood Pressure to Garmin!")
-            except Exception as e:
-                print(f"  Failed to upload/check Blood Pressure to Garmin. Error type: {type(e).__name__} {e}")
-
-        else:
-             print("  Skipping BP group (Incomplete data).")
-    else:
-        print("No blood pressure measurement found.")
-
-def main():
     print("Welcome to the Withings to Garmin Sync Tool!")
+    settings = accounts.resolve(account)
+    if settings['id']:
+        print(f"Account: {settings['name']}")
     
-    if not config.WITHINGS_CLIENT_ID or not config.WITHINGS_CLIENT_SECRET:
+    if not settings['withings_client_id'] or not settings['withings_client_secret']:
         print("Error: Withings Credentials not found. Please configure your Withings credentials.")
         return
         
-    if not config.GARMIN_EMAIL or not config.GARMIN_PASSWORD:
+    if not settings['garmin_email'] or not settings['garmin_password']:
         print("Error: Garmin Credentials not found. Please configure your Garmin credentials.")
         return
 
-    # 2. Authenticate Withings
-    try:
-        print("Connecting to Withings...")
-        token_data = authenticate_withings()
-    except Exception as e:
-        print(f"Withings Auth Failed. Error type: {type(e).__name__}")
-        return
+    # Authenticate Withings and Garmin concurrently, then sync
+    sync_pipeline = asyncio.run(sync_engine.run_latest_sync(settings, plan=plan, lease=lease))
+    if plan:
+        return sync_pipeline.plan.to_dict() if sync_pipeline else None
+    if sync_pipeline and not sync_pipeline.interrupted:
+        print("\nSync Complete!")
 
-    # 3. Authenticate Garmin
-    try:
-        print("Connecting to Garmin...")
-        token_dir = os.path.join(DATA_DIR, '.garminconnect')
-        os.makedirs(token_dir, exist_ok=True)
-        garmin = Garmin(config.GARMIN_EMAIL, config.GARMIN_PASSWORD)
-        
-        try:
-            garmin.login(tokenstore=token_dir)
-        except Exception:
-            try:
-                for f in os.listdir(token_dir):
-                    fp = os.path.join(token_dir, f)
-                    if os.path.isfile(fp):
-                        os.unlink(fp)
-            except Exception:
-                pass
-            garmin.login(tokenstore=token_dir)
-    except Exception as e:
-        print(f"Garmin Auth Failed. Check credentials. Error type: {type(e).__name__}")
-        return
 
-    # 4. Sync
-    try:
-        sync_data(token_data, garmin)
-        print("\nSync Complete!")
-    except Exception as e:
-        print(f"Sync Logic Failed. Error type: {type(e).__name__}")
+# 1 lb = 0.45359237 kg
+LB_TO_KG = 0.45359237
 
+def masses_to_kg(unit, *masses):
+    """Converts weight / muscle / bone mass entered in `unit` ('kg' or 'lbs') to kg. None stays None."""
+    if unit != 'lbs':
+        return masses
+    return tuple(m * LB_TO_KG if m else m for m in masses)
 
-def upload_manual_data(weight, fat_ratio=None, muscle_mass=None, bone_mass=None, hydration_percent=None, bmi=None, timestamp=None):
+def manual_payload(weight, fat_ratio=None, muscle_mass=None, bone_mass=None, hydration_percent=None, bmi=None, timestamp=None):
+    """Garmin add_body_composition arguments of a manual entry (timestamp defaults to now)."""
+    if not timestamp:
+        local_tz = tzlocal.get_localzone()
+        timestamp = datetime.now(local_tz).isoformat()
+
+    return dict(
+        timestamp=timestamp,
+        weight=weight,
+        percent_fat=fat_ratio,
+        percent_hydration=hydration_percent,
+        bone_mass=bone_mass,
+        muscle_mass=muscle_mass,
+        bmi=bmi
+    )
+
+def upload_manual_data(weight, fat_ratio=None, muscle_mass=None, bone_mass=None, hydration_percent=None, bmi=None, timestamp=None, account=None):
     """
     Uploads a single set of body composition data to Garmin.
     """
-    if not config.GARMIN_EMAIL or not config.GARMIN_PASSWORD:
+    settings = accounts.resolve(account)
+    if not settings['garmin_email'] or not settings['garmin_password']:
         raise Exception("Garmin credentials not configured.")
 
+    payload = manual_payload(weight, fat_ratio, muscle_mass, bone_mass, hydration_percent, bmi, timestamp)
+    timestamp = payload['timestamp']
+
     try:
         print("Connecting to Garmin for manual upload...")
-        token_dir = os.path.join(DATA_DIR, '.garminconnect')
-        os.makedirs(token_dir, exist_ok=True)
-        garmin = Garmin(config.GARMIN_EMAIL, config.GARMIN_PASSWORD)
-        
-        try:
-            garmin.login(tokenstore=token_dir)
-        except Exception:
-            try:
-                for f in os.listdir(token_dir):
-                    fp = os.path.join(token_dir, f)
-                    if os.path.isfile(fp):
-                        os.unlink(fp)
-            except Exception:
-                pass
-            garmin.login(tokenstore=token_dir)
-        
-        if not timestamp:
-            local_tz = tzlocal.get_localzone()
-            timestamp = datetime.now(local_tz).isoformat()
-            
+        garmin = circuit_breaker.GARMIN.call(login_garmin, settings)
+
         print(f"Uploading manual data: Weight={weight}, Fat={fat_ratio}, BMI={bmi} at {timestamp}")
-        
-        garmin.add_body_composition(
-            timestamp=timestamp,
-            weight=weight,
-            percent_fat=fat_ratio,
-            percent_hydration=hydration_percent,
-            bone_mass=bone_mass,
-            muscle_mass=muscle_mass,
-            bmi=bmi
-        )
+
+        circuit_breaker.GARMIN.call(garmin.add_body_composition, **payload)
         return True
     except Exception as e:
         print(f"Manual upload failed. Error type: {type(e).__name__}")
-        raise e
+        # Keep the entry so it reaches Garmin once the service is back
+        outbox.enqueue(settings, outbox.KIND_WEIGHT, payload, type(e).__name__)
+        print("Queued for automatic retry.")
+        return False
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description='Sync the latest Withings measurements to Garmin.')
+    parser.add_argument('--account', type=int, default=None, help='Account ID to sync (default: the main account)')
+    parser.add_argument('--plan', action='store_true', help='Only show what would be uploaded')
+    args = parser.parse_args()
+    main(account=args.account, plan=args.plan)
@@ -0,0 +1,471 @@
+"""
+asyncio sync engine.
+
+The Withings side (token refresh, height history, paginated measure fetch) runs on an
+async HTTP client, and the blocking Garmin SDK calls run in the default executor, so
+independent steps overlap: Withings auth -> (height || measures) runs alongside
+Garmin login -> existing-data prefetch. A sync takes as long as the slowest
+dependency instead of the sum of all of them.
+
+The synchronous entry points in sync_app / sync_historical are thin wrappers around
+the coroutines in this module.
+"""
+import asyncio
+import functools
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+
+import aiohttp
+import tzlocal
+
+import accounts
+import circuit_breaker
+import config
+import height_series
+import pipeline
+import sync_app
+from measurements import get_measure_value
+
+MEASURE_URL = "https://wbsapi.withings.net/measure"
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=60)
+
+# Refresh a saved access token ahead of time when it expires within this many seconds
+TOKEN_EXPIRY_MARGIN = 300
+
+# Days of Garmin blood pressure history prefetched by the daily sync for duplicate checks
+LATEST_BP_PREFETCH_DAYS = 7
+
+# Seconds a warm-up (see prewarm) stays usable after its scheduled sync time
+WARM_GRACE_SECONDS = 600
+
+# Prepared by prewarm for the next daily sync of an account: account key -> (prepared at, {'garmin', 'bp'})
+_warm = {}
+_warm_lock = threading.Lock()
+
+
+def keep_warm(account, **items):
+    with _warm_lock:
+        _warm[accounts._account_key(account)] = (time.time(), items)
+
+
+def take_warm(account):
+    """Returns (and forgets) what prewarm prepared for the account, or {} if nothing recent."""
+    with _warm_lock:
+        prepared_at, items = _warm.pop(accounts._account_key(account), (0, {}))
+    if time.time() - prepared_at > config.PREWARM_MINUTES * 60 + WARM_GRACE_SECONDS:
+        return {}
+    return items
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call (Garmin SDK, sqlite, ...) in the default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def client_session():
+    return aiohttp.ClientSession(timeout=HTTP_TIMEOUT)
+
+
+async def _withings_outage(response=None):
+    """
+    Counts a network error / server error against the Withings breaker. Any other answer
+    (e.g. 401 for a revoked token) shows Withings is up and ends a trial call.
+    """
+    if response is None or response.status >= 500:
+        await run_blocking(circuit_breaker.WITHINGS.record_failure)
+    else:
+        await run_blocking(circuit_breaker.WITHINGS.record_success)
+
+
+async def refresh_withings_token(session, auth, refresh_token):
+    """Async counterpart of SimpleWithingsAuth.refresh_token."""
+    await run_blocking(circuit_breaker.WITHINGS.enter)
+    data = {
+        'action': 'requesttoken',
+        'grant_type': 'refresh_token',
+        'client_id': auth.client_id,
+        'client_secret': auth.client_secret,
+        'refresh_token': refresh_token
+    }
+    try:
+        async with session.post(auth.TOKEN_URL, data=data) as response:
+            if response.status != 200:
+                await _withings_outage(response)
+                raise Exception(f"HTTP Error during refresh: {response.status}")
+            resp_json = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        await _withings_outage()
+        raise
+    await run_blocking(circuit_breaker.WITHINGS.record_success)
+    if resp_json.get('status') != 0:
+        raise Exception(f"Token refresh failed. Status: {resp_json}")
+    print("Token refresh successful.")
+    return resp_json.get('body')
+
+
+async def authenticate_withings(session, account=None):
+    """
+    Async counterpart of sync_app.authenticate_withings. A saved token that is still valid
+    (e.g. refreshed by the warm-up before a scheduled sync) is used as is.
+    """
+    settings = accounts.resolve(account)
+    token_data = await run_blocking(sync_app.load_credentials, settings['token_file'])
+    if token_data:
+        expires_at = token_data.get('expires_at')
+        if expires_at and expires_at - TOKEN_EXPIRY_MARGIN > time.time() and token_data.get('access_token'):
+            print("Using saved token (still valid).")
+            return token_data
+        refresh_token = token_data.get('refresh_token')
+        if refresh_token:
+            try:
+                print("Attempting to refresh token...")
+                new_token_data = await refresh_withings_token(session, sync_app.get_withings_auth(settings), refresh_token)
+                await run_blocking(sync_app.save_credentials, new_token_data, settings['token_file'])
+                return new_token_data
+            except circuit_breaker.CircuitOpenError:
+                raise
+            except Exception as e:
+                print(f"Token refresh failed ({type(e).__name__}), requesting new login.")
+        else:
+            print("No refresh token found, requesting new login.")
+
+    # Interactive fallback (CLI only)
+    return await run_blocking(sync_app.get_withings_credentials, settings)
+
+
+async def get_access_token(session, account=None, margin=TOKEN_EXPIRY_MARGIN):
+    """
+    Returns a usable access token from the saved credentials, refreshing it only if it
+    expires within `margin` seconds. Never prompts; returns None if Withings is not connected.
+    """
+    settings = accounts.resolve(account)
+    token_data = await run_blocking(sync_app.load_credentials, settings['token_file'])
+    if not token_data:
+        return None
+
+    expires_at = token_data.get('expires_at')
+    if expires_at and expires_at - margin > time.time():
+        return token_data.get('access_token')
+
+    refresh_token = token_data.get('refresh_token')
+    if not refresh_token:
+        return None
+    new_token_data = await refresh_withings_token(session, sync_app.get_withings_auth(settings), refresh_token)
+    await run_blocking(sync_app.save_credentials, new_token_data, settings['token_file'])
+    return new_token_data.get('access_token')
+
+
+async def _get_measure(session, access_token, params):
+    """Calls Withings getmeas. Returns the response body, or None (after logging) on error."""
+    try:
+        await run_blocking(circuit_breaker.WITHINGS.enter)
+    except circuit_breaker.CircuitOpenError:
+        print("Withings is unavailable (circuit open), skipping request.")
+        return None
+
+    headers = {'Authorization': f'Bearer {access_token}'}
+    try:
+        async with session.get(MEASURE_URL, headers=headers, params=params) as response:
+            if response.status != 200:
+                print(f"Error fetching data from Withings. Status: {response.status}")
+                await _withings_outage(response)
+                return None
+            data = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        await _withings_outage()
+        raise
+    await run_blocking(circuit_breaker.WITHINGS.record_success)
+    if data.get('status') != 0:
+        print(f"Withings API Error. Status: {data.get('status')}")
+        return None
+    return data.get('body', {})
+
+
+async def fetch_height_series(session, access_token):
+    """Fetches every height measurement (meters) of the account, all pages. Returns None on error."""
+    groups = await fetch_measure_groups(session, access_token, meastype=4, category=1)
+    if groups is None:
+        return None
+    points = []
+    for group in groups:
+        for measure in group['measures']:
+            if measure['type'] == 4:
+                points.append((group['date'], get_measure_value(measure)))
+    return height_series.HeightSeries(points)
+
+
+async def fetch_measure_groups(session, access_token, startdate=None, enddate=None, max_pages=None,
+                               meastype=None, category=None, lastupdate=None):
+    """
+    Fetches measurement groups from Withings, following the `more`/`offset` pagination.
+    Returns None if the first request fails.
+    """
+    params = {'action': 'getmeas'}
+    if meastype:
+        params['meastype'] = meastype
+    if category:
+        params['category'] = category
+    if lastupdate:
+        params['lastupdate'] = lastupdate
+    if startdate:
+        params['startdate'] = startdate
+    if enddate:
+        params['enddate'] = enddate
+
+    measuregrps = []
+    pages = 0
+    while True:
+        body = await _get_measure(session, access_token, params)
+        if body is None:
+            return measuregrps if pages else None
+        measuregrps.extend(body.get('measuregrps', []))
+        pages += 1
+        if not body.get('more') or (max_pages and pages >= max_pages):
+            return measuregrps
+        params['offset'] = body.get('offset')
+
+
+async def fetch_garmin_bp(garmin, start_date_str, end_date_str=None):
+    """Fetches existing Garmin blood pressure measurements for a local date range."""
+    if end_date_str:
+        existing_data = await run_blocking(circuit_breaker.GARMIN.call, garmin.get_blood_pressure, start_date_str, end_date_str)
+    else:
+        existing_data = await run_blocking(circuit_breaker.GARMIN.call, garmin.get_blood_pressure, start_date_str)
+    if existing_data and "measurementSummaries" in existing_data:
+        return [
+            metric
+            for x in existing_data["measurementSummaries"]
+            for metric in x.get("measurements", [])
+        ]
+    return []
+
+
+async def fetch_garmin_weights(garmin, start_date_str, end_date_str):
+    """Fetches existing Garmin weigh-ins for a local date range."""
+    existing_data = await run_blocking(circuit_breaker.GARMIN.call, garmin.get_body_composition, start_date_str, end_date_str)
+    if existing_data and "dateWeightList" in existing_data:
+        return existing_data["dateWeightList"] or []
+    return []
+
+
+async def load_height_series(session, access_token, account=None):
+    """Returns the account's height history, from the local cache or fetched from Withings."""
+    print("\nLoading height history for BMI calculation...")
+    series = None
+    try:
+        series = await run_blocking(height_series.load_cached, account)
+        if series is None:
+            series = await fetch_height_series(session, access_token)
+            if series is not None:
+                await run_blocking(height_series.store, account, series)
+    except Exception as e:
+        print(f"Warning: Could not fetch height. Error type: {type(e).__name__}")
+
+    if series:
+        print(f"  Found {len(series)} height measurement(s), latest: {series.latest()} m")
+    else:
+        print("  No height found. BMI will not be calculated.")
+    return series
+
+
+async def _run_pipeline(session, token_data, garmin_task, pages_factory, account=None, progress_callback=None,
+                        select_latest=False, preload_bp=None, checkpoint=None, plan=False, seed_bp=(), store=True, max_uploads=None,
+                        bulk=False, lease=None):
+    access_token = token_data['access_token']
+    if plan:
+        height_task = _completed(None) # BMI is not needed for a plan
+    else:
+        height_task = asyncio.ensure_future(load_height_series(session, access_token, account))
+    sync_pipeline = pipeline.SyncPipeline(garmin_task, height_task, account=account, progress_callback=progress_callback,
+                                          checkpoint=checkpoint, plan=plan, store=store,
+                                          max_uploads=max_uploads, bulk=bulk, lease=lease)
+    if preload_bp:
+        sync_pipeline.preload_bp(*preload_bp)
+    for bp_range in seed_bp:
+        sync_pipeline.seed_bp(*bp_range)
+    try:
+        await sync_pipeline.run(pages_factory(access_token), select_latest=select_latest)
+    finally:
+        height_task.cancel()
+    return sync_pipeline
+
+
+def latest_bp_window():
+    """Local date range of the Garmin BP entries the daily sync checks for duplicates."""
+    today = datetime.now(tzlocal.get_localzone())
+    return (
+        (today - timedelta(days=LATEST_BP_PREFETCH_DAYS - 1)).strftime('%Y-%m-%d'),
+        today.strftime('%Y-%m-%d'),
+    )
+
+
+async def sync_latest(session, token_data, garmin_task, account=None, plan=False, warm_bp=None, lease=None):
+    """
+    Uploads the latest weight and blood pressure groups (daily sync). garmin_task resolves to a logged-in client.
+    With plan=True nothing is uploaded; the returned pipeline's `plan` says what would be.
+    warm_bp: (start, end, records) read by the warm-up, used if it covers today's window.
+    lease: job_leases.Lease of a scheduled run; the sync stops once another instance took it over.
+    """
+    # Prefetch a few days of Garmin BP so the duplicate check doesn't wait for a lookup
+    bp_window = latest_bp_window()
+    seed_bp = ()
+    if warm_bp and tuple(warm_bp[:2]) == bp_window and warm_bp[2] is not None:
+        seed_bp, bp_window = [warm_bp], None
+    return await _run_pipeline(
+        session, token_data, garmin_task,
+        lambda access_token: pipeline.latest_page(session, access_token),
+        account=account, select_latest=True, preload_bp=bp_window, seed_bp=seed_bp, plan=plan, lease=lease,
+    )
+
+
+async def sync_range(session, token_data, garmin_task, days=30, start_date=None, end_date=None,
+                     progress_callback=None, account=None, checkpoint=None, plan=False, max_uploads=None,
+                     bulk=False):
+    """
+    Uploads every weight / blood pressure group in a date range (historical sync). See sync_latest for plan.
+    max_uploads stops the sync before it would make more Garmin upload calls (the checkpoint says where).
+    bulk=True makes the sync give way to interactive syncs between groups.
+    """
+    # Determine Start/End Timestamps
+    startdate = None
+    enddate = None
+
+    if start_date:
+        # Expecting timestamp intergers
+        startdate = start_date
+        enddate = end_date # Optional, defaults to now if None
+
+        # Friendly logging
+        sd_str = datetime.fromtimestamp(startdate).strftime('%Y-%m-%d')
+        ed_str = datetime.fromtimestamp(enddate).strftime('%Y-%m-%d') if enddate else "Now"
+        print(f"\nFetching data from Withings from {sd_str} to {ed_str}...")
+    else:
+        # Legacy behavior: Last X days
+        print(f"Fetching data from Withings for the last {days} days...")
+        now = datetime.now(timezone.utc)
+        start_date_obj = now - timedelta(days=days)
+        startdate = int(start_date_obj.timestamp())
+
+    return await _run_pipeline(
+        session, token_data, garmin_task,
+        lambda access_token: pipeline.range_pages(
+            session, access_token, startdate, enddate,
+            # A plan only reads, so windows are fetched in parallel
+            concurrency=config.PLAN_FETCH_CONCURRENCY if plan else 1,
+        ),
+        account=account, progress_callback=progress_callback, checkpoint=checkpoint, plan=plan,
+        max_uploads=max_uploads, bulk=bulk,
+    )
+
+
+def _completed(value):
+    """Wraps an already available value (e.g. a logged-in Garmin client) in a future."""
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(value)
+    return future
+
+
+async def _connect(session, settings, garmin=None):
+    """
+    Starts the Garmin login in the executor and authenticates Withings meanwhile.
+    Returns (token_data, garmin_task), or None after logging an auth failure.
+    Nothing is attempted while one of the services is known to be down (circuit open).
+    garmin: a client that is already logged in (warm-up); no new login then.
+    """
+    for breaker in (circuit_breaker.WITHINGS, circuit_breaker.GARMIN):
+        retry_at = await run_blocking(breaker.retry_at)
+        if retry_at and retry_at > time.time():
+            print(f"Skipping sync: {breaker.label} has been failing. "
+                  f"Next attempt after {datetime.fromtimestamp(retry_at).strftime('%H:%M:%S')}.")
+            return None
+
+    if garmin is not None:
+        garmin_task = _completed(garmin)
+    else:
+        garmin_task = asyncio.ensure_future(run_blocking(circuit_breaker.GARMIN.call, sync_app.login_garmin, settings))
+
+    try:
+        print("Connecting to Withings...")
+        token_data = await authenticate_withings(session, settings)
+    except Exception as e:
+        print(f"Withings Auth Failed. Error type: {type(e).__name__}")
+        garmin_task.cancel()
+        return None
+
+    print("Connecting to Garmin...")
+
+    async def garmin_or_fail():
+        try:
+            return await garmin_task
+        except Exception as e:
+            print(f"Garmin Auth Failed. Check credentials. Error type: {type(e).__name__}")
+            raise
+
+    return token_data, asyncio.ensure_future(garmin_or_fail())
+
+
+async def run_latest_sync(account=None, plan=False, lease=None):
+    """
+    Daily sync: connect to both services concurrently, then sync the latest measurements.
+    Returns the finished SyncPipeline, or False if the sync could not run.
+    """
+    settings = accounts.resolve(account)
+    warm = {} if plan else take_warm(settings)
+    if warm:
+        print("Using the sessions prepared before this sync.")
+    async with client_session() as session:
+        connected = await _connect(session, settings, garmin=warm.get('garmin'))
+        if not connected:
+            return False
+        token_data, garmin_task = connected
+        try:
+            sync_pipeline = await sync_latest(session, token_data, garmin_task, account=settings, plan=plan,
+                                              warm_bp=warm.get('bp'), lease=lease)
+        except circuit_breaker.CircuitOpenError as e:
+            print(f"Stopping: {circuit_breaker.BREAKERS[e.name].label} keeps failing. A later run will pick up the remaining measurements.")
+            return False
+        except Exception as e:
+            if garmin_task.done() and garmin_task.exception():
+                return False
+            print(f"Sync Logic Failed. Error type: {type(e).__name__}")
+            return False
+    return sync_pipeline
+
+
+async def run_range_sync(days=30, start_date=None, end_date=None, progress_callback=None, account=None,
+                         checkpoint=None, plan=False, max_uploads=None, bulk=False):
+    """
+    Historical sync: connect to both services concurrently, then sync the requested range.
+    Returns the finished SyncPipeline, or False if the sync could not run.
+    """
+    settings = accounts.resolve(account)
+    async with client_session() as session:
+        connected = await _connect(session, settings)
+        if not connected:
+            return False
+        token_data, garmin_task = connected
+        try:
+            sync_pipeline = await sync_range(session, token_data, garmin_task, days=days, start_date=start_date,
+                                             end_date=end_date, progress_callback=progress_callback, account=settings,
+                                             checkpoint=checkpoint, plan=plan, max_uploads=max_uploads,
+                                             bulk=bulk)
+        except circuit_breaker.CircuitOpenError as e:
+            print(f"Stopping: {circuit_breaker.BREAKERS[e.name].label} keeps failing. Resume the import once it is back.")
+            return False
+        except Exception:
+            if garmin_task.done() and garmin_task.exception():
+                return False
+            raise
+    return sync_pipeline
+
+
+async def sync_latest_with_client(token_data, garmin_client, account=None):
+    async with client_session() as session:
+        await sync_latest(session, token_data, _completed(garmin_client), account=account)
+
+
+async def sync_range_with_client(token_data, garmin_client, account=None, **kwargs):
+    async with client_session() as session:
+        await sync_range(session, token_data, _completed(garmin_client), account=account, **kwargs)
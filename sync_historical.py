@@ -1,316 +1,52 @@
-import sys
 import time
-import requests
-import json
+import asyncio
 from datetime import datetime, timezone, timedelta
-import tzlocal
-import config
-from garminconnect import Garmin
-# Import auth logic from sync_app to reuse the manual implementation and token persistence
-from sync_app import authenticate_withings, save_credentials, get_withings_credentials, parse_garmin_timestamp, is_duplicate_bp
-
-def get_measure_value(measure):
-    return measure['value'] * (10 ** measure['unit'])
-
-def get_latest_height(access_token):
+import accounts
+import checkpoints
+import sync_engine
+
+def sync_data(token_data, garmin_client, days=30, start_date=None, end_date=None, progress_callback=None, account=None):
+    """Syncs every weight / blood pressure measurement in a range. See sync_engine.sync_range."""
+    asyncio.run(sync_engine.sync_range_with_client(
+        token_data, garmin_client, days=days, start_date=start_date, end_date=end_date,
+        progress_callback=progress_callback, account=account
+    ))
+
+def run_historical_sync(days=30, from_date=None, to_date=None, progress_callback=None, account=None,
+                        start_ts=None, end_ts=None, resume=False, plan=False, bulk=False, resumable=True):
     """
-    Fetches the latest height measurement to use for BMI calculation.
+    Syncs the last `days` days, the dates from_date..to_date (YYYY-MM-DD), or the exact
+    epoch window start_ts..end_ts (used by Withings notifications).
+    With resume=True, continues the account's last interrupted historical sync instead.
+    With plan=True nothing is uploaded or recorded; the plan (see pipeline.PlanReport.to_dict)
+    is returned instead. bulk=True lets interactive syncs go first (see priority).
+    resumable=False skips the checkpoint: short windows (notifications, the change probe) are
+    synced again by the next trigger and must not show up as an interrupted import.
     """
-    url = "https://wbsapi.withings.net/measure"
-    headers = {'Authorization': f'Bearer {access_token}'}
-    params = {
-        'action': 'getmeas',
-        'meastype': '4', # Height
-        'category': 1,
-        'limit': 1
-    }
-    
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 0:
-                measuregrps = data.get('body', {}).get('measuregrps', [])
-                if measuregrps:
-                    for measure in measuregrps[0]['measures']:
-                        if measure['type'] == 4:
-                            return get_measure_value(measure) # Returns height in meters
-    except Exception as e:
-        print(f"Warning: Could not fetch height. Error type: {type(e).__name__}")
-    return None
-
-def sync_data(token_data, garmin_client, days=30, start_date=None, end_date=None, progress_callback=None):
-    access_token = token_data['access_token']
-    
-    print("\nFetching latest height for BMI calculation...")
-    user_height = get_latest_height(access_token)
-    if user_height:
-        print(f"  Found height: {user_height} m")
-    else:
-        print("  No height found. BMI will not be calculated.")
-
-    # Determine Start/End Timestamps
-    startdate = None
-    enddate = None
-    
-    if start_date:
-        # Expecting timestamp intergers
-        startdate = start_date
-        enddate = end_date # Optional, defaults to now if None
-        
-        # Friendly logging
-        sd_str = datetime.fromtimestamp(startdate).strftime('%Y-%m-%d')
-        ed_str = datetime.fromtimestamp(enddate).strftime('%Y-%m-%d') if enddate else "Now"
-        print(f"\nFetching data from Withings from {sd_str} to {ed_str}...")
-        
-    else:
-        # Legacy behavior: Last X days
-        print(f"Fetching data from Withings for the last {days} days...")
-        now = datetime.now(timezone.utc)
-        start_date_obj = now - timedelta(days=days)
-        startdate = int(start_date_obj.timestamp())
-    
-    url = "https://wbsapi.withings.net/measure"
-    headers = {'Authorization': f'Bearer {access_token}'}
-    params = {
-        'action': 'getmeas',
-        'startdate': startdate
-    }
-    
-    if enddate:
-        params['enddate'] = enddate
-    
-    response = requests.get(url, headers=headers, params=params)
-    
-    if response.status_code != 200:
-        print(f"Error fetching data from Withings. Status: {response.status_code}")
-        return
-        
-    data = response.json()
-    
-    if data.get('status') != 0:
-        print(f"Withings API Error. Status: {data.get('status')}")
-        return
-        
-    body = data.get('body', {})
-    measuregrps = body.get('measuregrps', [])
-    
-    if not measuregrps:
-        print(f"No measures found on Withings for the requested period.")
-        return
-
-    # Filter to only keep groups that have weight data (type 1) OR blood pressure (type 9, 10)
-    valid_groups = []
-    for group in measuregrps:
-        has_weight = False
-        has_bp = False
-        for m in group['measures']:
-            if m['type'] == 1:
-                has_weight = True
-            if m['type'] in [9, 10]:
-                has_bp = True
-        
-        if has_weight or has_bp:
-            valid_groups.append(group)
-            
-    measuregrps = valid_groups
-    total_groups = len(measuregrps)
-    print(f"Found {total_groups} valid measurement groups (Weight or BP).")
-    
-    # Reverse to process from Oldest to Newest
-    measuregrps.reverse()
-    
-    success_count = 0
-    fail_count = 0
-    
-    # Init local timezone
-    local_tz = tzlocal.get_localzone()
-    
-    # Fetch all existing Garmin blood pressure measurements for the range to avoid duplicate syncs
-    existing_bp_measurements = []
-    if any(any(m['type'] in [9, 10] for m in group['measures']) for group in measuregrps):
-        try:
-            # Find the date range of groups
-            group_dates = [datetime.fromtimestamp(group['date'], timezone.utc).astimezone(local_tz) for group in measuregrps]
-            if group_dates:
-                start_date_str = min(group_dates).strftime('%Y-%m-%d')
-                end_date_str = max(group_dates).strftime('%Y-%m-%d')
-                print(f"\nChecking Garmin for existing blood pressure entries from {start_date_str} to {end_date_str}...")
-                existing_data = garmin_client.get_blood_pressure(start_date_str, end_date_str)
-                if existing_data and "measurementSummaries" in existing_data:
-                    existing_bp_measurements = [
-                        metric 
-                        for x in existing_data["measurementSummaries"] 
-                        for metric in x.get("measurements", [])
-                    ]
-                print(f"  Found {len(existing_bp_measurements)} existing blood pressure records on Garmin.")
-        except Exception as e:
-            print(f"  Warning: Could not fetch existing Garmin blood pressure records. Error: {e}")
-            
-    # Process ALL groups found
-    for i, group in enumerate(measuregrps):
-        if progress_callback:
-            progress_callback(i + 1, total_groups)
-
-        dt = datetime.fromtimestamp(group['date'], timezone.utc)
-        
-        
-        # Convert to local time
-        dt_local = dt.astimezone(local_tz)
-        
-        print(f"Processing measurement {i+1}/{total_groups} for {dt} (UTC) -> {dt_local} (Local)...")
-        
-        weight = None
-        fat_ratio = None
-        muscle_mass = None
-        hydration = None
-        bone_mass = None
-        visceral_fat = None
-        
-        
-        diastolic = None
-        systolic = None
-        heart_rate = None
-
-        for measure in group['measures']:
-            val = get_measure_value(measure)
-            type_code = measure['type']
-            
-            if type_code == 1: weight = val
-            elif type_code == 6: fat_ratio = val
-            elif type_code == 76: muscle_mass = val
-            elif type_code == 77: hydration = val
-            elif type_code == 88: bone_mass = val
-            elif type_code == 12: visceral_fat = val
-            elif type_code == 9: diastolic = int(val)
-            elif type_code == 10: systolic = int(val)
-            elif type_code == 11: heart_rate = int(val)
-            
-        group_success = False
-        
-        # --- UPLOAD WEIGHT ---
-        if weight:
-            print(f"  Weight: {weight} kg")
-            
-            percent_hydration = None
-            if hydration and weight:
-                percent_hydration = (hydration / weight) * 100
-            
-            # Calculate BMI
-            bmi = None
-            if user_height:
-                bmi = weight / (user_height * user_height)
-                # print(f"  Calculated BMI: {bmi:.2f}")
-
-            try:
-                timestamp_str = dt_local.isoformat()
-                
-                garmin_client.add_body_composition(
-                    timestamp=timestamp_str,
-                    weight=weight,
-                    percent_fat=fat_ratio,
-                    percent_hydration=percent_hydration,
-                    visceral_fat_rating=visceral_fat,
-                    bone_mass=bone_mass,
-                    muscle_mass=muscle_mass,
-                    bmi=bmi
-                )
-                print(f"  Successfully synced Weight.")
-                group_success = True
-            except Exception as e:
-                print(f"  Failed to upload Weight. Error type: {type(e).__name__}")
-        
-        # --- UPLOAD BLOOD PRESSURE ---
-        if systolic and diastolic:
-            print(f"  BP: {systolic}/{diastolic} mmHg, HR: {heart_rate}")
-            
-            if is_duplicate_bp(dt, systolic, diastolic, heart_rate, existing_bp_measurements):
-                print("  Blood pressure measurement already synced. Skipping.")
-                group_success = True
-            else:
-                try:
-                    garmin_client.set_blood_pressure(
-                        systolic=systolic,
-                        diastolic=diastolic,
-                        pulse=heart_rate,
-                        timestamp=dt_local.isoformat()
-                    )
-                    print(f"  Successfully synced Blood Pressure.")
-                    group_success = True
-                except Exception as e:
-                    print(f"  Failed to upload Blood Pressure. Error type: {type(e).__name__}")
-
-        if group_success:
-            success_count += 1
-        else:
-            if not weight and not (systolic and diastolic):
-                print("  Skipping group (No valid weight or BP data).")
-            else:
-                fail_count += 1
-
-        # Avoid hitting rate limits (Garmin doesn't like rapid fire requests sometimes)
-        time.sleep(1) # Be nice
-            
-    print(f"\nBatch Sync Complete. Success (Groups): {success_count}, Failures/Partial: {fail_count}")
-
-    # If dates provided, parse them
-    start_ts = None
-    end_ts = None
-    
-    # If called via kwargs (e.g. from server.py wrapper which might pass args differently)
-    # But usually run_historical_sync(days=X) or run_historical_sync(from_date=Y, to_date=Z)
-    # Let's adjust signature of run_historical_sync to be more flexible
-    pass
-
-def run_historical_sync(days=30, from_date=None, to_date=None, progress_callback=None):
-    if from_date:
+    if resume:
+        print("Withings to Garmin Sync Tool - Resume")
+    elif start_ts:
+        print(f"Withings to Garmin Sync Tool - Window: {datetime.fromtimestamp(start_ts)} to "
+              f"{datetime.fromtimestamp(end_ts) if end_ts else 'Now'}")
+    elif from_date:
         print(f"Withings to Garmin Sync Tool - Date Range: {from_date} to {to_date or 'Now'}")
     else:
         print(f"Withings to Garmin Sync Tool - {days} Day Batch")
+
+    settings = accounts.resolve(account)
+    if settings['id']:
+        print(f"Account: {settings['name']}")
     
-    if not config.WITHINGS_CLIENT_ID or not config.WITHINGS_CLIENT_SECRET:
+    if not settings['withings_client_id'] or not settings['withings_client_secret']:
         print("Error: Withings Credentials not found in .env")
         return
         
-    if not config.GARMIN_EMAIL or not config.GARMIN_PASSWORD:
+    if not settings['garmin_email'] or not settings['garmin_password']:
         print("Error: Garmin Credentials not found in .env")
         return
 
-    try:
-        # Use simple auth from sync_app
-        print("Connecting to Withings...")
-        token_data = authenticate_withings()
-    except Exception as e:
-        print(f"Withings Auth Failed. Error type: {type(e).__name__}")
-        return
-
-    try:
-        print("Connecting to Garmin...")
-        import os
-        token_dir = os.path.join("data", '.garminconnect')
-        os.makedirs(token_dir, exist_ok=True)
-        garmin = Garmin(config.GARMIN_EMAIL, config.GARMIN_PASSWORD)
-        
-        try:
-            garmin.login(tokenstore=token_dir)
-        except Exception:
-            try:
-                for f in os.listdir(token_dir):
-                    fp = os.path.join(token_dir, f)
-                    if os.path.isfile(fp):
-                        os.unlink(fp)
-            except Exception:
-                pass
-            garmin.login(tokenstore=token_dir)
-    except Exception as e:
-        print(f"Garmin Auth Failed. Check credentials. Error type: {type(e).__name__}")
-        return
-
     # Parse Dates
-    start_ts = None
-    end_ts = None
-    
-    if from_date:
+    if from_date and not start_ts:
         try:
             # Assuming YYYY-MM-DD
             dt_start = datetime.strptime(from_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
@@ -323,15 +59,52 @@ def run_historical_sync(days=30, from_date=None, to_date=None, progress_callback
             print(f"Error parsing dates: {e}")
             return
 
-    sync_data(token_data, garmin, days=days, start_date=start_ts, end_date=end_ts, progress_callback=progress_callback)
+    checkpoint = None
+    if resume:
+        pending = checkpoints.latest_resumable(settings)
+        if pending and not plan:
+            checkpoint = checkpoints.resume(pending['id'])
+            pending = checkpoint and vars(checkpoint)
+        if not pending:
+            print("No interrupted historical sync to resume.")
+            return
+        start_ts = pending['last_date'] + 1 if pending['last_date'] else pending['start_ts']
+        end_ts = pending['end_ts']
+        print(f"Resuming after {pending['processed']} already processed measurement group(s).")
+    else:
+        # Fix the range up front so the job can be resumed exactly
+        now = int(time.time())
+        start_ts = start_ts or int((datetime.now(timezone.utc) - timedelta(days=days)).timestamp())
+        end_ts = end_ts or now
+        if not plan and resumable:
+            checkpoint = checkpoints.start(settings, start_ts, end_ts)
+
+    if plan:
+        print("Plan only: nothing will be uploaded.")
+
+    # Authenticate Withings and Garmin concurrently, then sync
+    try:
+        sync_pipeline = asyncio.run(sync_engine.run_range_sync(
+            days=days, start_date=start_ts, end_date=end_ts, progress_callback=progress_callback,
+            account=settings, checkpoint=checkpoint, plan=plan, bulk=bulk
+        ))
+    finally:
+        if checkpoint and not checkpoint.finished:
+            checkpoint.finish(False)
+
+    if plan:
+        return sync_pipeline.plan.to_dict() if sync_pipeline else None
 
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='Sync historical Withings data to Garmin.')
     parser.add_argument('--days', type=int, default=30, help='Number of days to sync (default: 30)')
+    parser.add_argument('--account', type=int, default=None, help='Account ID to sync (default: the main account)')
+    parser.add_argument('--resume', action='store_true', help='Continue the last interrupted historical sync')
+    parser.add_argument('--plan', action='store_true', help='Only show what would be uploaded, per day')
     args = parser.parse_args()
     
-    run_historical_sync(args.days)
+    run_historical_sync(args.days, account=args.account, resume=args.resume, plan=args.plan)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,112 @@
+import sys
+import queue
+import threading
+import multiprocessing
+
+import config
+import priority
+
+# Sync jobs are spawned, never forked: a fork would copy the web process' threads, locks
+# and open connections mid-use. A spawned worker starts from a clean interpreter, imports
+# _worker_main and the target by name, and reads credentials saved through the UI from
+# disk. It also re-imports the main module as __mp_main__, so server.py only starts its
+# database, scheduler and jobs in start_services().
+_START_METHOD = 'spawn'
+_ctx = multiprocessing.get_context(_START_METHOD)
+
+# Bounds the number of sync processes alive at the same time, per priority lane: bulk
+# processes wait at the priority gate while an interactive job runs, so they must not hold
+# the slot that job needs
+_slots = threading.BoundedSemaphore(max(1, config.SYNC_PROCESS_WORKERS))
+_interactive_slots = threading.BoundedSemaphore(max(1, config.SYNC_PROCESS_WORKERS))
+
+
+class _QueueWriter:
+    """stdout replacement inside the worker: every write is shipped to the parent as a log message."""
+
+    def __init__(self, q):
+        self.q = q
+
+    def write(self, s):
+        if s:
+            self.q.put(('log', s))
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+def _worker_main(target, kwargs, q, with_progress, priority_event):
+    """Entry point of the worker process. target must be a module-level function (pickled by name)."""
+    sys.stdout = _QueueWriter(q)
+    priority.GATE.attach(priority_event)
+
+    if with_progress:
+        def progress_callback(current, total):
+            q.put(('progress', current, total))
+        kwargs['progress_callback'] = progress_callback
+
+    ok = True
+    try:
+        target(**kwargs)
+    except Exception as e:
+        ok = False
+        print(f"\nBIG ERROR: {type(e).__name__}")
+    q.put(('result', ok))
+
+
+def run_in_process(target, on_log=None, on_progress=None, **kwargs):
+    """
+    Runs target(**kwargs) in a fresh worker process and blocks until it finishes.
+    Log lines and progress are streamed back over a queue and handed to on_log / on_progress
+    as they arrive. Each job gets its own process, so a crash or leak inside garminconnect
+    never reaches the web process.
+
+    Returns (ok, output). ok is False if the target raised or the process died.
+    """
+    with _interactive_slots if priority.GATE.in_interactive() else _slots:
+        q = _ctx.Queue()
+        process = _ctx.Process(target=_worker_main,
+                               args=(target, kwargs, q, on_progress is not None, priority.GATE.event),
+                               daemon=True)
+        process.start()
+
+        output = []
+        ok = None
+
+        def handle(msg):
+            nonlocal ok
+            kind = msg[0]
+            if kind == 'log':
+                output.append(msg[1])
+                if on_log:
+                    on_log(msg[1])
+            elif kind == 'progress':
+                if on_progress:
+                    on_progress(msg[1], msg[2])
+            elif kind == 'result':
+                ok = msg[1]
+
+        while ok is None:
+            try:
+                handle(q.get(timeout=0.5))
+            except queue.Empty:
+                if not process.is_alive():
+                    # Drain whatever the process managed to send before it died
+                    try:
+                        while ok is None:
+                            handle(q.get_nowait())
+                    except queue.Empty:
+                        pass
+                    break
+
+        process.join(timeout=5)
+        if ok is None:
+            line = f"\nBIG ERROR: Sync worker process exited unexpectedly (exit code {process.exitcode})"
+            output.append(line)
+            if on_log:
+                on_log(line)
+            ok = False
+
+        q.close()
+        return ok, "".join(output)
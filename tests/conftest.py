@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import accounts
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Points every module at an empty database in tmp_path."""
+    import checkpoints
+    import circuit_breaker
+    import outbox
+
+    monkeypatch.setattr(accounts, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(accounts, 'DB_PATH', str(tmp_path / 'garmin_import.db'))
+    for module in (accounts, checkpoints, circuit_breaker, outbox):
+        monkeypatch.setattr(module, '_db_ready', False)
+    # init_accounts_db defaults to the real database path
+    accounts.init_accounts_db(accounts.DB_PATH)
+    return accounts.DB_PATH
@@ -0,0 +1,25 @@
+import time
+from datetime import datetime
+
+import backfill
+
+
+def test_date_range_uses_whole_utc_days():
+    assert backfill.date_range('2024-01-01', '2024-01-31') == (1704067200, 1706745599)
+
+
+def test_date_range_defaults_to_the_last_days_up_to_now():
+    start_ts, end_ts = backfill.date_range(days=10)
+    assert abs(end_ts - time.time()) < 5
+    assert end_ts - start_ts == 10 * 86400
+
+
+def test_in_window_wraps_midnight():
+    plan = {'window_start': '22:00', 'window_end': '06:00'}
+    assert backfill.in_window(plan, now=_at(23, 30))
+    assert backfill.in_window(plan, now=_at(5, 59))
+    assert not backfill.in_window(plan, now=_at(12, 0))
+
+
+def _at(hour, minute):
+    return datetime(2024, 1, 1, hour, minute)
@@ -0,0 +1,30 @@
+import io
+
+import pytest
+
+import bulk_import
+
+
+def _rows(data):
+    return list(bulk_import.read_rows(io.BytesIO(data), bulk_import.FORMAT_JSON))
+
+
+def test_json_array_is_streamed_element_by_element():
+    rows = _rows(b'[{"timestamp": 1700000000, "weight": 80.5}, {"timestamp": 1700086400, "weight": 80.1}]')
+    assert rows == [(1, {"timestamp": 1700000000, "weight": 80.5}), (2, {"timestamp": 1700086400, "weight": 80.1})]
+
+
+def test_truncated_json_array_is_an_invalid_file():
+    with pytest.raises(bulk_import.InvalidFileError, match="truncated or malformed"):
+        _rows(b'[{"timestamp": 1700000000, "weight": 80.5}, {"weig')
+
+
+def test_unclosed_json_array_is_an_invalid_file():
+    with pytest.raises(bulk_import.InvalidFileError):
+        _rows(b'[{"timestamp": 1700000000, "weight": 80.5}')
+
+
+def test_bad_ndjson_line_is_an_invalid_row():
+    rows = _rows(b'{"timestamp": 1700000000, "weight": 80.5}\n{"weig\n')
+    assert rows[0] == (1, {"timestamp": 1700000000, "weight": 80.5})
+    assert isinstance(rows[1][1], bulk_import.RowError)
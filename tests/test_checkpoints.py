@@ -0,0 +1,53 @@
+import sqlite3
+
+import checkpoints
+
+
+def test_kinds_only_resume_their_own_jobs(db):
+    historical = checkpoints.start(None, 1000, 2000)
+    historical.finish(False)
+    export = checkpoints.start(None, 3000, 4000, checkpoints.KIND_EXPORT)
+    export.finish(False)
+
+    assert checkpoints.latest_resumable()['id'] == historical.id
+    assert checkpoints.latest_resumable(None, checkpoints.KIND_EXPORT)['id'] == export.id
+    assert checkpoints.latest_resumable(1) is None
+
+
+def test_interrupted_job_resumes_after_the_last_group(db):
+    checkpoint = checkpoints.start(None, 1000, 2000)
+    checkpoint.advance(1500, 7)
+    assert checkpoints.interrupt_running() == 1
+
+    resumed = checkpoints.resume(checkpoints.latest_resumable()['id'])
+    assert (resumed.resume_from, resumed.processed) == (1501, 1)
+    assert checkpoints.latest_resumable() is None
+
+
+def test_checkpoints_without_kind_are_historical(db):
+    with sqlite3.connect(db) as conn:
+        conn.execute('''CREATE TABLE sync_checkpoints
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT, account_id INTEGER NOT NULL, start_ts INTEGER NOT NULL,
+                         end_ts INTEGER NOT NULL, last_date INTEGER, last_grpid INTEGER,
+                         processed INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, created_at INTEGER, updated_at INTEGER)''')
+        conn.execute("INSERT INTO sync_checkpoints (account_id, start_ts, end_ts, status) VALUES (0, 1000, 2000, ?)",
+                     (checkpoints.STATUS_INTERRUPTED,))
+    checkpoints.init_db(db)
+    assert checkpoints.latest_resumable()['kind'] == checkpoints.KIND_HISTORICAL
+    assert checkpoints.latest_resumable(None, checkpoints.KIND_EXPORT) is None
+
+
+def test_startup_only_interrupts_jobs_of_this_instance(db):
+    own = checkpoints.start(None, 1000, 2000)
+    other = checkpoints.start(None, 3000, 4000)
+    gone = checkpoints.start(None, 5000, 6000)
+    with sqlite3.connect(db) as conn:
+        conn.execute("UPDATE sync_checkpoints SET owner='other-replica' WHERE id IN (?, ?)", (other.id, gone.id))
+        conn.execute("UPDATE sync_checkpoints SET updated_at=updated_at-? WHERE id=?",
+                     (checkpoints.STALE_SECONDS + 1, gone.id))
+
+    assert checkpoints.interrupt_running() == 2
+    with sqlite3.connect(db) as conn:
+        statuses = dict(conn.execute("SELECT id, status FROM sync_checkpoints"))
+    assert statuses == {own.id: checkpoints.STATUS_INTERRUPTED, other.id: checkpoints.STATUS_RUNNING,
+                        gone.id: checkpoints.STATUS_INTERRUPTED}
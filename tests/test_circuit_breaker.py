@@ -0,0 +1,111 @@
+import sqlite3
+import time
+
+import pytest
+import requests
+from garminconnect import GarminConnectAuthenticationError
+
+import accounts
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, is_outage
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def _fail(exc):
+    def func():
+        raise exc
+    return func
+
+
+def _age(breaker, seconds):
+    """Moves the breaker's opening back in time."""
+    with sqlite3.connect(accounts.DB_PATH) as conn:
+        conn.execute("UPDATE circuit_breakers SET opened_at=opened_at-?, updated_at=updated_at-? WHERE name=?",
+                     (seconds, seconds, breaker.name))
+
+
+@pytest.fixture
+def breaker(db):
+    return CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+
+
+def test_is_outage():
+    assert is_outage(requests.ConnectionError())
+    assert is_outage(_http_error(503))
+    assert not is_outage(_http_error(404))
+    assert not is_outage(GarminConnectAuthenticationError("bad password"))
+    try:
+        try:
+            raise requests.Timeout()
+        except requests.Timeout as e:
+            raise RuntimeError("upload failed") from e
+    except RuntimeError as e:
+        assert is_outage(e)
+
+
+def test_only_outages_count(breaker):
+    for _ in range(3):
+        with pytest.raises(GarminConnectAuthenticationError):
+            breaker.call(_fail(GarminConnectAuthenticationError("bad password")))
+    assert breaker.status()['failures'] == 0
+    assert breaker.state() == CLOSED
+
+
+def test_opens_after_threshold_and_rejects_calls(breaker):
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            breaker.call(_fail(requests.ConnectionError()))
+    assert breaker.state() == OPEN
+    calls = []
+    with pytest.raises(CircuitOpenError) as info:
+        breaker.call(lambda: calls.append(1))
+    assert calls == []
+    assert info.value.retry_at > time.time()
+
+
+def test_half_open_admits_a_single_trial(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    _age(breaker, 61)
+    assert breaker.state() == HALF_OPEN
+    assert breaker.enter() is True
+    # The trial is running: everyone else is rejected
+    with pytest.raises(CircuitOpenError):
+        breaker.enter()
+    breaker.record_success()
+    assert breaker.state() == CLOSED
+    assert breaker.enter() is False
+
+
+def test_failed_trial_reopens(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    _age(breaker, 61)
+    with pytest.raises(requests.ConnectionError):
+        breaker.call(_fail(requests.ConnectionError()))
+    assert breaker.state() == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.enter()
+
+
+def test_trial_without_outage_is_released(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    _age(breaker, 61)
+    with pytest.raises(GarminConnectAuthenticationError):
+        breaker.call(_fail(GarminConnectAuthenticationError("bad password")))
+    # Neither success nor outage: the next caller gets the trial right away
+    assert breaker.enter() is True
+
+
+def test_abandoned_trial_can_be_taken_over(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    _age(breaker, 61)
+    assert breaker.enter() is True
+    _age(breaker, 61)
+    assert breaker.enter() is True
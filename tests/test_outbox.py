@@ -0,0 +1,53 @@
+import time
+
+import config
+import outbox
+
+PAYLOAD = {'timestamp': '2024-01-01T08:00:00', 'weight': 80.0}
+
+
+def _entry(entry_id):
+    return next(entry for entry in outbox.list_entries() if entry['id'] == entry_id)
+
+
+def test_backoff_delay_doubles_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_BASE_DELAY', 300)
+    monkeypatch.setattr(config, 'OUTBOX_MAX_DELAY', 2000)
+    assert [outbox.backoff_delay(n) for n in (0, 1, 2, 3, 4, 5)] == [300, 300, 600, 1200, 2000, 2000]
+
+
+def test_enqueue_counts_the_failed_attempt_once(db):
+    entry_id = outbox.enqueue(None, 'weight', PAYLOAD, "timeout")
+    assert outbox.enqueue(None, 'weight', dict(PAYLOAD), "timeout") == entry_id
+    entry = _entry(entry_id)
+    assert entry['attempts'] == 1
+    assert entry['status'] == outbox.STATUS_PENDING
+    assert entry['payload'] == PAYLOAD
+
+
+def test_mark_failed_schedules_the_next_attempt(db):
+    entry_id = outbox.enqueue(None, 'weight', PAYLOAD)
+    before = int(time.time())
+    outbox.mark_failed(entry_id, "HTTP 500")
+    entry = _entry(entry_id)
+    assert entry['attempts'] == 2
+    assert entry['last_error'] == "HTTP 500"
+    assert entry['next_attempt_at'] >= before + outbox.backoff_delay(2)
+    assert outbox.due_entries() == []
+
+
+def test_mark_failed_dead_letters_after_max_attempts(db, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_MAX_ATTEMPTS', 3)
+    entry_id = outbox.enqueue(None, 'weight', PAYLOAD)
+    outbox.mark_failed(entry_id, "HTTP 500")
+    assert _entry(entry_id)['status'] == outbox.STATUS_PENDING
+    outbox.mark_failed(entry_id, "HTTP 502")
+    entry = _entry(entry_id)
+    assert entry['status'] == outbox.STATUS_DEAD
+    assert entry['attempts'] == 3
+    assert entry['next_attempt_at'] is None
+
+    outbox.retry(entry_id)
+    entry = _entry(entry_id)
+    assert (entry['status'], entry['attempts']) == (outbox.STATUS_PENDING, 0)
+    assert [e['id'] for e in outbox.due_entries()] == [entry_id]
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import pipeline
+from measurements import MeasurementGroup
+
+
+class _Lease:
+    def __init__(self, valid):
+        self._valid = valid
+
+    def valid(self):
+        return self._valid
+
+
+class _Sink:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, record, row=None, bp_duplicate=False):
+        self.sent.append(record)
+        return 'synced'
+
+
+def _upload(lease):
+    record = MeasurementGroup(1, 1700000000)
+    record.weight = 80.0
+    sync_pipeline = pipeline.SyncPipeline(None, None, lease=lease)
+    garmin, fan_out = _Sink(), _Sink()
+
+    async def run():
+        queue = asyncio.Queue()
+        await queue.put((record, False, record))
+        await queue.put(pipeline._END)
+        await sync_pipeline._upload_all(queue, garmin, fan_out)
+
+    return run, garmin
+
+
+def test_upload_stops_once_the_lease_is_lost(db):
+    run, garmin = _upload(_Lease(False))
+    with pytest.raises(pipeline.LeaseLost):
+        asyncio.run(run())
+    assert garmin.sent == []
+
+
+def test_upload_goes_ahead_with_a_valid_lease(db):
+    run, garmin = _upload(_Lease(True))
+    asyncio.run(run())
+    assert len(garmin.sent) == 1
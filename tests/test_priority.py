@@ -0,0 +1,40 @@
+import threading
+
+import accounts
+import priority
+
+
+def test_interactive_job_starts_while_bulk_lane_is_full():
+    gate = priority.PriorityGate(threading.Event())
+    pool = accounts.AccountSyncPool(1)
+    release = threading.Event()
+    try:
+        # Bulk jobs of other accounts occupy (and queue behind) every bulk thread
+        pool.submit_bulk(1, release.wait)
+        pool.submit_bulk(2, release.wait)
+
+        def interactive():
+            with gate.interactive():
+                return gate.interactive_running(), gate.in_interactive()
+
+        assert pool.submit(3, interactive).result(timeout=5) == (True, True)
+        assert not gate.interactive_running()
+        assert not gate.in_interactive()
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_account_with_a_job_rejects_a_second_one():
+    pool = accounts.AccountSyncPool(2)
+    release = threading.Event()
+    try:
+        assert pool.submit_bulk(1, release.wait) is not None
+        assert pool.submit_bulk(1, release.wait) is None
+        # Interactive work may still run next to the account's bulk job
+        interactive = pool.submit(1, release.wait)
+        assert interactive is not None
+        assert pool.submit(1, release.wait) is None
+    finally:
+        release.set()
+        pool.shutdown()
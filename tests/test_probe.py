@@ -0,0 +1,42 @@
+import asyncio
+import contextlib
+
+import accounts
+import probe
+import sync_engine
+
+
+def _group(grpid, date, mtype=1, value=80000):
+    return {'grpid': grpid, 'date': date, 'category': 1, 'measures': [{'type': mtype, 'value': value, 'unit': -3}]}
+
+
+def _fake_withings(monkeypatch, groups):
+    calls = []
+
+    async def access_token(session, settings):
+        return 'token'
+
+    async def fetch(session, access_token, **kwargs):
+        calls.append(kwargs)
+        return groups
+
+    monkeypatch.setattr(sync_engine, 'client_session', contextlib.nullcontext)
+    monkeypatch.setattr(sync_engine, 'get_access_token', access_token)
+    monkeypatch.setattr(sync_engine, 'fetch_measure_groups', fetch)
+    return calls
+
+
+def test_counts_every_changed_group_and_the_oldest_date(db, monkeypatch):
+    calls = _fake_withings(monkeypatch, [_group(1, 5000), _group(2, 900), _group(3, 6000, mtype=4, value=1800)])
+    probe.mark_checked(None, 1000)
+
+    new_groups, checked_at, since = asyncio.run(probe.check_for_changes())
+
+    # Every page is read, not only the first one
+    assert calls == [{'lastupdate': 1000}]
+    # The height-only group is not a change
+    assert new_groups == 2
+    assert since == 900
+    assert accounts.get_cursor(None, 'probe_lastupdate') == '1000'
+    probe.mark_checked(None, checked_at)
+    assert accounts.get_cursor(None, 'probe_lastupdate') == str(checked_at)
@@ -0,0 +1,70 @@
+import measurement_store
+import reconcile
+from reconcile import KeySet, Reconciler, bp_key, garmin_weight_key, weight_key
+
+
+def _measure(mtype, value, unit):
+    return {'type': mtype, 'value': value, 'unit': unit}
+
+
+def test_weight_key_matches_withings_and_garmin_values():
+    # Withings: 72.35 kg as 72350 * 10^-3, Garmin: 72350 g; as floats they differ in the last bits
+    withings = weight_key(1700000000, 72350 * 10 ** -3)
+    garmin = garmin_weight_key({'timestampGMT': 1700000000000, 'weight': 72350.0})
+    assert withings == garmin == (1700000000, 72350)
+
+
+def test_weight_key_rounds_to_grams():
+    assert weight_key(1700000000.4, 80.0004) == (1700000000, 80000)
+    assert weight_key(1700000000, 80.0004) != weight_key(1700000000, 80.001)
+
+
+def test_garmin_weight_key_needs_timestamp_and_weight():
+    assert garmin_weight_key({'date': 1700000000000, 'weight': 80000}) == (1700000000, 80000)
+    assert garmin_weight_key({'timestampGMT': 1700000000000}) is None
+    assert garmin_weight_key({'weight': 80000}) is None
+
+
+def test_key_set_matches_within_match_seconds():
+    keys = KeySet([weight_key(1000, 80.0), bp_key(5000, 120, 80, 60)])
+    assert weight_key(1000 + reconcile.MATCH_SECONDS, 80.0) in keys
+    assert weight_key(1000 - reconcile.MATCH_SECONDS, 80.0) in keys
+    assert weight_key(1001 + reconcile.MATCH_SECONDS, 80.0) not in keys
+    assert weight_key(1000, 80.1) not in keys
+    assert bp_key(5030, 120, 80, 60) in keys
+    assert bp_key(5030, 120, 80, None) not in keys
+    assert len(keys) == 2
+    assert sorted(keys) == [(1000, 80000), (5000, 120, 80, 60)]
+
+
+def _reconciler():
+    reconciler = Reconciler(None, 1700000000, 1700086400)
+    weight = weight_key(1700000000, 80.0)
+    bp = bp_key(1700000000, 120, 80, 60)
+    reconciler.weight_groups[('2023-11-14', weight)] = [1]
+    reconciler.bp_groups[('2023-11-14', bp)] = [1]
+    group = {'grpid': 1, 'date': 1700000000, 'category': 1, 'measures': [
+        _measure(1, 80000, -3), _measure(10, 120, 0), _measure(9, 80, 0), _measure(11, 60, 0)]}
+    return reconciler, weight, bp, group
+
+
+def test_groups_to_send_keeps_missing_measurements(monkeypatch):
+    reconciler, weight, bp, group = _reconciler()
+    monkeypatch.setattr(measurement_store, 'load_groups', lambda account, grpids: [dict(group)])
+    pages = reconciler.groups_to_send([{'date': '2023-11-14', 'missing_weights': [weight], 'missing_bp': [bp]}])
+    assert [(day, [m['type'] for m in groups[0]['measures']]) for day, groups in pages] == \
+        [('2023-11-14', [1, 10, 9, 11])]
+
+
+def test_groups_to_send_drops_measurements_garmin_has(monkeypatch):
+    reconciler, weight, bp, group = _reconciler()
+    monkeypatch.setattr(measurement_store, 'load_groups', lambda account, grpids: [dict(group)])
+    # Only the blood pressure is missing: the weigh-in is not sent again
+    pages = reconciler.groups_to_send([{'date': '2023-11-14', 'missing_weights': [], 'missing_bp': [bp]}])
+    assert [m['type'] for m in pages[0][1][0]['measures']] == [10, 9, 11]
+
+    # Garmin has both (a few seconds off): nothing is left to send
+    reconciler.garmin_weights.add(weight_key(1700000010, 80.0))
+    reconciler.garmin_bps.add(bp_key(1700000010, 120, 80, 60))
+    pages = reconciler.groups_to_send([{'date': '2023-11-14', 'missing_weights': [weight], 'missing_bp': [bp]}])
+    assert pages == []
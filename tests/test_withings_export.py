@@ -0,0 +1,51 @@
+import pytest
+
+import sync_app
+from measurements import decode_group
+from withings_export import _column, bp_group, weight_group
+
+TS = 1700000000
+
+
+def test_column_splits_name_and_unit():
+    assert _column('Weight (kg)') == ('weight', 'kg')
+    assert _column(' Fat mass (lb) ') == ('fat mass', 'lb')
+    assert _column('Date') == ('date', '')
+
+
+def test_weight_group_converts_fat_mass_to_ratio():
+    group = weight_group(TS, {'weight': ('kg', '80'), 'fat mass': ('kg', '16'), 'bone mass': ('kg', '3.2')})
+    assert group['grpid'] < 0
+    assert group['date'] == TS
+    record = decode_group(group)
+    assert record.weight == pytest.approx(80.0)
+    assert record.fat_ratio == pytest.approx(20.0)
+    assert record.bone_mass == pytest.approx(3.2)
+
+
+def test_weight_group_converts_pounds():
+    group = weight_group(TS, {'weight': ('lb', '176.37'), 'fat mass': ('lb', '35.27')})
+    record = decode_group(group)
+    assert record.weight == pytest.approx(176.37 * sync_app.LB_TO_KG, abs=1e-3)
+    assert record.fat_ratio == pytest.approx(35.27 / 176.37 * 100, abs=1e-3)
+
+
+def test_weight_group_uses_fat_ratio_column_without_fat_mass():
+    record = decode_group(weight_group(TS, {'weight': ('kg', '80'), 'fat ratio': ('%', '21.5')}))
+    assert record.fat_ratio == pytest.approx(21.5)
+
+
+def test_weight_group_needs_a_weight():
+    assert weight_group(TS, {'fat mass': ('kg', '16')}) is None
+
+
+def test_bp_group():
+    group = bp_group(TS, {'systolic': ('mmhg', '121'), 'diastolic': ('mmhg', '79'), 'heart rate': ('bpm', '64')})
+    record = decode_group(group)
+    assert (record.systolic, record.diastolic, record.heart_rate) == (121, 79, 64)
+    assert group['grpid'] < 0
+    assert group['grpid'] != weight_group(TS, {'weight': ('kg', '80')})['grpid']
+
+
+def test_bp_group_needs_systolic_and_diastolic():
+    assert bp_group(TS, {'systolic': ('mmhg', '121'), 'heart rate': ('bpm', '64')}) is None
@@ -0,0 +1,376 @@
+"""
+Columnar cache of decoded measurements for trend queries.
+
+Every account has a directory under data/timeseries/ with one file per column: the
+record timestamps (int64 epoch seconds, ascending) and one float64 file per value
+(NaN = missing). Syncs append to the files (pipeline sink, see sinks.TimeseriesSink);
+records older than the newest cached one are merged in by rewriting the columns.
+Rolling averages are computed when records are written and kept as columns of their
+own. Queries memory-map the files and binary-search the timestamp column, so a
+multi-year range is answered from local disk in milliseconds without any network access;
+trends() downsamples it to a fixed number of points for charts.
+"""
+import argparse
+import bisect
+import math
+import mmap
+import os
+import shutil
+import threading
+import time
+from array import array
+
+import accounts
+import config
+import measurement_store
+from measurements import GroupCoalescer, decode_page
+
+TIMESERIES_DIR = os.path.join(accounts.DATA_DIR, 'timeseries')
+
+COLUMNS = ('weight', 'fat_ratio', 'muscle_mass', 'bone_mass', 'hydration', 'systolic', 'diastolic', 'heart_rate')
+
+# Derived column -> (source column, days): mean of the source values of the trailing days,
+# set on the records that have a source value
+ROLLING = {
+    'weight_avg7': ('weight', 7),
+    'weight_avg30': ('weight', 30),
+    'fat_ratio_avg7': ('fat_ratio', 7),
+    'systolic_avg7': ('systolic', 7),
+    'diastolic_avg7': ('diastolic', 7),
+}
+
+ALL_COLUMNS = COLUMNS + tuple(ROLLING)
+
+# Series returned by trends()
+TREND_SERIES = ('weight', 'weight_avg7', 'weight_avg30', 'fat_ratio', 'fat_ratio_avg7',
+                'systolic', 'systolic_avg7', 'diastolic', 'diastolic_avg7')
+
+METHOD_LTTB = 'lttb'
+METHOD_MINMAX = 'minmax'
+METHODS = (METHOD_LTTB, METHOD_MINMAX)
+
+_TIMESTAMP_FILE = 'timestamp.i64'
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(account):
+    with _locks_lock:
+        return _locks.setdefault(accounts._account_key(account), threading.Lock())
+
+
+def series_dir(account=None):
+    return os.path.join(TIMESERIES_DIR, str(accounts._account_key(account)))
+
+
+def _column_file(directory, column):
+    return os.path.join(directory, f"{column}.f64")
+
+
+def _files(directory):
+    return [os.path.join(directory, _TIMESTAMP_FILE)] + [_column_file(directory, c) for c in ALL_COLUMNS]
+
+
+def _sizes(directory):
+    """Records per file (None for a missing file)."""
+    return [os.path.getsize(path) // 8 if os.path.exists(path) else None for path in _files(directory)]
+
+
+def _repair(directory):
+    """
+    Finishes an interrupted rewrite and cuts the columns to a common length (an append
+    interrupted half way leaves some columns one record longer). Columns added in a later
+    version are filled in. Returns the record count.
+    """
+    backup = directory + '.old'
+    if not os.path.isdir(directory) and os.path.isdir(backup):
+        os.replace(backup, directory)
+    shutil.rmtree(backup, ignore_errors=True)
+    if not os.path.isdir(directory):
+        return 0
+    sizes = _sizes(directory)
+    count = min((size for size in sizes if size is not None), default=0) if sizes[0] is not None else 0
+    for path, size in zip(_files(directory), sizes):
+        if size is not None and size > count:
+            with open(path, 'r+b') as f:
+                f.truncate(count * 8)
+    if None in sizes:
+        if count:
+            _rewrite(directory, *_load(directory, count))
+        else:
+            _write_all(directory, array('q'), {c: array('d') for c in ALL_COLUMNS}, 'ab')
+    return count
+
+
+def _load(directory, count):
+    """Reads the whole columns (missing ones as NaN)."""
+    timestamps = array('q')
+    with open(os.path.join(directory, _TIMESTAMP_FILE), 'rb') as f:
+        timestamps.fromfile(f, count)
+    values = {}
+    for column in COLUMNS:
+        values[column] = array('d')
+        path = _column_file(directory, column)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                values[column].fromfile(f, count)
+        else:
+            values[column] = array('d', [math.nan]) * count
+    return timestamps, values
+
+
+class Columns:
+    """Read-only memory-mapped view of an account's columns (use as a context manager)."""
+
+    def __init__(self, account=None):
+        self.directory = series_dir(account)
+        self._maps = []
+        self.timestamps = memoryview(b'').cast('q')
+        self.columns = {}
+
+    def _map(self, path, fmt, count):
+        if not count:
+            return memoryview(b'').cast(fmt)
+        if not os.path.exists(path):
+            # Column of a later version, filled in by the next write
+            return memoryview(array('d', [math.nan]) * count)
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), count * 8, access=mmap.ACCESS_READ)
+        view = memoryview(mm).cast(fmt)
+        self._maps.append((mm, view))
+        return view
+
+    def __enter__(self):
+        # Readers never repair: a sync in another process may be appending right now
+        count = min((size for size in _sizes(self.directory) if size is not None), default=0)
+        self.timestamps = self._map(os.path.join(self.directory, _TIMESTAMP_FILE), 'q', count)
+        self.columns = {c: self._map(_column_file(self.directory, c), 'd', count) for c in ALL_COLUMNS}
+        return self
+
+    def __exit__(self, *exc):
+        for mm, view in self._maps:
+            view.release()
+            mm.close()
+        self._maps = []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def bounds(self, start_ts, end_ts):
+        """Index range [lo, hi) of the records measured in [start_ts, end_ts]."""
+        return (bisect.bisect_left(self.timestamps, start_ts),
+                bisect.bisect_right(self.timestamps, end_ts))
+
+
+def query(account=None, start_ts=0, end_ts=None, columns=ALL_COLUMNS):
+    """
+    Returns (timestamps, {column: values}) of the records in [start_ts, end_ts] as
+    array('q') / array('d') (NaN = missing).
+    """
+    end_ts = end_ts if end_ts is not None else 2 ** 62
+    with Columns(account) as cached:
+        lo, hi = cached.bounds(start_ts, end_ts)
+        timestamps = array('q', cached.timestamps[lo:hi])
+        values = {c: array('d', cached.columns[c][lo:hi]) for c in columns}
+    return timestamps, values
+
+
+def count(account=None):
+    with Columns(account) as cached:
+        return len(cached)
+
+
+def _arrays(records):
+    timestamps = array('q', (ts for ts, _ in records))
+    values = {c: array('d', (v.get(c) if v.get(c) is not None else math.nan for _, v in records)) for c in COLUMNS}
+    return timestamps, values
+
+
+def _rolling(timestamps, values, days, start=0):
+    """Trailing `days` means of values[start:] (records before start only feed the window)."""
+    window = days * 86400
+    result = array('d')
+    lo, total, n = 0, 0.0, 0
+    for i, value in enumerate(values):
+        if not math.isnan(value):
+            total += value
+            n += 1
+        while timestamps[lo] <= timestamps[i] - window:
+            if not math.isnan(values[lo]):
+                total -= values[lo]
+                n -= 1
+            lo += 1
+        if i >= start:
+            result.append(total / n if n and not math.isnan(value) else math.nan)
+    return result
+
+
+def _with_rolling(timestamps, values, start=0):
+    """Adds the ROLLING columns for the records from `start` on; returns the columns from `start` on."""
+    result = {c: values[c][start:] for c in COLUMNS}
+    for column, (source, days) in ROLLING.items():
+        result[column] = _rolling(timestamps, values[source], days, start)
+    return timestamps[start:], result
+
+
+def _write_all(directory, timestamps, values, mode):
+    os.makedirs(directory, exist_ok=True)
+    # Value columns first: an interrupted append is cut back to the timestamp column by _repair
+    for column in ALL_COLUMNS:
+        with open(_column_file(directory, column), mode) as f:
+            values[column].tofile(f)
+    with open(os.path.join(directory, _TIMESTAMP_FILE), mode) as f:
+        timestamps.tofile(f)
+
+
+def _rewrite(directory, timestamps, values):
+    """Replaces all columns at once (new directory, then swapped in)."""
+    timestamps, values = _with_rolling(timestamps, values)
+    staging = directory + '.new'
+    shutil.rmtree(staging, ignore_errors=True)
+    _write_all(staging, timestamps, values, 'wb')
+    if os.path.isdir(directory):
+        os.replace(directory, directory + '.old')
+    os.replace(staging, directory)
+    shutil.rmtree(directory + '.old', ignore_errors=True)
+
+
+def extend(account, records):
+    """
+    Adds (timestamp, {column: value}) records. Newer than everything cached: appended.
+    Otherwise merged in (a record at an already cached timestamp replaces it).
+    """
+    records = sorted(dict(records).items())
+    if not records:
+        return 0
+    directory = series_dir(account)
+    with _lock(account):
+        existing = _repair(directory)
+        last = None
+        if existing:
+            with open(os.path.join(directory, _TIMESTAMP_FILE), 'rb') as f:
+                f.seek((existing - 1) * 8)
+                last = array('q', f.read(8))[0]
+
+        if last is None or records[0][0] > last:
+            # The rolling windows of the new records reach back into the cached ones
+            longest = max(days for _, days in ROLLING.values()) * 86400
+            timestamps, values = query(account, records[0][0] - longest, last or 0, COLUMNS)
+            start = len(timestamps)
+            new_timestamps, new_values = _arrays(records)
+            timestamps.extend(new_timestamps)
+            for column in COLUMNS:
+                values[column].extend(new_values[column])
+            _write_all(directory, *_with_rolling(timestamps, values, start), 'ab')
+            return len(records)
+
+        timestamps, values = query(account, columns=COLUMNS)
+        merged = {ts: {c: values[c][i] for c in COLUMNS} for i, ts in enumerate(timestamps)}
+        for ts, record in records:
+            merged[ts] = record
+        _rewrite(directory, *_arrays(sorted(merged.items())))
+        return len(records)
+
+
+def rebuild(account=None):
+    """Recreates the cache from the local measurement store (merging split groups like syncs do)."""
+    records = []
+
+    def add(done):
+        if done:
+            record = done[0]
+            if record.has_weight or record.has_bp:
+                records.append((record.date, {c: getattr(record, c) for c in COLUMNS}))
+
+    coalescer = GroupCoalescer(config.MERGE_WINDOW_SECONDS)
+    for groups in measurement_store.iter_pages(account, 0, int(time.time()) + 86400):
+        for record in decode_page(groups).rows():
+            add(coalescer.add(record))
+    add(coalescer.flush())
+
+    with _lock(account):
+        _rewrite(series_dir(account), *_arrays(sorted(dict(records).items())))
+    return len(records)
+
+
+# --- Downsampling ---
+
+def lttb(xs, ys, budget):
+    """Largest-Triangle-Three-Buckets: indexes of at most `budget` points keeping the shape of the line."""
+    n = len(xs)
+    if budget >= n:
+        return list(range(n))
+    if budget < 3:
+        return [0, n - 1][:max(0, budget)]
+    picked = [0]
+    size = (n - 2) / (budget - 2)
+    a = 0
+    for bucket in range(budget - 2):
+        start = int(bucket * size) + 1
+        end = int((bucket + 1) * size) + 1
+        # Average of the next bucket (or the last point) as the third triangle corner
+        next_start, next_end = end, min(int((bucket + 2) * size) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+        best, best_area = start, -1.0
+        for i in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[i] - ys[a]) - (xs[a] - xs[i]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = i, area
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+    return picked
+
+
+def minmax(xs, ys, budget):
+    """Indexes of the lowest and highest point of budget / 2 equal-width time buckets."""
+    n = len(xs)
+    if budget >= n:
+        return list(range(n))
+    buckets = max(1, budget // 2)
+    width = (xs[-1] - xs[0]) / buckets or 1
+    picked = []
+    i = 0
+    for bucket in range(buckets):
+        limit = xs[0] + (bucket + 1) * width
+        low = high = None
+        while i < n and (xs[i] <= limit or bucket == buckets - 1):
+            if low is None or ys[i] < ys[low]:
+                low = i
+            if high is None or ys[i] > ys[high]:
+                high = i
+            i += 1
+        if low is not None:
+            picked.extend(sorted({low, high}))
+    return picked
+
+
+def trends(account=None, start_ts=0, end_ts=None, points=300, method=METHOD_LTTB, series=TREND_SERIES):
+    """
+    The series of [start_ts, end_ts] downsampled to at most `points` points each:
+    {'count': records in range, 'series': {name: [[timestamp, value], ...]}}.
+    """
+    pick = minmax if method == METHOD_MINMAX else lttb
+    timestamps, values = query(account, start_ts, end_ts, series)
+    result = {}
+    for name in series:
+        present = [i for i, value in enumerate(values[name]) if not math.isnan(value)]
+        xs = [timestamps[i] for i in present]
+        ys = [values[name][i] for i in present]
+        result[name] = [[xs[i], round(ys[i], 2)] for i in pick(xs, ys, points)]
+    return {'count': len(timestamps), 'series': result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the local trend cache from the stored measurements.')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    args = parser.parse_args()
+    print(f"Cached {rebuild(args.account)} measurement(s).")
+
+
+if __name__ == "__main__":
+    main()
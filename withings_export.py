@@ -0,0 +1,310 @@
+"""
+Offline import of a Withings data export.
+
+The archive from Withings' "Download your data" contains weight.csv, bp.csv and
+height.csv. Its members are streamed straight out of the zip (nothing is extracted)
+and every CSV row becomes a measure group in the format getmeas returns, so the
+import runs through the regular decode -> merge -> dedup -> upload pipeline without a
+single Withings API call. Rows are first written to the local measurement store page
+by page, which orders them by date whatever the order of the file (exports list the
+newest first), and are then replayed from there oldest first. Export rows have no
+Withings ids, so before a page is replayed its weigh-ins are matched (reconcile keys)
+against the groups synced from the API and Garmin's weigh-ins of the same dates (the
+pipeline itself only checks blood pressure readings for duplicates).
+"""
+import argparse
+import asyncio
+import csv
+import io
+import os
+import re
+import zipfile
+from datetime import datetime
+
+import tzlocal
+
+import accounts
+import checkpoints
+import circuit_breaker
+import height_series
+import measurement_store
+import pipeline
+import reconcile
+import sync_app
+import sync_engine
+from measurements import decode_group, decode_page
+
+WEIGHT_FILE = 'weight.csv'
+BP_FILE = 'bp.csv'
+HEIGHT_FILE = 'height.csv'
+
+# Groups written to / read from the measurement store at a time
+PAGE_SIZE = 500
+
+# Export column (lower case, without unit) -> Withings measure type
+WEIGHT_COLUMNS = {'weight': 1, 'bone mass': 88, 'muscle mass': 76, 'hydration': 77}
+BP_COLUMNS = {'systolic': 10, 'diastolic': 9, 'heart rate': 11, 'pulse': 11}
+TYPE_FAT_RATIO = 6
+
+# Synthetic group ids: export rows have no grpid. Negative so they never collide with
+# Withings' ids, and derived from the timestamp so each row is stored once however often
+# the archive is imported.
+_KIND_WEIGHT = 1
+_KIND_BP = 2
+
+_COLUMN = re.compile(r'^\s*([^(]*?)\s*(?:\(([^)]*)\))?\s*$')
+
+
+def _column(header):
+    """'Weight (kg)' -> ('weight', 'kg')"""
+    name, unit = _COLUMN.match(header or '').groups()
+    return name.lower(), (unit or '').strip().lower()
+
+
+def _grpid(kind, ts):
+    return -(ts * 4 + kind)
+
+
+def _measure(mtype, value, decimals=3):
+    return {'type': mtype, 'value': int(round(value * 10 ** decimals)), 'unit': -decimals}
+
+
+def _number(value):
+    value = (value or '').strip()
+    return float(value) if value else None
+
+
+def _find_member(archive, name):
+    for info in archive.infolist():
+        if os.path.basename(info.filename).lower() == name:
+            return info
+    return None
+
+
+def _rows(archive, name):
+    """
+    Yields (timestamp, {column: (unit, value)}) for the rows of an archive member, streamed.
+    The timestamp is None for rows with an unreadable date.
+    """
+    info = _find_member(archive, name)
+    if info is None:
+        return
+    local_tz = tzlocal.get_localzone()
+    with archive.open(info) as member:
+        reader = csv.reader(io.TextIOWrapper(member, encoding='utf-8-sig', newline=''))
+        header = [_column(h) for h in next(reader, [])]
+        for row in reader:
+            values = {}
+            date = None
+            for (column, unit), value in zip(header, row):
+                if column == 'date':
+                    date = value
+                elif value.strip():
+                    values[column] = (unit, value)
+            if not date:
+                continue
+            # Exports are in the account's local time (the server's TZ)
+            try:
+                dt = datetime.fromisoformat(date.strip())
+            except ValueError:
+                yield None, values
+                continue
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=local_tz)
+            yield int(dt.timestamp()), values
+
+
+def _mass(unit, value):
+    return value * sync_app.LB_TO_KG if value and unit in ('lb', 'lbs') else value
+
+
+def weight_group(ts, values):
+    """Measure group of a weight.csv row, or None if it has no weight."""
+    masses = {column: _mass(unit, _number(value)) for column, (unit, value) in values.items()
+              if column in WEIGHT_COLUMNS or column == 'fat mass'}
+    weight = masses.get('weight')
+    if not weight:
+        return None
+    measures = [_measure(WEIGHT_COLUMNS[column], value) for column, value in masses.items()
+                if column in WEIGHT_COLUMNS and value]
+    # The export has the fat mass, Garmin wants the fat ratio
+    if masses.get('fat mass'):
+        measures.append(_measure(TYPE_FAT_RATIO, masses['fat mass'] / weight * 100))
+    elif 'fat ratio' in values:
+        measures.append(_measure(TYPE_FAT_RATIO, _number(values['fat ratio'][1])))
+    return {'grpid': _grpid(_KIND_WEIGHT, ts), 'date': ts, 'category': 1, 'measures': measures}
+
+
+def bp_group(ts, values):
+    """Measure group of a bp.csv row, or None without systolic and diastolic values."""
+    numbers = {BP_COLUMNS[column]: _number(value) for column, (_, value) in values.items() if column in BP_COLUMNS}
+    if not numbers.get(10) or not numbers.get(9):
+        return None
+    measures = [_measure(mtype, value, 0) for mtype, value in numbers.items() if value]
+    return {'grpid': _grpid(_KIND_BP, ts), 'date': ts, 'category': 1, 'measures': measures}
+
+
+def read_heights(archive):
+    heights = []
+    for ts, values in _rows(archive, HEIGHT_FILE):
+        if ts is None:
+            continue
+        for column, (unit, value) in values.items():
+            if column == 'height' and _number(value):
+                height = _number(value)
+                heights.append((ts, height / 100 if unit == 'cm' else height))
+    return heights
+
+
+def ingest(path, account=None):
+    """
+    Streams weight.csv and bp.csv of an export archive into the measurement store.
+    Returns (groups stored, first timestamp, last timestamp, skipped rows).
+    """
+    stored, skipped = 0, 0
+    first = last = None
+    with zipfile.ZipFile(path) as archive:
+        for name, to_group in ((WEIGHT_FILE, weight_group), (BP_FILE, bp_group)):
+            print(f"Reading {name}...")
+            page = []
+            for ts, values in _rows(archive, name):
+                try:
+                    group = ts and to_group(ts, values)
+                except ValueError:
+                    group = None
+                if group is None:
+                    skipped += 1
+                    continue
+                page.append(group)
+                first = ts if first is None else min(first, ts)
+                last = ts if last is None else max(last, ts)
+                if len(page) >= PAGE_SIZE:
+                    stored += measurement_store.save_page(account, page, decode_page(page))
+                    page = []
+            if page:
+                stored += measurement_store.save_page(account, page, decode_page(page))
+    return stored, first, last, skipped
+
+
+async def known_weights(account, garmin, start_ts, end_ts):
+    """reconcile.KeySet of the weigh-ins of [start_ts, end_ts] on Garmin or synced from the Withings API."""
+    keys = await reconcile.garmin_weights(garmin, start_ts, end_ts)
+    rows = await sync_engine.run_blocking(measurement_store.values, account, start_ts - reconcile.MATCH_SECONDS,
+                                          end_ts + reconcile.MATCH_SECONDS)
+    for grpid, date, weight, _, _, _ in rows:
+        # Export groups have negative ids
+        if grpid > 0 and weight:
+            keys.add(reconcile.weight_key(date, weight))
+    return keys
+
+
+async def stored_pages(account, start_ts, end_ts, garmin_task=None):
+    """
+    Pipeline source replaying the export groups of a range from the measurement store.
+    With garmin_task, weigh-ins that are already known (see known_weights) are left out.
+    """
+    pages = measurement_store.iter_pages(account, start_ts, end_ts, PAGE_SIZE, exported_only=True)
+    skipped = 0
+    while True:
+        groups = await sync_engine.run_blocking(next, pages, None)
+        if groups is None:
+            break
+        if garmin_task is not None:
+            known = await known_weights(account, await garmin_task, groups[0]['date'], groups[-1]['date'])
+            records = [decode_group(group) for group in groups]
+            kept = [group for group, record in zip(groups, records)
+                    if not (record.has_weight and reconcile.weight_key(record.date, record.weight) in known)]
+            skipped += len(groups) - len(kept)
+            if not kept:
+                continue
+            groups = kept
+        yield groups, groups[0]['date'], groups[-1]['date']
+    if skipped:
+        print(f"  {skipped} weigh-in(s) of the export already synced, not uploaded again.")
+
+
+async def upload_stored(settings, start_ts, end_ts, checkpoint=None, progress_callback=None, bulk=False):
+    """Runs the stored export groups of [start_ts, end_ts] through the sync pipeline."""
+    garmin_task = asyncio.ensure_future(sync_engine.run_blocking(circuit_breaker.GARMIN.call, sync_app.login_garmin, settings))
+    heights = await sync_engine.run_blocking(height_series.load_cached, settings)
+    sync_pipeline = pipeline.SyncPipeline(garmin_task, sync_engine._completed(heights), account=settings,
+                                          progress_callback=progress_callback, checkpoint=checkpoint,
+                                          store=False, bulk=bulk)
+    try:
+        await sync_pipeline.run(stored_pages(settings, start_ts, end_ts, garmin_task))
+    except circuit_breaker.CircuitOpenError as e:
+        print(f"Stopping: {circuit_breaker.BREAKERS[e.name].label} keeps failing. Resume the import once it is back.")
+        return False
+    except Exception:
+        if garmin_task.done() and garmin_task.exception():
+            print(f"Garmin Auth Failed. Check credentials. Error type: {type(garmin_task.exception()).__name__}")
+            return False
+        raise
+    return sync_pipeline
+
+
+def _merge_heights(settings, heights):
+    """Adds the archive's heights to the cached height history used for BMI."""
+    if not heights:
+        return
+    series = height_series.load_cached(settings) or height_series.HeightSeries()
+    changed = [series.add(ts, height) for ts, height in heights]
+    if any(changed):
+        height_series.store(settings, series)
+    print(f"  {len(heights)} height measurement(s) in the export, latest: {series.latest()} m")
+
+
+def run_export_import(path=None, account=None, resume=False, progress_callback=None, bulk=False):
+    """
+    Imports a Withings export archive into Garmin. With resume=True, continues the
+    account's last interrupted import from the measurement store instead (no archive needed).
+    """
+    print("Withings to Garmin Sync Tool - Export Import")
+    settings = accounts.resolve(account)
+    if not settings['garmin_email'] or not settings['garmin_password']:
+        print("Error: Garmin Credentials not found. Please configure your Garmin credentials.")
+        return
+
+    if resume:
+        pending = checkpoints.latest_resumable(settings, checkpoints.KIND_EXPORT)
+        checkpoint = pending and checkpoints.resume(pending['id'])
+        if not checkpoint:
+            print("No interrupted import to resume.")
+            return
+        start_ts, end_ts = checkpoint.resume_from, checkpoint.end_ts
+        print(f"Resuming after {checkpoint.processed} already processed measurement group(s).")
+    else:
+        print(f"Reading {os.path.basename(path)}...")
+        stored, start_ts, end_ts, skipped = ingest(path, settings)
+        with zipfile.ZipFile(path) as archive:
+            _merge_heights(settings, read_heights(archive))
+        print(f"  {stored} measurement group(s) read, {skipped} row(s) without weight or blood pressure skipped.")
+        if not stored:
+            print("No weight or blood pressure measurements found in the export.")
+            return
+        print(f"  Measurements from {datetime.fromtimestamp(start_ts).strftime('%Y-%m-%d')} "
+              f"to {datetime.fromtimestamp(end_ts).strftime('%Y-%m-%d')}.")
+        checkpoint = checkpoints.start(settings, start_ts, end_ts, checkpoints.KIND_EXPORT)
+
+    print("\nConnecting to Garmin...")
+    sync_pipeline = asyncio.run(upload_stored(settings, start_ts, end_ts, checkpoint=checkpoint,
+                                              progress_callback=progress_callback, bulk=bulk))
+    if sync_pipeline is False and not checkpoint.finished:
+        checkpoint.finish(False)
+    elif sync_pipeline:
+        print("\nExport Import Complete!")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a Withings data export (zip) into Garmin without using the Withings API.')
+    parser.add_argument('archive', nargs='?', help='Export archive downloaded from Withings')
+    parser.add_argument('--resume', action='store_true', help='Continue the last interrupted import')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    args = parser.parse_args()
+    if not args.archive and not args.resume:
+        parser.error('the archive is required unless --resume is given')
+    run_export_import(args.archive, account=args.account, resume=args.resume)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Withings Notify (push) support.
+
+Withings POSTs `userid`, `startdate`, `enddate` and `appli` to the subscribed callback URL
+whenever new data is available. Notifications for the same account are debounced and
+merged into one pending time window, which is synced by a single scheduler job once no
+new notification arrived for WITHINGS_NOTIFY_DEBOUNCE_SECONDS.
+
+Run this module directly to manage subscriptions or to post test notifications:
+
+    python withings_notify.py subscribe --callback-url https://example.com/webhook/withings
+    python withings_notify.py list
+    python withings_notify.py revoke --callback-url https://example.com/webhook/withings
+    python withings_notify.py simulate --url http://localhost:5000/webhook/withings --userid 12345
+"""
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+import accounts
+import config
+import sync_app
+import sync_engine
+
+APPLI_WEIGHT = 1 # Weight, fat, height, ...
+APPLI_HEART = 4  # Blood pressure, heart rate
+
+# Notification categories that carry data this app syncs
+SYNC_APPLIS = (APPLI_WEIGHT, APPLI_HEART)
+
+
+def parse_notification(form):
+    """Validates a notification payload. Returns a dict of ints, or None if it is malformed."""
+    try:
+        notification = {field: int(form[field]) for field in ('userid', 'startdate', 'enddate', 'appli')}
+    except (KeyError, TypeError, ValueError):
+        return None
+    if notification['startdate'] > notification['enddate']:
+        return None
+    return notification
+
+
+def find_account(userid):
+    """Returns the resolved settings of the account whose Withings token belongs to userid, or None."""
+    candidates = [None] + [a['id'] for a in accounts.list_accounts() if a['enabled']]
+    for account_id in candidates:
+        settings = accounts.resolve(account_id)
+        token_data = sync_app.load_credentials(settings['token_file'])
+        if token_data and str(token_data.get('userid')) == str(userid):
+            return settings
+    return None
+
+
+class NotificationCoalescer:
+    """
+    Merges notifications per account into one [start, end] window and runs a single sync
+    for it after the debounce delay. Each new notification pushes the sync back.
+
+    run_window(account_id, start_ts, end_ts) must return False if the sync could not start
+    (e.g. another sync of the account is running); the window is then retried later.
+    """
+
+    def __init__(self, scheduler, run_window, debounce_seconds=None):
+        self.scheduler = scheduler
+        self.run_window = run_window
+        self.debounce_seconds = config.WITHINGS_NOTIFY_DEBOUNCE_SECONDS if debounce_seconds is None else debounce_seconds
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, account_id, startdate, enddate):
+        key = accounts._account_key(account_id)
+        with self._lock:
+            window = self._pending.get(key)
+            if window:
+                startdate, enddate = min(window[1], startdate), max(window[2], enddate)
+            self._pending[key] = (account_id, startdate, enddate)
+            self.scheduler.add_job(
+                func=self._fire,
+                trigger='date',
+                run_date=datetime.now(self.scheduler.timezone) + timedelta(seconds=self.debounce_seconds),
+                args=[key],
+                id=f'withings_notify_{key}',
+                name=f'withings_notify_job_{key}',
+                replace_existing=True
+            )
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _fire(self, key):
+        with self._lock:
+            window = self._pending.pop(key, None)
+        if window and not self.run_window(*window):
+            print("Notification sync postponed: a sync for this account is already running.")
+            self.add(*window)
+
+
+def _access_token(account):
+    async def get():
+        async with sync_engine.client_session() as session:
+            return await sync_engine.get_access_token(session, account)
+    access_token = asyncio.run(get())
+    if not access_token:
+        raise Exception("Withings is not connected")
+    return access_token
+
+
+def subscribe(account, callback_url, applis=SYNC_APPLIS):
+    access_token = _access_token(account)
+    auth = sync_app.get_withings_auth(account)
+    for appli in applis:
+        auth.subscribe_notifications(access_token, callback_url, appli)
+
+
+def list_subscriptions(account):
+    access_token = _access_token(account)
+    auth = sync_app.get_withings_auth(account)
+    profiles = []
+    for appli in SYNC_APPLIS:
+        profiles.extend(auth.list_notifications(access_token, appli))
+    return profiles
+
+
+def revoke(account, callback_url, applis=SYNC_APPLIS):
+    access_token = _access_token(account)
+    auth = sync_app.get_withings_auth(account)
+    for appli in applis:
+        auth.revoke_notifications(access_token, callback_url, appli)
+
+
+def simulate(url, userid, startdate=None, enddate=None, appli=APPLI_WEIGHT, count=1, interval=0.0):
+    """Posts notification payloads the way Withings does (form encoded) to a local webhook."""
+    enddate = enddate or int(time.time())
+    startdate = startdate or enddate - 3600
+    for i in range(count):
+        response = requests.post(url, data={
+            'userid': userid,
+            'startdate': startdate,
+            'enddate': enddate,
+            'appli': appli
+        })
+        print(f"Notification {i + 1}/{count}: HTTP {response.status_code}")
+        if interval and i + 1 < count:
+            time.sleep(interval)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Manage Withings notification subscriptions.')
+    parser.add_argument('--account', type=int, default=None, help='Account ID (default: the main account)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('subscribe', help='Subscribe a callback URL to weight and blood pressure notifications')
+    p.add_argument('--callback-url', required=True)
+    sub.add_parser('list', help='List the subscribed callback URLs')
+    p = sub.add_parser('revoke', help='Remove a callback URL subscription')
+    p.add_argument('--callback-url', required=True)
+
+    p = sub.add_parser('simulate', help='Post test notifications to a webhook')
+    p.add_argument('--url', default='http://localhost:5000/webhook/withings')
+    p.add_argument('--userid', required=True)
+    p.add_argument('--startdate', type=int, default=None, help='Epoch seconds (default: one hour ago)')
+    p.add_argument('--enddate', type=int, default=None, help='Epoch seconds (default: now)')
+    p.add_argument('--appli', type=int, default=APPLI_WEIGHT)
+    p.add_argument('--count', type=int, default=1, help='Number of notifications to send')
+    p.add_argument('--interval', type=float, default=0.0, help='Seconds between notifications')
+    args = parser.parse_args()
+
+    if args.command == 'subscribe':
+        subscribe(args.account, args.callback_url)
+        print("Subscribed.")
+    elif args.command == 'list':
+        for profile in list_subscriptions(args.account):
+            print(f"appli {profile.get('appli')}: {profile.get('callbackurl')} ({profile.get('comment', '')})")
+    elif args.command == 'revoke':
+        revoke(args.account, args.callback_url)
+        print("Subscription revoked.")
+    elif args.command == 'simulate':
+        simulate(args.url, args.userid, args.startdate, args.enddate, args.appli, args.count, args.interval)
+
+
+if __name__ == "__main__":
+    main()